@@ -0,0 +1,32 @@
+"""Async counterparts of ValidatePartialUniqueMixin methods. Only imported on Python 3.5 and later."""
+try:
+    from asgiref.sync import sync_to_async  # Django 3.0 and later.
+except ImportError:
+    sync_to_async = None
+
+
+async def run_sync(func, *args):
+    """Runs a blocking function (usually a database query) from async code.
+
+    With asgiref, the function runs in the thread that holds the caller's database connection and transaction.
+    Django versions without asgiref have no async views, and the function is called directly instead.
+    """
+    if sync_to_async is None:
+        return func(*args)
+    return await sync_to_async(func, thread_sensitive=True)(*args)
+
+
+class AsyncValidatePartialUniqueMethods(object):
+    """Base class of ValidatePartialUniqueMixin with the async methods."""
+
+    async def avalidate_unique(self, exclude=None):
+        """Async version of validate_unique()."""
+        # Django does not have an async version of the standard unique validation, so both run in one call.
+        await run_sync(self.validate_unique, exclude)
+
+    async def avalidate_partial_unique(self):
+        """Async version of validate_partial_unique().
+
+        All unique partial indexes are still checked with a single query.
+        """
+        await run_sync(self.validate_partial_unique)
@@ -0,0 +1,200 @@
+"""Direct PQ to SQL compilation for the lookups that are commonly used in index predicates.
+
+Going through Query._add_q() and SQLCompiler supports every lookup, but builds a lot of machinery just to render a
+short WHERE clause. The compiler here walks the PQ tree against model._meta and produces the same SQL as Django
+for plain field lookups. Anything else raises Unsupported, and callers fall back to Django.
+"""
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import lookups, F, Model, Q
+from django.db.models.constants import LOOKUP_SEP
+
+
+class Unsupported(Exception):
+    """Raised for predicates that have to be compiled by Django."""
+
+
+# Lookup classes that are rendered here, by name. Fields with custom lookups registered under these names are
+# compiled by Django instead.
+LOOKUP_CLASSES = {
+    'exact': (lookups.Exact, ),
+    'gt': (lookups.GreaterThan, ),
+    'gte': (lookups.GreaterThanOrEqual, getattr(lookups, 'IntegerGreaterThanOrEqual', None)),
+    'lt': (lookups.LessThan, getattr(lookups, 'IntegerLessThan', None)),
+    'lte': (lookups.LessThanOrEqual, ),
+    'in': (lookups.In, ),
+    'isnull': (lookups.IsNull, ),
+}
+
+
+class WhereNode(object):
+    """Mirrors django.db.models.sql.where.WhereNode, including how children are squashed when they are added."""
+
+    def __init__(self, connector, negated=False, children=None):
+        self.connector = connector
+        self.negated = negated
+        self.children = children or []
+
+    def add(self, node):
+        if not node.negated and (node.connector == self.connector or len(node.children) == 1):
+            self.children.extend(node.children)
+        else:
+            self.children.append(node)
+
+    def as_sql(self, connection):
+        result = []
+        result_params = []
+        for child in self.children:
+            sql, params = child.as_sql(connection)
+            if sql:
+                result.append(sql)
+                result_params.extend(params)
+        sql = (' %s ' % self.connector).join(result)
+        if sql:
+            if self.negated:
+                sql = 'NOT (%s)' % sql
+            elif len(result) > 1:
+                sql = '(%s)' % sql
+        return sql, result_params
+
+
+class FieldLookup(object):
+    """A lookup on a local concrete field, with a prepared constant or another local field on the right hand side."""
+
+    def __init__(self, field, lookup_name, value=None, rhs_field=None):
+        self.field = field
+        self.lookup_name = lookup_name
+        self.value = value
+        self.rhs_field = rhs_field
+
+    def as_sql(self, connection):
+        qn = connection.ops.quote_name
+        lhs = '%s.%s' % (qn(self.field.model._meta.db_table), qn(self.field.column))
+        if self.lookup_name == 'isnull':
+            return '%s IS NULL' % lhs if self.value else '%s IS NOT NULL' % lhs, []
+
+        internal_type = self.field.get_internal_type()
+        if hasattr(connection.ops, 'field_cast_sql'):
+            lhs = connection.ops.field_cast_sql(self.field.db_type(connection=connection), internal_type) % lhs
+        lhs = connection.ops.lookup_cast(self.lookup_name, internal_type) % lhs
+
+        if self.rhs_field is not None:
+            rhs, params = '(%s.%s)' % (qn(self.rhs_field.model._meta.db_table), qn(self.rhs_field.column)), []
+        elif self.lookup_name == 'in':
+            params = [self.field.get_db_prep_value(value, connection, prepared=True) for value in self.value]
+            rhs = '(%s)' % ', '.join(['%s'] * len(params))
+        else:
+            rhs, params = '%s', [self.field.get_db_prep_value(self.value, connection, prepared=True)]
+
+        if self.lookup_name == 'in':
+            return '%s IN %s' % (lhs, rhs), params
+        return '%s %s' % (lhs, connection.operators[self.lookup_name] % rhs), params
+
+
+def compile_q(q, model, connection):
+    """Returns the SQL for a Q object with %s placeholders, its parameters, and the names of the mentioned fields.
+
+    Raises Unsupported if the Q object uses joins, transforms, expressions or lookups other than exact, gt, gte, lt,
+    lte, in and isnull.
+    """
+    where, mentioned_fields = resolve_q(q, model)
+    sql, params = where.as_sql(connection)
+    return sql, params, mentioned_fields
+
+
+def resolve_q(q, model):
+    """Returns a WhereNode for a Q object and the set of mentioned field names. Does not need a database connection."""
+    mentioned_fields = set()
+    where = _resolve_node(q, model._meta, mentioned_fields, False)
+    return where, mentioned_fields
+
+
+def _resolve_node(q, opts, mentioned_fields, current_negated):
+    # Follows Query._add_q().
+    current_negated = current_negated ^ q.negated
+    where = WhereNode(q.connector, q.negated)
+    for child in q.children:
+        if isinstance(child, Q):
+            child_where = _resolve_node(child, opts, mentioned_fields, current_negated)
+        else:
+            child_where = WhereNode(Q.AND, children=_resolve_lookups(child[0], child[1], opts, mentioned_fields, current_negated))
+        if child_where.children:
+            where.add(child_where)
+    return where
+
+
+def _resolve_lookups(lookup, value, opts, mentioned_fields, current_negated):
+    # Follows Query.build_filter().
+    parts = lookup.split(LOOKUP_SEP)
+    if len(parts) > 2:
+        raise Unsupported(lookup)
+    field = _local_field(opts, parts[0])
+    lookup_name = parts[1] if len(parts) == 2 else 'exact'
+    if lookup_name not in LOOKUP_CLASSES or field.get_lookup(lookup_name) not in LOOKUP_CLASSES[lookup_name]:
+        raise Unsupported(lookup)
+
+    mentioned_fields.add(field.name)
+    if value is None:
+        if lookup_name != 'exact':
+            # Django raises a helpful error for this.
+            raise Unsupported(lookup)
+        lookup_name, value = 'isnull', True
+
+    rhs_field = None
+    if lookup_name == 'isnull':
+        if not isinstance(value, bool):
+            raise Unsupported(lookup)
+    elif isinstance(value, F) and type(value).resolve_expression is F.resolve_expression:
+        rhs_field = _local_field(opts, value.name)
+        if current_negated and rhs_field.null:
+            # Django versions differ in whether a NULL check is added for the right hand side.
+            raise Unsupported(lookup)
+        mentioned_fields.add(rhs_field.name)
+        value = None
+    elif lookup_name == 'in':
+        if not isinstance(value, (list, tuple, set, frozenset)):
+            raise Unsupported(lookup)
+        prepared = [_prepare_value(field, item, lookup) for item in value]
+        if None in prepared:
+            raise Unsupported(lookup)
+        try:
+            value = list(OrderedDict.fromkeys(prepared))
+        except TypeError:
+            # Unhashable values are not deduplicated by Django.
+            raise Unsupported(lookup)
+        if not value:
+            # Django raises EmptyResultSet, which removes the lookup from the SQL.
+            raise Unsupported(lookup)
+    else:
+        if isinstance(value, float) and field.get_lookup(lookup_name) not in LOOKUP_CLASSES[lookup_name][:1]:
+            # IntegerField rounds floats for some comparisons.
+            raise Unsupported(lookup)
+        value = _prepare_value(field, value, lookup)
+
+    result = [FieldLookup(field, lookup_name, value, rhs_field)]
+    if current_negated and lookup_name != 'isnull' and field.null:
+        # NOT (a > 1) must not match rows where a is NULL.
+        result.append(FieldLookup(field, 'isnull', False))
+    return result
+
+
+def _local_field(opts, name):
+    if LOOKUP_SEP in name:
+        raise Unsupported(name)
+    if name == 'pk':
+        field = opts.pk
+    else:
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            raise Unsupported(name)
+    if not field.concrete or field.is_relation or field.model._meta.concrete_model is not opts.concrete_model:
+        raise Unsupported(name)
+    return field
+
+
+def _prepare_value(field, value, lookup):
+    if isinstance(value, Model) or hasattr(value, 'resolve_expression'):
+        raise Unsupported(lookup)
+    return field.get_prep_value(value)
@@ -0,0 +1,97 @@
+"""Finds rows that would violate a unique PartialIndex, without building the index.
+
+Creating a unique index on a table with duplicates only fails after the whole table has been scanned. The duplicate
+keys can be found faster with GROUP BY ... HAVING COUNT(*) > 1 over the rows covered by the index. The covered rows
+are aggregated once, in a single query, and its results are fetched in chunks, so that long lists of duplicates are
+not held in memory.
+"""
+from django.db import connections, DEFAULT_DB_ALIAS, IntegrityError
+from django.utils import six
+
+from . import query
+from .index import PartialIndex
+
+
+SQL_DUPLICATES = (
+    'SELECT %(keys)s, COUNT(*) FROM (SELECT %(columns)s FROM %(table)s WHERE %(where)s) partial_index_keys '
+    'WHERE %(conditions)s GROUP BY %(keys)s HAVING COUNT(*) > 1 ORDER BY %(keys)s'
+)
+
+# Number of duplicate keys listed in the IntegrityError raised by check_duplicates().
+MAX_REPORTED_DUPLICATES = 10
+
+
+def find_duplicates(model, index, using=DEFAULT_DB_ALIAS, chunk_size=1000):
+    """Yields (key, count) for each key that more than one row covered by a unique PartialIndex has, in key order.
+
+    The key is a tuple of database values, in the order of index.fields. Keys with NULL values are skipped, as they
+    do not conflict in unique indexes. The result rows are fetched chunk_size at a time, through a server-side cursor
+    on PostgreSQL.
+    """
+    if not isinstance(index, PartialIndex) or not index.unique:
+        raise ValueError('Duplicates can only be checked for unique PartialIndexes, got %r.' % index)
+    connection = connections[using]
+    sql, params = duplicates_sql_params(model, index, connection)
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+            for row in rows:
+                yield tuple(row[:-1]), row[-1]
+
+
+def duplicates_sql_params(model, index, connection):
+    """Returns the query of find_duplicates() and its parameters."""
+    vendor = connection.vendor
+    if vendor not in (query.Vendor.POSTGRESQL, query.Vendor.SQLITE):
+        raise ValueError('Database vendor %s is not supported by django-partial-index.' % vendor)
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    columns, params = [], []
+    for i, (key, order) in enumerate(index.key_orders):
+        if isinstance(key, six.string_types):
+            key_sql = '%s.%s' % (table, qn(model._meta.get_field(key).column))
+        else:
+            key_sql, key_params = query.expression_to_sql_params(key, model, connection)
+            params.extend(key_params)
+        columns.append('%s AS k%d' % (key_sql, i))
+
+    if isinstance(index.where, query.PQ):
+        where_sql, where_params = query.q_to_sql_params(index.where, model, connection)
+        params.extend(where_params)
+    else:
+        # Text-based where-conditions are inserted as they are, so literal percent signs must be escaped.
+        where_sql = (index.where_postgresql if vendor == query.Vendor.POSTGRESQL else index.where_sqlite) or index.where
+        where_sql = where_sql.replace('%', '%%')
+
+    keys = ['k%d' % i for i in range(len(columns))]
+    conditions = ['%s IS NOT NULL' % key for key in keys]
+    sql = SQL_DUPLICATES % {
+        'keys': ', '.join(keys),
+        'columns': ', '.join(columns),
+        'table': table,
+        'where': where_sql,
+        'conditions': ' AND '.join(conditions),
+    }
+    return sql, params
+
+
+def format_duplicate(index, key, count):
+    """order=1, group=2 (3 rows)"""
+    return '%s (%d rows)' % (', '.join('%s=%r' % (label, value) for label, value in zip(index.field_labels(), key)), count)
+
+
+def check_duplicates(model, index, using=DEFAULT_DB_ALIAS, chunk_size=1000):
+    """Raises IntegrityError if creating a unique PartialIndex would fail because of existing duplicates.
+
+    The error lists the first duplicate keys and their row counts.
+    """
+    duplicates = []
+    for key, count in find_duplicates(model, index, using=using, chunk_size=chunk_size):
+        duplicates.append(format_duplicate(index, key, count))
+        if len(duplicates) > MAX_REPORTED_DUPLICATES:
+            break
+    if duplicates:
+        shown = duplicates[:MAX_REPORTED_DUPLICATES]
+        more = ', ...' if len(duplicates) > MAX_REPORTED_DUPLICATES else ''
+        raise IntegrityError('Cannot create unique index %s, rows covered by it have duplicate keys: %s%s' % (
+            index.name, '; '.join(shown), more))
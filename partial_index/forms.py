@@ -0,0 +1,44 @@
+"""ModelFormSet support for ValidatePartialUniqueMixin."""
+from django.forms.models import BaseModelFormSet
+
+from .mixins import PartialUniqueValidationError
+
+
+class PartialUniqueBaseModelFormSet(BaseModelFormSet):
+    """Validates partial unique constraints of all forms in the formset at once.
+
+    Use as the formset base class for a model with ValidatePartialUniqueMixin:
+
+    MyFormSet = modelformset_factory(MyModel, formset=PartialUniqueBaseModelFormSet, fields=...)
+
+    Instead of a query per form, it runs a single query per unique PartialIndex for the whole formset.
+    Forms that conflict with each other are also detected. Errors are added to the non-field errors of each invalid form.
+    """
+
+    def full_clean(self):
+        # Skip validation of the single instance in ModelForm._post_clean(), it is done in validate_unique() below.
+        # Only while the formset is cleaned, so that the saved instances are validated as usual afterwards.
+        instances = [form.instance for form in self.forms]
+        for instance in instances:
+            instance._partial_unique_deferred = True
+        try:
+            super(PartialUniqueBaseModelFormSet, self).full_clean()
+        finally:
+            for instance in instances:
+                instance._partial_unique_deferred = False
+
+    def validate_unique(self):
+        super(PartialUniqueBaseModelFormSet, self).validate_unique()
+        if self.model.partial_unique_optimistic:
+            return
+
+        forms_to_delete = self.deleted_forms
+        valid_forms = [
+            form for form in self.forms
+            if form.is_valid() and form not in forms_to_delete and not (form.empty_permitted and not form.has_changed())
+        ]
+        try:
+            self.model.validate_partial_unique_bulk([form.instance for form in valid_forms])
+        except PartialUniqueValidationError as e:
+            for position, errors in e.error_dict.items():
+                valid_forms[position].add_error(None, errors)
@@ -0,0 +1,309 @@
+"""Checks whether a QuerySet can use a partial index.
+
+A database only uses a partial index for a query if the WHERE clause of the query implies the index predicate. The
+check here works on the predicates symbolically: both are brought into negation normal form, and every conjunct of the
+index predicate must follow from the conjuncts of the query. Lookups are compared pairwise on the same field, with
+exact, in, gt, gte, lt, lte and isnull understood as sets of values. This is sound but not complete - a conjunct that
+is reported as missing may still follow from a combination of several query conditions.
+"""
+from collections import namedtuple
+import re
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import Col
+
+from . import compiler as pq_compiler
+from .query import Vendor
+
+
+IndexUsage = namedtuple('IndexUsage', ['implied', 'missing', 'explain_uses_index'])
+IndexUsage.__doc__ = """Result of analyze_index_usage().
+
+implied: True if the query implies the index predicate, None if the predicate is not a PQ object.
+missing: Conjuncts of the index predicate that could not be shown to follow from the query, as PQ objects.
+explain_uses_index: True or False if the query plan was checked, otherwise None.
+"""
+
+EXPLAIN_PREFIX = {
+    Vendor.POSTGRESQL: 'EXPLAIN ',
+    Vendor.SQLITE: 'EXPLAIN QUERY PLAN ',
+}
+
+
+def analyze_index_usage(queryset, index, explain=False):
+    """Checks whether the WHERE clause of a QuerySet implies the where-condition of a partial index on its model.
+
+    JobQ.objects.order_by('-order') -> IndexUsage(implied=False, missing=[PQ(is_complete=False)], explain_uses_index=None)
+
+    Text-based where-conditions cannot be analyzed, and only the query plan is checked for them, if explain=True.
+    With explain=True the query plan is checked for the index name. Note that the planner may still choose not to use
+    an implied index, for example on small tables.
+    """
+    implied, missing = None, None
+    if isinstance(index.where, Q):
+        missing = missing_conjuncts(queryset, index.where)
+        implied = not missing
+    explained = explain_uses_index(queryset, index) if explain else None
+    return IndexUsage(implied, missing, explained)
+
+
+def missing_conjuncts(queryset, q):
+    """Returns the top-level conjuncts of a Q object that do not follow from the WHERE clause of a QuerySet."""
+    query = queryset.query
+    # The first alias is the base table. Query.get_initial_alias() is not used, as it changes reference counts.
+    alias = next(iter(query.alias_map), None)
+    where = _nnf(query.where, False, lambda lookup: _query_atom(lookup, query.model, alias))
+    if where is None:
+        conditions = []
+    elif isinstance(where, Atom) or where.connector == Q.OR:
+        conditions = [where]
+    else:
+        conditions = where.children
+
+    missing = []
+    for conjunct in conjuncts(q):
+        try:
+            predicate = _nnf(pq_compiler.resolve_q(conjunct, queryset.model)[0], False, _index_atom)
+        except pq_compiler.Unsupported:
+            predicate = None
+        if predicate is None or not _implies(conditions, predicate):
+            missing.append(conjunct)
+    return missing
+
+
+def conjuncts(q):
+    """Returns the top-level conjuncts of a Q object, as Q objects of the same class.
+
+    PQ(a=1, b=2) & (PQ(c=3) | PQ(d=4)) -> [PQ(a=1), PQ(b=2), PQ(c=3) | PQ(d=4)]
+    """
+    if q.connector == Q.AND and not q.negated:
+        return [child if isinstance(child, Q) else q.__class__(child) for child in q.children]
+    return [q]
+
+
+def explain_uses_index(queryset, index):
+    """Returns True if the query plan of a QuerySet mentions the index.
+
+    On PostgreSQL sequential scans are disabled while explaining, so that the result does not depend on table size.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor not in EXPLAIN_PREFIX:
+        raise ValueError('Database vendor %s is not supported by django-partial-index.' % connection.vendor)
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == Vendor.POSTGRESQL:
+            cursor.execute('SET enable_seqscan = off')
+        try:
+            cursor.execute(EXPLAIN_PREFIX[connection.vendor] + sql, params)
+            plan = '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+        finally:
+            if connection.vendor == Vendor.POSTGRESQL:
+                cursor.execute('RESET enable_seqscan')
+    return re.search(r'\b%s\b' % re.escape(index.name), plan) is not None
+
+
+class Atom(object):
+    """A lookup on a field, with a constant or another field on the right hand side, which may be negated.
+
+    Negated isnull lookups are written as isnull lookups with the opposite value.
+    """
+
+    def __init__(self, field, lookup_name, value, rhs_field=None, negated=False):
+        self.field = field
+        self.lookup_name = lookup_name
+        self.value = value
+        self.rhs_field = rhs_field
+        self.negated = negated
+
+    def negate(self):
+        if self.lookup_name == 'isnull':
+            return Atom(self.field, 'isnull', not self.value)
+        return Atom(self.field, self.lookup_name, self.value, self.rhs_field, not self.negated)
+
+    def key(self):
+        value = tuple(self.value) if self.lookup_name == 'in' else self.value
+        return self.field.column, self.lookup_name, value, self.rhs_field and self.rhs_field.column, self.negated
+
+
+class Node(object):
+    """AND or OR of atoms and nodes, without negation."""
+
+    def __init__(self, connector, children):
+        self.connector = connector
+        self.children = children
+
+
+def _nnf(node, negated, to_atom):
+    """Converts a where tree into negation normal form. Returns None if the condition is not understood.
+
+    Leaves are converted with to_atom(), which returns None for unknown lookups. Unknown parts of an AND are left out,
+    which makes the condition weaker, and any unknown part of an OR makes the whole OR unknown.
+    """
+    if not hasattr(node, 'children'):
+        atom = to_atom(node)
+        if atom is None:
+            return None
+        return atom.negate() if negated else atom
+
+    negated = negated ^ node.negated
+    connector = node.connector
+    if negated:
+        connector = Q.OR if connector == Q.AND else Q.AND
+    children = []
+    for child in node.children:
+        child = _nnf(child, negated, to_atom)
+        if child is None:
+            if connector == Q.OR:
+                return None
+        elif isinstance(child, Node) and child.connector == connector:
+            children.extend(child.children)
+        else:
+            children.append(child)
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return Node(connector, children)
+
+
+def _index_atom(lookup):
+    return Atom(lookup.field, lookup.lookup_name, lookup.value, lookup.rhs_field)
+
+
+def _query_atom(lookup, model, alias):
+    lookup_classes = pq_compiler.LOOKUP_CLASSES.get(getattr(lookup, 'lookup_name', None), ())
+    if type(lookup) not in lookup_classes or not _is_local_col(lookup.lhs, model, alias):
+        return None
+    rhs = lookup.rhs
+    if isinstance(rhs, Col):
+        return Atom(lookup.lhs.target, lookup.lookup_name, None, rhs.target) if _is_local_col(rhs, model, alias) else None
+    if hasattr(rhs, 'resolve_expression'):
+        return None
+    if lookup.lookup_name == 'in':
+        if not isinstance(rhs, (list, tuple, set, frozenset)) or any(hasattr(value, 'resolve_expression') for value in rhs):
+            return None
+        rhs = list(rhs)
+    return Atom(lookup.lhs.target, lookup.lookup_name, rhs)
+
+
+def _is_local_col(expression, model, alias):
+    return (isinstance(expression, Col) and expression.alias == alias and
+            expression.target.model._meta.concrete_model is model._meta.concrete_model)
+
+
+def _implies(conditions, predicate):
+    """Returns True if the conjunction of the conditions implies the predicate."""
+    if isinstance(predicate, Node) and predicate.connector == Q.AND:
+        return all(_implies(conditions, child) for child in predicate.children)
+    if isinstance(predicate, Node) and any(_implies(conditions, child) for child in predicate.children):
+        return True
+    for condition in conditions:
+        if isinstance(condition, Atom):
+            if isinstance(predicate, Atom) and _atom_implies(condition, predicate):
+                return True
+        elif condition.connector == Q.OR:
+            # Every alternative of the condition must imply the predicate.
+            others = [other for other in conditions if other is not condition]
+            if all(_implies(others + _conjuncts(alternative), predicate) for alternative in condition.children):
+                return True
+    return False
+
+
+def _conjuncts(node):
+    if isinstance(node, Node) and node.connector == Q.AND:
+        return node.children
+    return [node]
+
+
+def _atom_implies(condition, predicate):
+    if condition.field.column != predicate.field.column:
+        return False
+    condition, predicate = _positive_boolean(condition), _positive_boolean(predicate)
+    if condition.key() == predicate.key():
+        return True
+    if predicate.lookup_name == 'isnull':
+        # Comparisons are never true for NULL, and neither are their negations.
+        return not predicate.value and (condition.lookup_name != 'isnull' or not condition.value)
+    if 'isnull' in (condition.lookup_name, predicate.lookup_name) or condition.rhs_field or predicate.rhs_field:
+        return False
+
+    try:
+        if predicate.negated:
+            if condition.negated:
+                return _subset(_values(predicate), _values(condition))
+            return _disjoint(_values(condition), _values(predicate))
+        return not condition.negated and _subset(_values(condition), _values(predicate))
+    except TypeError:
+        # Values of different types cannot be compared.
+        return False
+
+
+def _positive_boolean(atom):
+    # NOT (is_complete = true) is is_complete = false, when the field is not nullable.
+    if atom.negated and atom.lookup_name in ('exact', 'in') and not atom.rhs_field and not atom.field.null and \
+            atom.field.get_internal_type() == 'BooleanField':
+        values = _values(atom)
+        return Atom(atom.field, 'in', [value for value in (False, True) if value not in values])
+    return atom
+
+
+# Sets of values that match a lookup. Finite sets are lists, ranges are (low, low inclusive, high, high inclusive)
+# tuples, where None is unbounded.
+def _values(atom):
+    if atom.lookup_name == 'exact':
+        return [atom.value]
+    if atom.lookup_name == 'in':
+        return atom.value
+    return {
+        'gt': (atom.value, False, None, False),
+        'gte': (atom.value, True, None, False),
+        'lt': (None, False, atom.value, False),
+        'lte': (None, False, atom.value, True),
+    }[atom.lookup_name]
+
+
+def _in_range(value, values):
+    low, low_inclusive, high, high_inclusive = values
+    if low is not None and not (value > low or (low_inclusive and value == low)):
+        return False
+    if high is not None and not (value < high or (high_inclusive and value == high)):
+        return False
+    return True
+
+
+def _subset(values, other):
+    if isinstance(values, list):
+        if isinstance(other, list):
+            return all(value in other for value in values)
+        return all(_in_range(value, other) for value in values)
+    if isinstance(other, list):
+        return False
+    low, low_inclusive, high, high_inclusive = values
+    other_low, other_low_inclusive, other_high, other_high_inclusive = other
+    if other_low is not None:
+        if low is None or low < other_low or (low == other_low and low_inclusive and not other_low_inclusive):
+            return False
+    if other_high is not None:
+        if high is None or high > other_high or (high == other_high and high_inclusive and not other_high_inclusive):
+            return False
+    return True
+
+
+def _disjoint(values, other):
+    if isinstance(values, list):
+        if isinstance(other, list):
+            return not any(value in other for value in values)
+        return not any(_in_range(value, other) for value in values)
+    if isinstance(other, list):
+        return _disjoint(other, values)
+    return _below(values, other) or _below(other, values)
+
+
+def _below(values, other):
+    # True if the range of values ends before the other range starts.
+    high, high_inclusive = values[2:]
+    other_low, other_low_inclusive = other[:2]
+    if high is None or other_low is None:
+        return False
+    return high < other_low or (high == other_low and not (high_inclusive and other_low_inclusive))
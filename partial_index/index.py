@@ -1,4 +1,5 @@
 from django.db.models import Index, Q
+from django.db.models.expressions import OrderBy
 from django.utils import six
 from django.utils.encoding import force_bytes
 import hashlib
@@ -36,25 +37,165 @@ def validate_where(where='', where_postgresql='', where_sqlite=''):
     return where, where_postgresql, where_sqlite
 
 
+# Index access methods of PostgreSQL. SQLite only has btree indexes.
+INDEX_TYPES = ['btree', 'hash', 'gist', 'spgist', 'gin', 'brin']
+
+# Storage parameters of each index access method on PostgreSQL, with the type of their values.
+STORAGE_PARAMS = {
+    'btree': {'fillfactor': int, 'deduplicate_items': bool},
+    'hash': {'fillfactor': int},
+    'gist': {'fillfactor': int, 'buffering': str},
+    'spgist': {'fillfactor': int},
+    'gin': {'fastupdate': bool, 'gin_pending_list_limit': int},
+    'brin': {'pages_per_range': int, 'autosummarize': bool},
+}
+
+
+def validate_storage_params(storage_params, index_type=None):
+    """Checks storage parameters against the ones known for the index type, so that typos fail when the index is defined."""
+    if not isinstance(storage_params, dict):
+        raise ValueError('PartialIndex.storage_params must be a dict.')
+    index_type = index_type or 'btree'
+    known = STORAGE_PARAMS[index_type]
+    for param, value in storage_params.items():
+        if param not in known:
+            raise ValueError('Unknown storage parameter %s for %s indexes. Valid parameters are %s.' % (
+                param, index_type, ', '.join(sorted(known))))
+        # bool is a subclass of int, but fillfactor=True is a mistake.
+        if not isinstance(value, known[param]) or (known[param] is int and isinstance(value, bool)):
+            raise ValueError('Storage parameter %s must be of type %s.' % (param, known[param].__name__))
+    if not 10 <= storage_params.get('fillfactor', 100) <= 100:
+        raise ValueError('Storage parameter fillfactor must be between 10 and 100.')
+    if storage_params.get('buffering', 'auto') not in ('on', 'off', 'auto'):
+        raise ValueError('Storage parameter buffering must be on, off or auto.')
+    return storage_params
+
+
+def storage_params_sql(storage_params):
+    """{'fillfactor': 70, 'deduplicate_items': False} -> ' WITH (deduplicate_items = off, fillfactor = 70)'"""
+    if not storage_params:
+        return ''
+    values = []
+    for param, value in sorted(storage_params.items()):
+        if isinstance(value, bool):
+            value = 'on' if value else 'off'
+        values.append('%s = %s' % (param, value))
+    return ' WITH (%s)' % ', '.join(values)
+
+
 class PartialIndex(Index):
+    """An index with a WHERE condition.
+
+    Indexes are hashable, and equality compares a cached key of the index definition before falling back to comparing
+    deconstruct() results. The key is reset when an attribute is assigned, so the fields list must not be changed in place.
+    """
     suffix = 'partial'
     # Allow an index name longer than 30 characters since this index can only be used on PostgreSQL and SQLite,
     # and the Django default 30 character limit for cross-database compatibility isn't applicable.
     # The "partial" suffix is 4 letters longer than the default "idx".
     max_name_length = 34
+    _definition_hash = None
     sql_create_index = {
-        'postgresql': 'CREATE%(unique)s INDEX %(name)s ON %(table)s%(using)s (%(columns)s)%(extra)s WHERE %(where)s',
+        'postgresql': 'CREATE%(unique)s INDEX%(concurrently)s %(name)s ON %(table)s%(using)s (%(columns)s)%(include)s%(extra)s WHERE %(where)s',
         'sqlite': 'CREATE%(unique)s INDEX %(name)s ON %(table)s%(using)s (%(columns)s) WHERE %(where)s',
     }
 
     # Mutable default fields=[] looks wrong, but it's copied from super class.
-    def __init__(self, fields=[], name=None, unique=None, where='', where_postgresql='', where_sqlite=''):
+    def __init__(self, fields=[], name=None, unique=None, where='', where_postgresql='', where_sqlite='', normalize_where=False,
+                 include=(), include_as_key=False, index_type=None, opclasses=(), storage_params=None, db_tablespace=None):
         if unique not in [True, False]:
             raise ValueError('Unique must be True or False')
         self.unique = unique
+        if index_type is not None and index_type not in INDEX_TYPES:
+            raise ValueError('PartialIndex.index_type must be one of %s.' % ', '.join(INDEX_TYPES))
+        if index_type not in (None, 'btree') and unique:
+            raise ValueError('Only btree indexes can be unique.')
+        self.storage_params = dict(validate_storage_params(storage_params or {}, index_type))
+        if not isinstance(opclasses, (list, tuple)):
+            raise ValueError('PartialIndex.opclasses must be a list or tuple.')
+        if opclasses and len(opclasses) != len(fields):
+            raise ValueError('PartialIndex.fields and PartialIndex.opclasses must have the same number of elements.')
+        if not isinstance(include, (list, tuple)):
+            raise ValueError('PartialIndex.include must be a list or tuple.')
+        if any(not isinstance(field_name, six.string_types) or field_name.startswith('-') for field_name in include):
+            raise ValueError('PartialIndex.include must contain field names, without ordering.')
+        if include_as_key and unique:
+            raise ValueError('include_as_key cannot be used with unique=True, as it would change what is unique.')
+        self.include = list(include)
+        # SQLite has no INCLUDE. Adding the columns to the end of the index key there is opt-in.
+        self.include_as_key = include_as_key
         self.where, self.where_postgresql, self.where_sqlite = \
             validate_where(where=where, where_postgresql=where_postgresql, where_sqlite=where_sqlite)
-        super(PartialIndex, self).__init__(fields=fields, name=name)
+        # Off by default, as normalizing changes the generated names of existing indexes.
+        self.normalize_where = normalize_where
+        if normalize_where:
+            if not isinstance(self.where, query.PQ):
+                raise ValueError('normalize_where can only be used with where=PQ().')
+            self.where = query.normalize_q(self.where)
+            if not self.where:
+                raise ValueError('The where predicate is empty.')
+        if not isinstance(fields, (list, tuple)):
+            raise ValueError('Index.fields must be a list or tuple.')
+        if any(not isinstance(field, six.string_types) and not hasattr(field, 'resolve_expression') for field in fields):
+            raise ValueError('PartialIndex.fields must contain field names or expressions.')
+        # Index.__init__() only accepts field names, expressions are put back below.
+        super(PartialIndex, self).__init__(
+            fields=[field if isinstance(field, six.string_types) else 'expression' for field in fields], name=name,
+        )
+        # All keys with their orders. fields_orders only has the field names, which Django checks against the model.
+        self.key_orders = [self.field_order(field) for field in fields]
+        if any(not isinstance(field, six.string_types) for field in fields):
+            self.fields = list(fields)
+            self.fields_orders = [(key, order) for key, order in self.key_orders if isinstance(key, six.string_types)]
+        if index_type not in (None, 'btree') and any(order for field, order in self.key_orders):
+            raise ValueError('Only btree indexes can have descending fields.')
+        # Set after Index.__init__(), which has its own opclasses on Django 2.2.
+        self.index_type = index_type
+        self.opclasses = list(opclasses)
+        # Index.__init__() only accepts db_tablespace on Django 2.0 and later.
+        self.db_tablespace = db_tablespace
+
+    def key_expressions(self):
+        """Returns the keys which are expressions instead of field names."""
+        return [field for field, order in self.key_orders if not isinstance(field, six.string_types)]
+
+    @staticmethod
+    def field_order(field):
+        """Returns (field name or expression, order) for a key. Lower('email').desc() is a descending expression key."""
+        if isinstance(field, six.string_types):
+            return (field[1:], 'DESC') if field.startswith('-') else (field, '')
+        if isinstance(field, OrderBy):
+            return field.expression, 'DESC' if field.descending else ''
+        return field, ''
+
+    def __setattr__(self, name, value):
+        self.__dict__['_definition_hash'] = None
+        super(PartialIndex, self).__setattr__(name, value)
+
+    def _definition_key(self):
+        return (
+            self.__class__.__name__, tuple(self.field_labels()), self.name, self.db_tablespace, self.unique,
+            self.where, self.where_postgresql, self.where_sqlite, self.normalize_where, tuple(self.include), self.include_as_key,
+            self.index_type, tuple(self.opclasses), tuple(sorted(self.storage_params.items())),
+        )
+
+    def __hash__(self):
+        if self._definition_hash is None:
+            self.__dict__['_definition_hash'] = hash(self._definition_key())
+        return self._definition_hash
+
+    def __eq__(self, other):
+        if self.__class__ != other.__class__:
+            return False
+        if self is other:
+            return True
+        if hash(self) != hash(other):
+            return False
+        return super(PartialIndex, self).__eq__(other)
+
+    def field_labels(self):
+        """Returns the fields as strings, with expressions as their repr()."""
+        return [field if isinstance(field, six.string_types) else repr(field) for field in self.fields]
 
     def __repr__(self):
         if self.where:
@@ -65,11 +206,21 @@ class PartialIndex(Index):
         else:
             anywhere = "where_postgresql='%s', where_sqlite='%s'" % (self.where_postgresql, self.where_sqlite)
 
-        return "<%(name)s: fields=%(fields)s, unique=%(unique)s, %(anywhere)s>" % {
+        include = ", include='%s'" % ', '.join(self.include) if self.include else ''
+        if self.index_type:
+            include += ", index_type='%s'" % self.index_type
+        if self.opclasses:
+            include += ", opclasses='%s'" % ', '.join(self.opclasses)
+        if self.storage_params:
+            include += ", storage_params=%r" % dict(sorted(self.storage_params.items()))
+        if self.db_tablespace:
+            include += ", db_tablespace='%s'" % self.db_tablespace
+        return "<%(name)s: fields=%(fields)s, unique=%(unique)s, %(anywhere)s%(include)s>" % {
             'name': self.__class__.__name__,
-            'fields': "'{}'".format(', '.join(self.fields)),
+            'fields': "'{}'".format(', '.join(self.field_labels())),
             'unique': self.unique,
-            'anywhere': anywhere
+            'anywhere': anywhere,
+            'include': include,
         }
 
     def deconstruct(self):
@@ -79,9 +230,26 @@ class PartialIndex(Index):
         kwargs['unique'] = self.unique
         if self.where:
             kwargs['where'] = self.where
+            if self.normalize_where:
+                kwargs['normalize_where'] = True
         else:
             kwargs['where_postgresql'] = self.where_postgresql
             kwargs['where_sqlite'] = self.where_sqlite
+        if self.include:
+            kwargs['include'] = self.include
+            if self.include_as_key:
+                kwargs['include_as_key'] = True
+        if self.index_type:
+            kwargs['index_type'] = self.index_type
+        # Index.deconstruct() also adds opclasses on Django 2.2, but not on earlier versions.
+        kwargs.pop('opclasses', None)
+        if self.opclasses:
+            kwargs['opclasses'] = self.opclasses
+        if self.storage_params:
+            kwargs['storage_params'] = self.storage_params
+        # Index.deconstruct() also adds db_tablespace on Django 2.0 and later.
+        if self.db_tablespace is not None:
+            kwargs['db_tablespace'] = self.db_tablespace
         return path, args, kwargs
 
     def get_sql_create_template_values(self, model, schema_editor, using):
@@ -90,12 +258,24 @@ class PartialIndex(Index):
         # Can be simplified if Django 1.11 support is dropped one day.
 
         # Copied from Django 1.11 Index.get_sql_create_template_values(), which does not exist in Django 2.0:
-        fields = [model._meta.get_field(field_name) for field_name, order in self.fields_orders]
-        tablespace_sql = schema_editor._get_index_tablespace_sql(model, fields)
+        # PartialIndex updates: keys may be expressions, and operator classes go between the column and the order.
+        fields = [
+            model._meta.get_field(field_name) if isinstance(field_name, six.string_types) else field_name
+            for field_name, order in self.key_orders
+        ]
+        if self.db_tablespace is not None:
+            # PartialIndex update: explicit tablespace, as in Django 2.0 and later.
+            tablespace_sql = ' ' + schema_editor.connection.ops.tablespace_sql(self.db_tablespace)
+        else:
+            tablespace_sql = schema_editor._get_index_tablespace_sql(model, [field for field in fields if not hasattr(field, 'resolve_expression')])
         quote_name = schema_editor.quote_name
         columns = [
-            ('%s %s' % (quote_name(field.column), order)).strip()
-            for field, (field_name, order) in zip(fields, self.fields_orders)
+            ' '.join(part for part in (
+                '(%s)' % query.expression_to_sql(field, model, schema_editor) if hasattr(field, 'resolve_expression') else quote_name(field.column),
+                opclass,
+                order,
+            ) if part)
+            for field, opclass, (field_name, order) in zip(fields, self.opclasses or [''] * len(fields), self.key_orders)
         ]
         parameters = {
             'table': quote_name(model._meta.db_table),
@@ -107,9 +287,25 @@ class PartialIndex(Index):
 
         # PartialIndex updates:
         parameters['unique'] = ' UNIQUE' if self.unique else ''
+        vendor = query.get_valid_vendor(schema_editor)
+        if vendor == query.Vendor.POSTGRESQL:
+            if self.index_type:
+                parameters['using'] = ' USING %s' % self.index_type
+            # Storage parameters come before the tablespace.
+            parameters['extra'] = storage_params_sql(self.storage_params) + parameters['extra']
+        elif self.index_type not in (None, 'btree') or self.opclasses:
+            raise ValueError('Index %s has an index type or operator classes, which SQLite does not support.' % self.name)
+        include_columns = [quote_name(model._meta.get_field(field_name).column) for field_name in self.include]
+        parameters['include'] = ''
+        if include_columns:
+            if vendor == query.Vendor.POSTGRESQL:
+                parameters['include'] = ' INCLUDE (%s)' % ', '.join(include_columns)
+            elif self.include_as_key:
+                parameters['columns'] = ', '.join(columns + include_columns)
+            else:
+                raise ValueError('Index %s has include columns, which SQLite does not support. Use include_as_key=True to add them to the index key instead.' % self.name)
         # Note: the WHERE predicate is not yet checked for syntax or field names, and is inserted into the CREATE INDEX query unescaped.
         # This is bad for usability, but is not a security risk, as the string cannot come from user input.
-        vendor = query.get_valid_vendor(schema_editor)
         if isinstance(self.where, query.PQ):
             parameters['where'] = query.q_to_sql(self.where, model, schema_editor)
         elif vendor == 'postgresql':
@@ -120,14 +316,27 @@ class PartialIndex(Index):
             raise ValueError('Should never happen')
         return parameters
 
-    def create_sql(self, model, schema_editor, using=''):
+    def create_sql(self, model, schema_editor, using='', concurrently=False):
         vendor = query.get_valid_vendor(schema_editor)
+        if concurrently and vendor != query.Vendor.POSTGRESQL:
+            raise ValueError('Indexes can only be created concurrently on PostgreSQL.')
         sql_template = self.sql_create_index[vendor]
         sql_parameters = self.get_sql_create_template_values(model, schema_editor, using)
+        sql_parameters['concurrently'] = ' CONCURRENTLY' if concurrently else ''
         return sql_template % sql_parameters
 
     def name_hash_extra_data(self):
-        return [str(self.unique), self.where, self.where_postgresql, self.where_sqlite]
+        data = [str(self.unique), self.where, self.where_postgresql, self.where_sqlite]
+        # Only added when used, so that the names of existing indexes do not change.
+        if self.include:
+            data.append('include=%s' % ','.join(self.include))
+        if self.index_type not in (None, 'btree'):
+            data.append('index_type=%s' % self.index_type)
+        if self.opclasses:
+            data.append('opclasses=%s' % ','.join(self.opclasses))
+        if self.storage_params:
+            data.append('storage_params=%s' % ','.join('%s=%s' % item for item in sorted(self.storage_params.items())))
+        return data
 
     def set_name_with_model(self, model):
         """Sets an unique generated name for the index.
@@ -135,10 +344,10 @@ class PartialIndex(Index):
         PartialIndex would like to only override "hash_data = ...", but the entire method must be duplicated for that.
         """
         table_name = model._meta.db_table
-        column_names = [model._meta.get_field(field_name).column for field_name, order in self.fields_orders]
+        column_names = [self._name_column(model, field_name) for field_name, order in self.key_orders]
         column_names_with_order = [
-            (('-%s' if order else '%s') % column_name)
-            for column_name, (field_name, order) in zip(column_names, self.fields_orders)
+            (('-%s' if order else '%s') % (column_name if isinstance(field_name, six.string_types) else repr(field_name)))
+            for column_name, (field_name, order) in zip(column_names, self.key_orders)
         ]
         # The length of the parts of the name is based on the default max
         # length of 30 characters.
@@ -154,6 +363,14 @@ class PartialIndex(Index):
         )
         self.check_name()
 
+    @staticmethod
+    def _name_column(model, field_name):
+        # Expressions are named after the first field they refer to.
+        if isinstance(field_name, six.string_types):
+            return model._meta.get_field(field_name).column
+        field_names = query.expression_mentioned_field_names(field_name, model)
+        return model._meta.get_field(field_names[0]).column if field_names else 'expr'
+
     @staticmethod
     def _hash_generator(*args):
         """Copied from Django 2.1 for compatibility. In Django 2.2 this has been moved into django.db.backends.utils.names_digest().
@@ -0,0 +1,52 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, router
+
+from partial_index.duplicates import find_duplicates, format_duplicate
+from partial_index.mixins import unique_partial_indexes
+
+
+class Command(BaseCommand):
+    help = ('Finds rows that would violate unique partial indexes, without building the indexes. '
+            'Exits with an error if any duplicates are found.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('labels', nargs='*', metavar='app_label[.ModelName]',
+                            help='Only check these apps or models. All installed models are checked by default.')
+        parser.add_argument('--index', help='Only check the index with this name.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='The database to check. Defaults to "default".')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of duplicate keys fetched from the database at a time.')
+
+    def handle(self, *args, **options):
+        duplicate_count = 0
+        checked = False
+        for model in self.get_models(options['labels']):
+            if not router.allow_migrate_model(options['database'], model):
+                continue
+            for index in unique_partial_indexes(model):
+                if options['index'] and index.name != options['index']:
+                    continue
+                checked = True
+                for key, count in find_duplicates(model, index, using=options['database'], chunk_size=options['chunk_size']):
+                    duplicate_count += 1
+                    self.stdout.write('%s %s: %s' % (model._meta.label, index.name, format_duplicate(index, key, count)))
+        if options['index'] and not checked:
+            raise CommandError('No unique partial index named %s.' % options['index'])
+        if duplicate_count:
+            raise CommandError('Found %d duplicate keys.' % duplicate_count)
+        if options['verbosity'] >= 1:
+            self.stdout.write('No duplicates found.')
+
+    def get_models(self, labels):
+        if not labels:
+            return apps.get_models()
+        models = []
+        for label in labels:
+            try:
+                if '.' in label:
+                    models.append(apps.get_model(label))
+                else:
+                    models.extend(apps.get_app_config(label).get_models())
+            except LookupError as e:
+                raise CommandError(str(e))
+        return models
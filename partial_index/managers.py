@@ -0,0 +1,115 @@
+"""QuerySet and Manager that restrict queries to the rows covered by a partial index."""
+from collections import defaultdict
+import threading
+
+from django.db import connections, models, transaction
+from django.utils import six
+
+from . import implication
+from .index import PartialIndex
+from .query import PQ, q_matches_instance, q_mentioned_fields
+
+
+# Serialises claim_next() per database in this process, on databases without SELECT ... FOR UPDATE SKIP LOCKED.
+_claim_locks = defaultdict(threading.Lock)
+
+
+class PartialIndexQuerySet(models.QuerySet):
+    def covered_by(self, index, ordered=True):
+        """Restricts the QuerySet to the rows in a partial index, so that the database can use the index.
+
+        The index is a PartialIndex from the model's Meta.indexes, or its name. Conditions of its where-condition that
+        the QuerySet does not already imply are added as filters. With ordered=True, the QuerySet is also ordered by
+        the index fields, in the index order.
+
+        JobQ.objects.covered_by('jobq_order_partial') -> JobQ.objects.filter(is_complete=False).order_by('-order')
+        """
+        index = self._partial_index(index)
+        queryset = self
+        for conjunct in implication.missing_conjuncts(self, index.where):
+            queryset = queryset.filter(conjunct)
+        if ordered:
+            queryset = queryset.order_by(*[self._order_by(key, order) for key, order in index.key_orders])
+        return queryset
+
+    @staticmethod
+    def _order_by(key, order):
+        if not isinstance(key, six.string_types):
+            return key.desc() if order == 'DESC' else key.asc()
+        return '-' + key if order == 'DESC' else key
+
+    def claim_next(self, index, values, batch_size=1):
+        """Claims the next rows of a partial index, in index order, by updating them with the given values.
+
+        Meant for work queues, where the index covers the rows that still need work:
+
+        jobs = JobQ.objects.claim_next('jobq_order_partial', {'is_complete': True}, batch_size=10)
+
+        Returns a list of the claimed instances, with the values set. The values must take the rows out of the index
+        where-condition, so that they are not claimed again.
+
+        On PostgreSQL, the rows are locked with SELECT ... FOR UPDATE SKIP LOCKED, so that concurrent workers each get
+        different rows without waiting for each other. On SQLite, claims are serialised with a lock in this process, and
+        every row is updated only if it is still covered by the index, in case another process claimed it already.
+        """
+        index = self._partial_index(index)
+        self._check_claim_values(index, values)
+        queryset = self.covered_by(index)
+        connection = connections[queryset.db]
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic(using=queryset.db):
+                claimed = list(queryset.select_for_update(skip_locked=True)[:batch_size])
+                if claimed:
+                    queryset.model._base_manager.using(queryset.db).filter(pk__in=[obj.pk for obj in claimed]).update(**values)
+        else:
+            claimed = []
+            with _claim_locks[queryset.db]:
+                while len(claimed) < batch_size:
+                    candidates = list(queryset[:batch_size - len(claimed)])
+                    if not candidates:
+                        break
+                    for obj in candidates:
+                        if queryset.filter(pk=obj.pk).update(**values):
+                            claimed.append(obj)
+        for obj in claimed:
+            for name, value in values.items():
+                setattr(obj, name, value)
+        return claimed
+
+    def _check_claim_values(self, index, values):
+        # Some conjunct of the where-condition must be false for every row with the values, whatever its other fields are.
+        instance = self.model(**values)
+        for conjunct in implication.conjuncts(index.where):
+            if set(q_mentioned_fields(conjunct, self.model)) <= set(values) and q_matches_instance(conjunct, instance) is False:
+                return
+        raise ValueError('Claimed rows must not be covered by partial index %s. Values %r do not take them out of it.' % (index.name, values))
+
+    def _partial_index(self, index):
+        name = index.name if isinstance(index, PartialIndex) else index
+        for idx in self.model._meta.indexes:
+            if isinstance(idx, PartialIndex) and idx.name == name:
+                if not isinstance(idx.where, PQ):
+                    raise ValueError('Partial index %s has a text-based where-condition, which cannot be added to a QuerySet.' % name)
+                return idx
+        raise ValueError('Model %s has no partial index named %s.' % (self.model._meta.label, name))
+
+
+class PartialIndexManager(models.Manager.from_queryset(PartialIndexQuerySet)):
+    """Manager with the covered_by() QuerySet method.
+
+    If an index (or its name) is given, all QuerySets are restricted to the rows covered by that index, and ordered by it:
+
+    class Job(models.Model):
+        objects = PartialIndexManager()
+        open_jobs = PartialIndexManager('job_order_partial')
+    """
+
+    def __init__(self, index=None):
+        super(PartialIndexManager, self).__init__()
+        self.index = index
+
+    def get_queryset(self):
+        queryset = super(PartialIndexManager, self).get_queryset()
+        if self.index is not None:
+            queryset = queryset.covered_by(self.index)
+        return queryset
@@ -1,15 +1,210 @@
+from collections import OrderedDict
+from functools import reduce
+import operator
+import re
+import sys
+import weakref
+
 from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.db.models import Q
+from django.core.signals import setting_changed
+from django.db import connections, router, transaction, IntegrityError
+from django.db.models import F, Q, Value
+from django.dispatch import receiver
+from django.utils import six
 
 from .index import PartialIndex
 from . import query
 
+if sys.version_info >= (3, 5):
+    from .async_mixins import AsyncValidatePartialUniqueMethods
+else:
+    AsyncValidatePartialUniqueMethods = object
+
 
 class PartialUniqueValidationError(ValidationError):
     pass
 
 
-class ValidatePartialUniqueMixin(object):
+def unique_partial_indexes(model):
+    """Returns the PartialIndexes with unique=True defined on the model."""
+    return [idx for idx in model._meta.indexes if isinstance(idx, PartialIndex) and idx.unique]
+
+
+def partial_unique_mentioned_fields(model, idx):
+    """Returns the set of field names that must be compared when looking for conflicts in a unique PartialIndex.
+
+    These are the fields in idx.fields, and the fields referred to by idx.where. Fields that are only used in expression
+    keys are not included, as rows with different values can still have the same value for the expression.
+    """
+    if not isinstance(idx.where, Q):
+        raise ImproperlyConfigured(
+            'ValidatePartialUniqueMixin is not supported for PartialIndexes with a text-based where condition. ' +
+            'Please upgrade to Q-object based where conditions.'
+        )
+
+    mentioned_fields = set(field_name for field_name, order in idx.fields_orders) | set(query.q_mentioned_fields(idx.where, model))
+
+    model_fields = set(f.name for f in model._meta.get_fields(include_parents=True, include_hidden=True))
+    missing_fields = mentioned_fields - model_fields
+    if missing_fields:
+        raise RuntimeError(('Unable to use ValidatePartialUniqueMixin: expecting to find fields %s on model. ' +
+                            'This is a bug in the PartialIndex definition or the django-partial-index library itself.') %
+                           ', '.join(sorted(missing_fields)))
+    return mentioned_fields
+
+
+class KeyParam(object):
+    """Placeholder for the value of a field of the validated instance, in the parameters of precompiled conflict SQL."""
+
+    def __init__(self, field):
+        self.field = field
+
+    def value(self, instance, connection):
+        return self.field.get_db_prep_value(getattr(instance, self.field.attname), connection)
+
+
+def instance_expression(expression, instance):
+    """Returns the expression with field references replaced by the values of the instance.
+
+    Lower('email') -> Lower(Value(instance.email))
+    """
+    if isinstance(expression, F):
+        field = instance._meta.get_field(expression.name)
+        return Value(getattr(instance, field.attname), output_field=field)
+    if not hasattr(expression, 'get_source_expressions'):
+        return expression
+    expression = expression.copy()
+    expression.set_source_expressions([instance_expression(source, instance) for source in expression.get_source_expressions()])
+    return expression
+
+
+class PartialUniqueIndexInfo(object):
+    """Everything needed for validating one unique PartialIndex, which does not depend on the instance being validated."""
+
+    def __init__(self, model, idx):
+        self.idx = idx
+        self.name = idx.name
+        self.where = idx.where
+        self.table = model._meta.db_table
+        self.columns = [model._meta.get_field(field_name).column for field_name, order in idx.fields_orders]
+        self.mentioned_fields = sorted(partial_unique_mentioned_fields(model, idx))
+        self.fields = [model._meta.get_field(field_name) for field_name in self.mentioned_fields]
+        self.attnames = [field.attname for field in self.fields]
+        # Keys that are expressions are compared by evaluating them for both rows in the database.
+        self.expressions = idx.key_expressions()
+        expression_field_names = set(
+            field_name for expression in self.expressions for field_name in query.expression_mentioned_field_names(expression, model)
+        )
+        self.expression_fields = [model._meta.get_field(field_name) for field_name in sorted(expression_field_names - set(self.mentioned_fields))]
+        # Fields whose changes require validating the index again.
+        self.tracked_fields = self.fields + self.expression_fields
+        self.tracked_attnames = [field.attname for field in self.tracked_fields]
+        self.error_message = '%s with the same values for %s already exists.' % (
+            model.__name__,
+            ', '.join(sorted(idx.field_labels())),
+        )
+        self.duplicate_error_message = '%s with the same values for %s is repeated in the same batch.' % (
+            model.__name__,
+            ', '.join(sorted(idx.field_labels())),
+        )
+        # (connection alias, attnames with NULL values, whether pk is excluded) -> (SQL, parameters from expressions and where)
+        self._conflict_sql = {}
+
+    def conflict_sql(self, model, connection, null_attnames, exclude_pk):
+        """Returns the SQL statement for finding a conflicting row, and the parameters of the expressions and where condition in it.
+
+        The statement has placeholders for the values of non-NULL mentioned fields (in the order of self.attnames),
+        then the parameters of the expression keys, then the parameters of the where condition, then the primary key to
+        exclude if exclude_pk is True. Parameters of expression keys that depend on the instance are KeyParam objects.
+
+        The statement is compiled once and reused, so that the query planner can match it to the partial index.
+        """
+        key = (connection.alias, null_attnames, exclude_pk)
+        try:
+            return self._conflict_sql[key]
+        except KeyError:
+            pass
+
+        qn = connection.ops.quote_name
+        table = qn(self.table)
+        conditions = []
+        for field in self.fields:
+            column = '%s.%s' % (table, qn(field.column))
+            conditions.append(('%s IS NULL' if field.attname in null_attnames else '%s = %%s') % column)
+        params = []
+        for expression in self.expressions:
+            expression_sql, expression_params = self.expression_conflict_sql(model, connection, expression)
+            conditions.append(expression_sql)
+            params.extend(expression_params)
+        where_sql, where_params = query.q_to_sql_params(self.where, model, connection)
+        conditions.append('(%s)' % where_sql)
+        params.extend(where_params)
+        if exclude_pk:
+            conditions.append('%s.%s <> %%s' % (table, qn(model._meta.pk.column)))
+
+        sql = 'SELECT 1 FROM %s WHERE %s LIMIT 1' % (table, ' AND '.join(conditions))
+        self._conflict_sql[key] = sql, tuple(params)
+        return self._conflict_sql[key]
+
+    def expression_conflict_sql(self, model, connection, expression):
+        """Returns SQL comparing an expression key of a row to the same expression for the instance, and its parameters.
+
+        LOWER("t"."email") = LOWER(%s), with a KeyParam for the email of the instance.
+        """
+        sql, params = query.expression_to_sql_params(expression, model, connection)
+        qn = connection.ops.quote_name
+        columns = OrderedDict(('%s.%s' % (qn(self.table), qn(field.column)), field) for field in model._meta.concrete_fields)
+        token_re = re.compile('|'.join(['%s'] + [re.escape(column) for column in columns]))
+        constants = iter(params)
+        instance_params = [next(constants) if token == '%s' else KeyParam(columns[token]) for token in token_re.findall(sql)]
+        instance_sql = token_re.sub('%s', sql)
+        return '%s = %s' % (sql, instance_sql), list(params) + instance_params
+
+    def matches_integrity_error(self, error):
+        """Returns True if the IntegrityError was raised by the database for a conflict in this index."""
+        message = six.text_type(error)
+        # PostgreSQL: duplicate key value violates unique constraint "<index name>"
+        if 'unique constraint "%s"' % self.name in message:
+            return True
+        # SQLite: UNIQUE constraint failed: <table>.<column>, <table>.<column>
+        # Or for indexes on expressions: UNIQUE constraint failed: index '<index name>'
+        prefix = 'UNIQUE constraint failed: '
+        if message.startswith(prefix):
+            failed = message[len(prefix):]
+            return failed == "index '%s'" % self.name or failed.split(', ') == ['%s.%s' % (self.table, column) for column in self.columns]
+        return False
+
+
+# Model class -> list of PartialUniqueIndexInfo. Weak keys, so that temporary models (for example from migration states)
+# are not kept alive.
+_partial_unique_cache = weakref.WeakKeyDictionary()
+
+
+def partial_unique_index_infos(model):
+    """Returns PartialUniqueIndexInfo for every unique PartialIndex on the model.
+
+    Computed on first use and cached per model class, as index definitions do not change at runtime.
+    """
+    try:
+        return _partial_unique_cache[model]
+    except KeyError:
+        infos = [PartialUniqueIndexInfo(model, idx) for idx in unique_partial_indexes(model)]
+        _partial_unique_cache[model] = infos
+        return infos
+
+
+def clear_partial_unique_cache():
+    _partial_unique_cache.clear()
+
+
+@receiver(setting_changed)
+def _clear_partial_unique_cache_on_installed_apps_change(setting, **kwargs):
+    # Changing INSTALLED_APPS reloads the app registry.
+    if setting == 'INSTALLED_APPS':
+        clear_partial_unique_cache()
+
+
+class ValidatePartialUniqueMixin(AsyncValidatePartialUniqueMethods):
     """PartialIndex with unique=True validation to ModelForms and Django Rest Framework Serializers.
 
     Mixin should be added before the parent model class, for example:
@@ -31,12 +226,77 @@ class ValidatePartialUniqueMixin(object):
 
     ValidatePartialUniqueMixin does not follow that example:
     It always validates with all fields, even if they are not on the form.
+
+    Set partial_unique_optimistic = True on the model to skip the conflict queries in validate_unique(). Instead, save()
+    runs in a savepoint, and an IntegrityError from a unique PartialIndex is raised as PartialUniqueValidationError.
+    This saves a query per index on every save, but the error is raised by save(), not by ModelForm or Serializer validation.
+
+    Set partial_unique_track_changes = True on the model to remember the values of the fields mentioned by unique
+    PartialIndexes as they were loaded from the database. Indexes whose fields have not changed since are not validated again,
+    as the database has already enforced them for the stored row.
+
+    On Python 3.5 and later, avalidate_unique() and avalidate_partial_unique() are async versions of the validation methods.
     """
+    partial_unique_optimistic = False
+    partial_unique_track_changes = False
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ValidatePartialUniqueMixin, cls).from_db(db, field_names, values)
+        if cls.partial_unique_track_changes:
+            instance._partial_unique_remember_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(ValidatePartialUniqueMixin, self).refresh_from_db(using=using, fields=fields)
+        if self.partial_unique_track_changes:
+            self._partial_unique_remember_values(fields)
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        save = super(ValidatePartialUniqueMixin, self).save
+        if self.partial_unique_optimistic:
+            using = using or router.db_for_write(self.__class__, instance=self)
+            try:
+                with transaction.atomic(using=using):
+                    save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+            except IntegrityError as e:
+                for info in partial_unique_index_infos(self.__class__):
+                    if info.matches_integrity_error(e):
+                        raise PartialUniqueValidationError(info.error_message)
+                raise
+        else:
+            save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        if self.partial_unique_track_changes:
+            self._partial_unique_remember_values(update_fields)
+
+    def _partial_unique_remember_values(self, fields=None):
+        """Remembers the current values of tracked fields, which are known to be the same as in the database.
+
+        If fields is given, only remembers values for fields with these names or attnames.
+        """
+        loaded_values = self.__dict__.setdefault('_partial_unique_loaded_values', {})
+        for info in partial_unique_index_infos(self.__class__):
+            for field in info.tracked_fields:
+                # Deferred fields are missing from __dict__. They have not been loaded, so can not have been changed either.
+                if field.attname in self.__dict__ and (fields is None or field.name in fields or field.attname in fields):
+                    loaded_values[field.attname] = self.__dict__[field.attname]
+
+    def _partial_unique_unchanged(self, info):
+        """Returns True if the fields mentioned by the index are known to have the same values as in the database."""
+        loaded_values = self.__dict__.get('_partial_unique_loaded_values')
+        if not loaded_values or self._state.adding or self.pk is None:
+            return False
+        for attname in info.tracked_attnames:
+            if attname in self.__dict__ and (attname not in loaded_values or loaded_values[attname] != self.__dict__[attname]):
+                return False
+        return True
 
     def validate_unique(self, exclude=None):
         # Standard unique validation first.
         super(ValidatePartialUniqueMixin, self).validate_unique(exclude=exclude)
-        self.validate_partial_unique()
+        # Formsets and list serializers validate all their instances at once with validate_partial_unique_bulk().
+        if not self.partial_unique_optimistic and not getattr(self, '_partial_unique_deferred', False):
+            self.validate_partial_unique()
 
     def validate_partial_unique(self):
         """Check partial unique constraints on the model and raise ValidationError if any failed.
@@ -45,45 +305,154 @@ class ValidatePartialUniqueMixin(object):
         But can't just check for the fields in idx.fields - idx.where may refer to other fields on the current (or other) models.
         Also can't check for all fields on the current model - should not include irrelevant fields which may hide duplicates.
 
-        To find potential conflicts, we need to build a queryset which:
+        To find potential conflicts, we need to build a query which:
         1. Filters by idx.fields with their current values on this instance,
         2. Filters on idx.where
         3. Filters by fields mentioned in idx.where, with their current values on this instance,
         4. Excludes current object if it does not match the where condition.
 
         Note that step 2 ensures the lookup only looks for conflicts among rows covered by the PartialIndes,
-        and steps 2+3 ensures that the QuerySet is empty if the PartialIndex does not cover the current object.
+        and steps 2+3 ensures that the query is empty if the PartialIndex does not cover the current object.
+
+        The query is a precompiled SQL statement, see PartialUniqueIndexInfo.conflict_sql().
+        partial_unique_conflict_queryset() builds the equivalent QuerySet.
+        If the model has several unique PartialIndexes, they are all checked with a single query.
+
+        If idx.where can be evaluated in Python and does not cover the current object, the query is skipped entirely.
+        It is also skipped if partial_unique_track_changes is enabled, and none of the mentioned fields have changed.
+        """
+        infos = [
+            info for info in partial_unique_index_infos(self.__class__)
+            if not self._partial_unique_unchanged(info) and query.q_matches_instance(info.where, self) is not False
+        ]
+        if infos:
+            for info, conflict in zip(infos, self.partial_unique_conflicts(infos)):
+                if conflict:
+                    raise PartialUniqueValidationError(info.error_message)
+
+    def partial_unique_conflict_exists(self, info):
+        """Runs the precompiled conflict query for one unique PartialIndex. Returns True if a conflicting row exists."""
+        return self.partial_unique_conflicts([info])[0]
+
+    def partial_unique_conflicts(self, infos):
+        """Checks for conflicts in several unique PartialIndexes with a single query.
+
+        Returns a list of booleans, True where a conflicting row exists for the corresponding PartialUniqueIndexInfo.
         """
-        # Find PartialIndexes with unique=True defined on model.
-        unique_idxs = [idx for idx in self._meta.indexes if isinstance(idx, PartialIndex) and idx.unique]
-
-        if unique_idxs:
-            model_fields = set(f.name for f in self._meta.get_fields(include_parents=True, include_hidden=True))
-
-            for idx in unique_idxs:
-                where = idx.where
-                if not isinstance(where, Q):
-                    raise ImproperlyConfigured(
-                        'ValidatePartialUniqueMixin is not supported for PartialIndexes with a text-based where condition. ' +
-                        'Please upgrade to Q-object based where conditions.'
-                    )
-
-                mentioned_fields = set(idx.fields) | set(query.q_mentioned_fields(where, self.__class__))
-
-                missing_fields = mentioned_fields - model_fields
-                if missing_fields:
-                    raise RuntimeError('Unable to use ValidatePartialUniqueMixin: expecting to find fields %s on model. ' +
-                                       'This is a bug in the PartialIndex definition or the django-partial-index library itself.')
-
-                values = {field_name: getattr(self, field_name) for field_name in mentioned_fields}
-
-                conflict = self.__class__.objects.filter(**values)  # Step 1 and 3
-                conflict = conflict.filter(where)  # Step 2
-                if self.pk:
-                    conflict = conflict.exclude(pk=self.pk)  # Step 4
-
-                if conflict.exists():
-                    raise PartialUniqueValidationError('%s with the same values for %s already exists.' % (
-                        self.__class__.__name__,
-                        ', '.join(sorted(idx.fields)),
-                    ))
+        connection = connections[router.db_for_read(self.__class__, instance=self)]
+        queries = [self._partial_unique_conflict_sql_params(info, connection) for info in infos]
+
+        if len(queries) == 1:
+            sql, params = queries[0]
+        else:
+            # SELECT EXISTS (<index 1 query>), EXISTS (<index 2 query>), ...
+            sql = 'SELECT %s' % ', '.join('EXISTS (%s)' % query_sql for query_sql, query_params in queries)
+            params = [param for query_sql, query_params in queries for param in query_params]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if len(queries) == 1:
+            return [row is not None]
+        return [bool(exists) for exists in row]
+
+    def _partial_unique_conflict_sql_params(self, info, connection):
+        values = [(field, getattr(self, field.attname)) for field in info.fields]
+        null_attnames = tuple(field.attname for field, value in values if value is None)
+        exclude_pk = bool(self.pk)
+        sql, sql_params = info.conflict_sql(self.__class__, connection, null_attnames, exclude_pk)
+
+        params = [field.get_db_prep_value(value, connection) for field, value in values if value is not None]  # Step 1 and 3
+        # Expression keys and step 2
+        params.extend(param.value(self, connection) if isinstance(param, KeyParam) else param for param in sql_params)
+        if exclude_pk:
+            params.append(self._meta.pk.get_db_prep_value(self.pk, connection))  # Step 4
+        return sql, params
+
+    def partial_unique_conflict_queryset(self, info):
+        """Returns a QuerySet of rows that conflict with this instance in one unique PartialIndex."""
+        values = {attname: getattr(self, attname) for attname in info.attnames}
+
+        conflict = self.__class__._base_manager.filter(**values)  # Step 1 and 3
+        for position, expression in enumerate(info.expressions):
+            alias = '_partial_unique_key_%d' % position
+            conflict = conflict.annotate(**{alias: expression}).filter(**{alias: instance_expression(expression, self)})
+        conflict = conflict.filter(info.where)  # Step 2
+        if self.pk:
+            conflict = conflict.exclude(pk=self.pk)  # Step 4
+        return conflict
+
+    @classmethod
+    def validate_partial_unique_bulk(cls, instances):
+        """Check partial unique constraints for many instances at once and raise ValidationError if any failed.
+
+        Gives the same results as calling validate_partial_unique() on each instance, but runs a single query per
+        unique PartialIndex (split into chunks for very large batches), instead of one query per instance.
+
+        Additionally, instances that would conflict with each other are detected before querying the database.
+        The first instance of each such group is considered valid, the rest are reported as duplicates. This is only done
+        for instances that idx.where can be evaluated for in Python. Others are only checked against the database.
+
+        Indexes with expression keys are checked with one query per instance, as the expressions can only be evaluated
+        in the database. Instances that conflict with each other only through such an index are not detected.
+
+        The raised PartialUniqueValidationError has an error_dict, keyed by the position of each invalid instance in instances.
+        """
+        instances = list(instances)
+        using = router.db_for_read(cls)
+        connection = connections[using]
+        errors = {}
+
+        for info in partial_unique_index_infos(cls):
+            if info.expressions:
+                for position, instance in enumerate(instances):
+                    if instance._partial_unique_unchanged(info) or query.q_matches_instance(info.where, instance) is False:
+                        continue
+                    if instance.partial_unique_conflict_exists(info):
+                        errors.setdefault(position, []).append(info.error_message)
+                continue
+
+            fields, attnames = info.fields, info.attnames
+
+            # Group instances by the values of all mentioned fields. Instances in the same group conflict with each other,
+            # if the group is covered by the index. Instances that are known to not be covered can never conflict.
+            groups = OrderedDict()
+            covered_groups = OrderedDict()
+            for position, instance in enumerate(instances):
+                if instance._partial_unique_unchanged(info):
+                    continue
+                covered = query.q_matches_instance(info.where, instance)
+                if covered is False:
+                    continue
+                key = tuple(field.to_python(getattr(instance, field.attname)) for field in fields)
+                groups.setdefault(key, []).append(position)
+                # Where coverage is unknown, the instances may not conflict, and only the database is asked.
+                if covered:
+                    covered_groups.setdefault(key, []).append(position)
+
+            for positions in covered_groups.values():
+                first = instances[positions[0]]
+                for position in positions[1:]:
+                    if instances[position].pk is None or instances[position].pk != first.pk:
+                        errors.setdefault(position, []).append(info.duplicate_error_message)
+
+            keys = list(groups)
+            batch_size = connection.ops.bulk_batch_size(attnames, keys)
+            max_query_params = connection.features.max_query_params
+            if max_query_params is not None:
+                # The parameters of the where condition are in every chunk as well.
+                where_params = query.q_to_sql_params(info.where, cls, connection)[1]
+                batch_size = min(batch_size, (max_query_params - len(where_params)) // len(attnames))
+            batch_size = max(batch_size, 1)
+            for start in range(0, len(keys), batch_size):
+                chunk = keys[start:start + batch_size]
+                conflicts = cls._base_manager.using(using).filter(info.where)
+                conflicts = conflicts.filter(reduce(operator.or_, [Q(**dict(zip(attnames, key))) for key in chunk]))
+                for row in conflicts.values_list('pk', *attnames):
+                    key = tuple(field.to_python(value) for field, value in zip(fields, row[1:]))
+                    for position in groups.get(key, []):
+                        if instances[position].pk != row[0]:
+                            errors.setdefault(position, []).append(info.error_message)
+
+        if errors:
+            raise PartialUniqueValidationError(OrderedDict(sorted(errors.items())))
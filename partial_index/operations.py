@@ -0,0 +1,395 @@
+"""Migration operations for building and dropping partial indexes on large tables.
+
+On PostgreSQL, the indexes are built and dropped CONCURRENTLY, so that writes to the table are not blocked while
+the index is being built. Concurrent index operations cannot run in a transaction, so migrations using these
+operations must set atomic = False. SQLite has no such option, and plain CREATE INDEX / DROP INDEX are used there.
+"""
+import re
+
+import django
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction, NotSupportedError
+from django.db.migrations.operations import AddIndex, RemoveIndex
+from django.db.migrations.operations.base import Operation
+from django.db.migrations.operations.models import IndexOperation
+from django.db.models import F, Index, Q
+
+from . import duplicates, query
+from .index import PartialIndex
+
+
+SQL_DROP_INDEX_CONCURRENTLY = 'DROP INDEX CONCURRENTLY IF EXISTS %(name)s'
+SQL_DROP_INDEX = 'DROP INDEX IF EXISTS %(name)s'
+SQL_RENAME_INDEX = 'ALTER INDEX %(old_name)s RENAME TO %(new_name)s'
+
+# Suffix of the name under which a replacement index is built. PostgreSQL truncates names to 63 characters.
+TEMPORARY_INDEX_SUFFIX = '_new'
+MAX_NAME_LENGTH = 63
+
+# Returns a row for an existing index, with a flag that is false if building it failed.
+SQL_INDEX_IS_VALID = (
+    'SELECT i.indisvalid FROM pg_catalog.pg_index i JOIN pg_catalog.pg_class c ON c.oid = i.indexrelid '
+    'WHERE c.relname = %s AND pg_catalog.pg_table_is_visible(c.oid)'
+)
+
+
+def check_concurrently(schema_editor, operation):
+    """Returns True if indexes should be built concurrently, which is only possible on PostgreSQL.
+
+    Raises NotSupportedError if the migration is running in a transaction.
+    """
+    if query.get_valid_vendor(schema_editor) != query.Vendor.POSTGRESQL:
+        return False
+    if schema_editor.connection.in_atomic_block:
+        raise NotSupportedError(
+            'The %s operation cannot be executed inside a transaction (set atomic = False on the migration).' %
+            operation.__class__.__name__)
+    return True
+
+
+def index_is_valid(schema_editor, name):
+    """Returns True or False for an existing PostgreSQL index, and None if there is no index with this name.
+
+    A failed CREATE INDEX CONCURRENTLY leaves behind an INVALID index, which is not used by queries but is still
+    updated on every write, and which blocks creating an index with the same name.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(SQL_INDEX_IS_VALID, [name])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def add_index_concurrently(schema_editor, model, index, operation):
+    if not check_concurrently(schema_editor, operation):
+        schema_editor.add_index(model, index)
+        return
+    if not isinstance(index, PartialIndex):
+        raise ValueError('Only PartialIndex can be created concurrently, got %r.' % index)
+    if index_is_valid(schema_editor, index.name) is False:
+        # Left behind by a failed previous attempt.
+        drop_index_concurrently(schema_editor, index.name)
+    schema_editor.execute(index.create_sql(model, schema_editor, concurrently=True), params=None)
+
+
+def remove_index_concurrently(schema_editor, model, index, operation):
+    if not check_concurrently(schema_editor, operation):
+        schema_editor.remove_index(model, index)
+        return
+    drop_index_concurrently(schema_editor, index.name)
+
+
+def drop_index_concurrently(schema_editor, name):
+    schema_editor.execute(SQL_DROP_INDEX_CONCURRENTLY % {'name': schema_editor.quote_name(name)})
+
+
+# Single-quoted string literals, which are left alone when comparing index definitions.
+SQL_STRING_LITERAL_RE = re.compile(r"('(?:[^']|'')*')")
+SQL_QUOTED_IDENTIFIER_RE = re.compile(r'"([a-z_][a-z0-9_]*)"')
+# Placeholder name for rendering indexes, so that their definitions can be compared.
+COMPARE_INDEX_NAME = 'partial_index_compare'
+
+
+def normalized_index_sql(schema_editor, model, index):
+    """Returns the CREATE INDEX statement for an index, without its name, and normalized for comparison.
+
+    Outside of string literals, whitespace is collapsed, and table names and quotes are removed from column names.
+    Quoted names are surrounded by spaces, as Django 2.2 leaves out the space in '"field"DESC'.
+    So a text-based where='deleted_at IS NULL' and the equivalent where=PQ(deleted_at__isnull=True) give the same result.
+    PQ where-conditions are normalized first, so the order of their terms does not matter either.
+    """
+    index = index.clone()
+    index.name = COMPARE_INDEX_NAME
+    if isinstance(getattr(index, 'where', None), query.PQ):
+        index.where = query.normalize_q(index.where)
+    sql = str(index.create_sql(model, schema_editor))
+    table_prefix = schema_editor.quote_name(model._meta.db_table) + '.'
+    parts = SQL_STRING_LITERAL_RE.split(sql)
+    for i in range(0, len(parts), 2):
+        part = SQL_QUOTED_IDENTIFIER_RE.sub(r' \1 ', parts[i].replace(table_prefix, ''))
+        parts[i] = ' '.join(part.split())
+    return ' '.join(part for part in parts if part).rstrip(';')
+
+
+def rename_index(schema_editor, model, old_index, new_index):
+    """Renames an index. SQLite cannot rename indexes, so the index is recreated there."""
+    if query.get_valid_vendor(schema_editor) != query.Vendor.POSTGRESQL:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.remove_index(model, old_index)
+            schema_editor.add_index(model, new_index)
+        return
+    schema_editor.execute(SQL_RENAME_INDEX % {
+        'old_name': schema_editor.quote_name(old_index.name),
+        'new_name': schema_editor.quote_name(new_index.name),
+    })
+
+
+def replace_index_concurrently(schema_editor, old_model, old_index, new_model, new_index, operation):
+    """Replaces old_index with new_index, so that the table always has one of them.
+
+    If the indexes only differ by name, the old index is renamed. Otherwise on PostgreSQL, new_index is first built
+    concurrently under a temporary name. Then the old index is dropped and the new one renamed, in one transaction
+    which only holds the table lock for a moment.
+    On SQLite, the old index is dropped and the new one created in the same transaction.
+    """
+    if normalized_index_sql(schema_editor, old_model, old_index) == normalized_index_sql(schema_editor, new_model, new_index):
+        if old_index.name != new_index.name:
+            rename_index(schema_editor, new_model, old_index, new_index)
+        return
+
+    if not check_concurrently(schema_editor, operation):
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.remove_index(old_model, old_index)
+            schema_editor.add_index(new_model, new_index)
+        return
+
+    temporary_index = new_index.clone()
+    temporary_index.name = new_index.name[:MAX_NAME_LENGTH - len(TEMPORARY_INDEX_SUFFIX)] + TEMPORARY_INDEX_SUFFIX
+    if not index_is_valid(schema_editor, temporary_index.name):
+        # An earlier attempt may have succeeded in building the temporary index before failing.
+        add_index_concurrently(schema_editor, new_model, temporary_index, operation)
+    quote_name = schema_editor.quote_name
+    with transaction.atomic(using=schema_editor.connection.alias):
+        schema_editor.execute(SQL_DROP_INDEX % {'name': quote_name(old_index.name)})
+        schema_editor.execute(SQL_RENAME_INDEX % {'old_name': quote_name(temporary_index.name), 'new_name': quote_name(new_index.name)})
+
+
+class AddPartialIndexConcurrently(AddIndex):
+    """Creates a PartialIndex with CREATE INDEX CONCURRENTLY on PostgreSQL. Same as AddIndex on SQLite."""
+
+    def __init__(self, model_name, index):
+        if not isinstance(index, PartialIndex):
+            raise ValueError('%s only supports PartialIndex, got %r.' % (self.__class__.__name__, index))
+        super(AddPartialIndexConcurrently, self).__init__(model_name, index)
+
+    def describe(self):
+        return 'Concurrently create index %s on field(s) %s of model %s' % (
+            self.index.name, ', '.join(self.index.field_labels()), self.model_name)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            add_index_concurrently(schema_editor, model, self.index, self)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            remove_index_concurrently(schema_editor, model, self.index, self)
+
+
+class RemovePartialIndexConcurrently(RemoveIndex):
+    """Drops a PartialIndex with DROP INDEX CONCURRENTLY on PostgreSQL. Same as RemoveIndex on SQLite."""
+
+    def describe(self):
+        return 'Concurrently remove index %s from %s' % (self.name, self.model_name)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            index = from_state.models[app_label, self.model_name_lower].get_index_by_name(self.name)
+            remove_index_concurrently(schema_editor, model, index, self)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            index = to_state.models[app_label, self.model_name_lower].get_index_by_name(self.name)
+            add_index_concurrently(schema_editor, model, index, self)
+
+
+class ReplacePartialIndexConcurrently(IndexOperation):
+    """Replaces the index old_name with a new PartialIndex, without a period where the table has neither.
+
+    Use instead of RemoveIndex and AddIndex when the fields or the where-condition of an index change.
+    """
+
+    def __init__(self, model_name, old_name, index):
+        if not isinstance(index, PartialIndex):
+            raise ValueError('%s only supports PartialIndex, got %r.' % (self.__class__.__name__, index))
+        if not index.name:
+            raise ValueError('Indexes passed to %s operations require a name argument.' % self.__class__.__name__)
+        self.model_name = model_name
+        self.old_name = old_name
+        self.index = index
+
+    def state_forwards(self, app_label, state):
+        model_state = state.models[app_label, self.model_name_lower]
+        indexes = [idx for idx in model_state.options[self.option_name] if idx.name != self.old_name]
+        model_state.options[self.option_name] = indexes + [self.index.clone()]
+        state.reload_model(app_label, self.model_name_lower, delay=True)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            old_model = from_state.apps.get_model(app_label, self.model_name)
+            old_index = from_state.models[app_label, self.model_name_lower].get_index_by_name(self.old_name)
+            replace_index_concurrently(schema_editor, old_model, old_index, model, self.index, self)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            new_model = from_state.apps.get_model(app_label, self.model_name)
+            old_index = to_state.models[app_label, self.model_name_lower].get_index_by_name(self.old_name)
+            replace_index_concurrently(schema_editor, new_model, self.index, model, old_index, self)
+
+    def deconstruct(self):
+        kwargs = {
+            'model_name': self.model_name,
+            'old_name': self.old_name,
+            'index': self.index,
+        }
+        return self.__class__.__name__, [], kwargs
+
+    def describe(self):
+        return 'Concurrently replace index %s with %s on model %s' % (self.old_name, self.index.name, self.model_name)
+
+
+class CheckPartialIndexDuplicates(Operation):
+    """Fails the migration early if a unique PartialIndex cannot be created because of existing duplicates.
+
+    Put it before the AddIndex, AddPartialIndexConcurrently or ReplacePartialIndexConcurrently operation that creates
+    the index. The duplicate keys are found in a single query without building the index, and are listed in the IntegrityError.
+    The operation does not change the migration state, and does nothing when unapplied.
+    """
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, index, chunk_size=1000):
+        if not isinstance(index, PartialIndex) or not index.unique:
+            raise ValueError('%s only supports unique PartialIndex, got %r.' % (self.__class__.__name__, index))
+        self.model_name = model_name
+        self.index = index
+        self.chunk_size = chunk_size
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            duplicates.check_duplicates(model, self.index, using=schema_editor.connection.alias, chunk_size=self.chunk_size)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        pass
+
+    def deconstruct(self):
+        kwargs = {
+            'model_name': self.model_name,
+            'index': self.index,
+        }
+        if self.chunk_size != 1000:
+            kwargs['chunk_size'] = self.chunk_size
+        return self.__class__.__name__, [], kwargs
+
+    def describe(self):
+        return 'Check for duplicates of unique index %s on model %s' % (self.index.name, self.model_name)
+
+
+def native_q(q):
+    """Converts a PQ object to a Q object, and PF() values in it to F()."""
+    native = Q()
+    native.connector = q.connector
+    native.negated = q.negated
+    native.children = [
+        native_q(child) if isinstance(child, Q) else (child[0], F(child[1].name) if isinstance(child[1], query.PF) else child[1])
+        for child in q.children
+    ]
+    return native
+
+
+def native_index(index, condition=None, name=None):
+    """Returns a Django 2.2 Index or UniqueConstraint with a condition, which creates the same database index as the PartialIndex.
+
+    condition is required for text-based where-conditions. Index names are limited to 30 characters, so a longer
+    generated PartialIndex name gets the usual "idx" suffix instead of "partial", unless another name is given.
+    """
+    if django.VERSION < (2, 2):
+        raise ImproperlyConfigured('Index and UniqueConstraint conditions require Django 2.2 or later.')
+    if condition is None:
+        if not isinstance(index.where, query.PQ):
+            raise ValueError('Index %s has a text-based where-condition, please provide an equivalent Q object as condition.' % index.name)
+        condition = native_q(index.where)
+    if index.include:
+        raise ValueError('Index %s has include columns, which Django 2.2 indexes do not support.' % index.name)
+    if index.key_expressions():
+        raise ValueError('Index %s has expression keys, which Django 2.2 indexes do not support.' % index.name)
+    if index.storage_params:
+        raise ValueError('Index %s has storage parameters, which Django 2.2 indexes do not support.' % index.name)
+    if index.index_type not in (None, 'btree'):
+        raise ValueError('Index %s has index type %s, which Django 2.2 indexes do not support.' % (index.name, index.index_type))
+    name = name or index.name
+
+    if not index.unique:
+        if len(name) > Index.max_name_length:
+            if not name.endswith('_' + PartialIndex.suffix):
+                raise ValueError('Index name %s is longer than %d characters, please provide a new name.' % (name, Index.max_name_length))
+            name = name[:-len(PartialIndex.suffix)] + Index.suffix
+        return Index(fields=index.fields, name=name, condition=condition, opclasses=index.opclasses, db_tablespace=index.db_tablespace)
+
+    from django.db.models import UniqueConstraint
+    if any(order for field_name, order in index.key_orders):
+        raise ValueError('Index %s is unique and has descending fields, which UniqueConstraint does not support.' % index.name)
+    if index.opclasses:
+        raise ValueError('Index %s is unique and has operator classes, which UniqueConstraint does not support.' % index.name)
+    if index.db_tablespace is not None:
+        raise ValueError('Index %s is unique and has a tablespace, which UniqueConstraint does not support.' % index.name)
+    return UniqueConstraint(fields=index.fields, name=name, condition=condition)
+
+
+class ConvertToNativeIndex(IndexOperation):
+    """Replaces a PartialIndex in the migration state with an equivalent Index or UniqueConstraint with a condition.
+
+    The database index is kept. It is only renamed if the native index needs a different name. When the migration is
+    applied, the operation checks that the native index would have the same definition.
+    """
+    reduces_to_sql = False
+
+    def __init__(self, model_name, name, condition=None, new_name=None):
+        if django.VERSION < (2, 2):
+            raise ImproperlyConfigured('%s requires Django 2.2 or later.' % self.__class__.__name__)
+        self.model_name = model_name
+        self.name = name
+        self.condition = condition
+        self.new_name = new_name
+
+    def get_native_index(self, model_state):
+        return native_index(model_state.get_index_by_name(self.name), self.condition, self.new_name)
+
+    def state_forwards(self, app_label, state):
+        model_state = state.models[app_label, self.model_name_lower]
+        native = self.get_native_index(model_state)
+        model_state.options['indexes'] = [idx for idx in model_state.options['indexes'] if idx.name != self.name]
+        option_name = 'indexes' if isinstance(native, Index) else 'constraints'
+        model_state.options[option_name] = model_state.options[option_name] + [native]
+        state.reload_model(app_label, self.model_name_lower, delay=True)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            index = from_state.models[app_label, self.model_name_lower].get_index_by_name(self.name)
+            native = self.get_native_index(from_state.models[app_label, self.model_name_lower])
+            native_model = to_state.apps.get_model(app_label, self.model_name)
+            if normalized_index_sql(schema_editor, model, index) != normalized_index_sql(schema_editor, native_model, native):
+                raise ValueError('%r does not create the same database index as %r.' % (native, index))
+            if native.name != index.name:
+                rename_index(schema_editor, native_model, index, native)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            native = self.get_native_index(to_state.models[app_label, self.model_name_lower])
+            index = to_state.models[app_label, self.model_name_lower].get_index_by_name(self.name)
+            if native.name != index.name:
+                rename_index(schema_editor, model, native, index)
+
+    def deconstruct(self):
+        kwargs = {
+            'model_name': self.model_name,
+            'name': self.name,
+        }
+        if self.condition is not None:
+            kwargs['condition'] = self.condition
+        if self.new_name is not None:
+            kwargs['new_name'] = self.new_name
+        return self.__class__.__name__, [], kwargs
+
+    def describe(self):
+        return 'Convert index %s on model %s to a native Django index' % (self.name, self.model_name)
@@ -1,6 +1,15 @@
 """Django Q object to SQL string conversion."""
-from django.db.models import expressions, Q, F
+from collections import OrderedDict
+import datetime
+import operator
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import expressions, Model, Q, F
+from django.db.models.constants import LOOKUP_SEP
 from django.db.models.sql import Query
+from django.utils import six, timezone
+
+from . import compiler as pq_compiler
 
 
 class Vendor(object):
@@ -14,12 +23,43 @@ class PQ(Q):
     Django 2.0 Q-objects are suitable on their own, but Django 1.11 needs a better deep equality comparison and a deconstruct() method.
 
     PartialIndex definitions in model classes should use PQ to avoid problems when upgrading projects.
+
+    PQ objects are hashable. The structural hash is cached, as the migration autodetector compares the where-conditions
+    of every index in the project, and is reset when the node is changed through add(), negate() or attribute assignment.
     """
+    _structural_hash = None
+
+    def __setattr__(self, name, value):
+        if name in ('children', 'connector', 'negated'):
+            self.__dict__['_structural_hash'] = None
+        super(PQ, self).__setattr__(name, value)
+
+    def add(self, *args, **kwargs):
+        self._structural_hash = None
+        return super(PQ, self).add(*args, **kwargs)
+
+    def negate(self):
+        self._structural_hash = None
+        super(PQ, self).negate()
+
+    def __hash__(self):
+        if self._structural_hash is None:
+            try:
+                key = hashable_q(self, typed=False)
+            except TypeError:
+                # Some value is not hashable, fall back to the shape of the tree.
+                key = q_structure(self)
+            self._structural_hash = hash(key)
+        return self._structural_hash
 
     def __eq__(self, other):
-        """Copied from Django 2.0 django.utils.tree.Node.__eq__()"""
+        """Copied from Django 2.0 django.utils.tree.Node.__eq__(), with a shortcut for different hashes."""
         if self.__class__ != other.__class__:
             return False
+        if self is other:
+            return True
+        if hash(self) != hash(other):
+            return False
         if (self.connector, self.negated) == (other.connector, other.negated):
             return self.children == other.children
         return False
@@ -57,6 +97,9 @@ class PF(F):
             return False
         return self.name == other.name
 
+    def __hash__(self):
+        return hash((self.__class__.__name__, self.name))
+
     def deconstruct(self):
         path = '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
         # Keep imports clean in migrations
@@ -68,7 +111,6 @@ class PF(F):
         return path, args, kwargs
 
 
-
 def get_valid_vendor(schema_editor):
     vendor = schema_editor.connection.vendor
     if vendor not in [Vendor.POSTGRESQL, Vendor.SQLITE]:
@@ -76,18 +118,186 @@ def get_valid_vendor(schema_editor):
     return vendor
 
 
+# Maximum number of (model, Q object, vendor) combinations remembered by q_to_sql().
+Q_TO_SQL_CACHE_SIZE = 512
+_q_to_sql_cache = OrderedDict()
+
+
 def q_to_sql(q, model, schema_editor):
+    """Returns the SQL for a Q object, with parameters quoted inline.
+
+    Results are cached, as the same predicates are compiled repeatedly when migrations recreate indexes.
+    """
+    try:
+        key = q_to_sql_cache_key(q, model, schema_editor.connection)
+    except TypeError:
+        # Some value in the Q object is not hashable.
+        return _q_to_sql(q, model, schema_editor)
+
+    try:
+        where_sql = _q_to_sql_cache.pop(key)
+    except KeyError:
+        where_sql = _q_to_sql(q, model, schema_editor)
+        while len(_q_to_sql_cache) >= Q_TO_SQL_CACHE_SIZE:
+            _q_to_sql_cache.popitem(last=False)
+    # Most recently used entries are last.
+    _q_to_sql_cache[key] = where_sql
+    return where_sql
+
+
+def _q_to_sql(q, model, schema_editor):
+    sql, params = q_to_sql_params(q, model, schema_editor.connection)
+    params = tuple(map(schema_editor.quote_value, params))
+    return sql % params
+
+
+def q_to_sql_cache_key(q, model, connection):
+    """Returns a hashable key which includes everything that q_to_sql() output depends on.
+
+    Historical models in migrations are different classes with the same label, so the table and columns are included as well.
+    """
+    columns = tuple((field.name, field.column, field.get_internal_type()) for field in model._meta.local_concrete_fields)
+    return model._meta.label_lower, model._meta.db_table, columns, hashable_q(q), connection.vendor
+
+
+def clear_q_to_sql_cache():
+    _q_to_sql_cache.clear()
+
+
+def hashable_q(value, typed=True):
+    """Converts a Q object to nested tuples, which can be used as a dictionary key.
+
+    Equal Q objects give equal results. Values are tagged with their type, as PQ(a=1) and PQ(a=True) produce different SQL.
+    With typed=False they are not, so that the result can be hashed by PQ objects, which compare equal in that case.
+    """
+    if isinstance(value, Q):
+        return (value.__class__.__name__, value.connector, value.negated,
+                tuple(hashable_q(child, typed) for child in value.children))
+    elif isinstance(value, F):
+        return (value.__class__.__name__, value.name)
+    elif isinstance(value, (list, tuple)):
+        return (value.__class__.__name__, tuple(hashable_q(item, typed) for item in value))
+    elif hasattr(value, 'deconstruct'):
+        path, args, kwargs = value.deconstruct()
+        return (path, hashable_q(args, typed), hashable_q(sorted(kwargs.items()), typed))
+    hash(value)  # Raises TypeError for unsupported values.
+    return (value.__class__.__name__, value) if typed else value
+
+
+def q_structure(q):
+    """Same as hashable_q(), but only includes the connectors and lookups of a Q object, not the values.
+
+    Q(a=1) | ~Q(b=[2, 3]) -> ('Q', 'OR', False, ('a', ('Q', 'AND', True, ('b', ))))
+    """
+    return (q.__class__.__name__, q.connector, q.negated,
+            tuple(q_structure(child) if isinstance(child, Q) else child[0] for child in q.children))
+
+
+def normalize_q(q):
+    """Returns an equivalent Q object in canonical form, so that equivalent predicates compare and hash equal.
+
+    Nested nodes with the same connector are flattened, children are sorted and deduplicated, double negations are
+    removed and "a__exact" is written as "a". Empty nodes are dropped, as they are when compiling Q objects to SQL.
+
+    PQ(b=2) & PQ(a=1) & PQ(a=1) -> PQ(a=1, b=2)
+    """
+    children = []
+    for child in q.children:
+        if isinstance(child, Q):
+            child = normalize_q(child)
+            if not child.children:
+                continue
+            if not child.negated and (child.connector == q.connector or len(child.children) == 1):
+                children.extend(child.children)
+                continue
+        elif child[0].endswith(LOOKUP_SEP + 'exact'):
+            child = (child[0][:-len(LOOKUP_SEP + 'exact')], child[1])
+        children.append(child)
+
+    unique_children = OrderedDict()
+    for child in children:
+        unique_children.setdefault(_normalize_sort_key(child), child)
+    children = [unique_children[key] for key in sorted(unique_children)]
+
+    negated = q.negated
+    if len(children) == 1 and isinstance(children[0], Q):
+        # PQ(PQ(...)) is PQ(...), ~PQ(PQ(...)) is ~PQ(...) and ~PQ(~PQ(...)) is PQ(...).
+        child = children[0]
+        if not q.negated:
+            return child
+        negated = not child.negated
+        q, children = child, child.children
+
+    normalized = q.__class__()
+    normalized.connector = q.connector if len(children) > 1 else Q.AND
+    normalized.negated = negated
+    normalized.children = children
+    return normalized
+
+
+def _normalize_sort_key(child):
+    # Lookups come before nested nodes, and are sorted by field name.
+    if isinstance(child, Q):
+        return 1, child.connector, child.negated, tuple(_normalize_sort_key(grandchild) for grandchild in child.children)
+    lookup, value = child
+    try:
+        return 0, lookup, repr(hashable_q(value))
+    except TypeError:
+        return 0, lookup, repr(value)
+
+
+def expression_to_sql(expression, model, schema_editor):
+    """Returns the SQL for an expression such as Lower('email'), with parameters quoted inline.
+
+    Columns are not qualified with the table name, as SQLite does not allow that in index expressions.
+    """
+    sql, params = expression_to_sql_params(expression, model, schema_editor.connection)
+    sql = sql.replace(schema_editor.quote_name(model._meta.db_table) + '.', '')
+    params = tuple(map(schema_editor.quote_value, params))
+    return sql % params
+
+
+def expression_to_sql_params(expression, model, connection):
+    """Returns the SQL for an expression with %s placeholders, and the parameters for them.
+
+    Like q_to_sql_params(), columns are qualified with the table name.
+    """
+    query = Query(model)
+    resolved = expression.resolve_expression(query, allow_joins=False)
+    compiler = connection.ops.compiler('SQLCompiler')(query, connection, connection.alias)
+    return compiler.compile(resolved)
+
+
+def expression_mentioned_field_names(expression, model):
+    """Returns the sorted names of the model fields referred to by an expression.
+
+    Lower('email') -> ['email']
+    """
+    resolved = expression.resolve_expression(Query(model), allow_joins=False)
+    return list(sorted(set(expression_mentioned_fields(resolved))))
+
+
+def q_to_sql_params(q, model, connection):
+    """Returns the SQL for a Q object with %s placeholders, and the parameters for them.
+
+    Plain field lookups are compiled directly, everything else goes through the Django ORM.
+    """
+    try:
+        sql, params, _ = pq_compiler.compile_q(q, model, connection)
+        return sql, params
+    except pq_compiler.Unsupported:
+        return orm_q_to_sql_params(q, model, connection)
+
+
+def orm_q_to_sql_params(q, model, connection):
+    """Same as q_to_sql_params(), but always uses the Django ORM."""
     # Q -> SQL conversion based on code from Ian Foote's Check Constraints pull request:
     # https://github.com/django/django/pull/7615/
 
     query = Query(model)
     where = query._add_q(q, used_aliases=set(), allow_joins=False)[0]
-    connection = schema_editor.connection
-    compiler = connection.ops.compiler('SQLCompiler')(query, connection, 'default')
-    sql, params = where.as_sql(compiler, connection)
-    params = tuple(map(schema_editor.quote_value, params))
-    where_sql = sql % params
-    return where_sql
+    compiler = connection.ops.compiler('SQLCompiler')(query, connection, connection.alias)
+    return where.as_sql(compiler, connection)
 
 
 def expression_mentioned_fields(exp):
@@ -109,6 +319,127 @@ def q_mentioned_fields(q, model):
 
     Q(a__isnull=True, b=F('c')) -> ['a', 'b', 'c']
     """
+    try:
+        return list(sorted(pq_compiler.resolve_q(q, model)[1]))
+    except pq_compiler.Unsupported:
+        pass
+
     query = Query(model)
     where = query._add_q(q, used_aliases=set(), allow_joins=False)[0]
     return list(sorted(set(expression_mentioned_fields(where))))
+
+
+def q_matches_instance(q, instance):
+    """Evaluates a Q object against the current field values of a model instance, without querying the database.
+
+    Returns True or False if the result could be decided in Python, or None if the Q object contains lookups
+    that are not supported here. Callers must then fall back to asking the database.
+
+    Supported are plain field lookups with exact, isnull, gt, gte, lt, lte and in, with constants or PF() references to
+    other fields on the same model. Joins, transforms and arithmetic expressions are never evaluated. Neither are
+    comparisons of naive and aware datetimes, which Django converts before querying, and gt, gte, lt and lte on text,
+    which the database orders by collation.
+    """
+    results = []
+    for child in q.children:
+        if isinstance(child, Q):
+            result = q_matches_instance(child, instance)
+        else:
+            result = _lookup_matches_instance(child[0], child[1], instance)
+        results.append(result)
+
+    if q.connector == Q.AND:
+        if False in results:
+            matches = False
+        elif None in results:
+            return None
+        else:
+            matches = True
+    else:
+        if True in results:
+            matches = True
+        elif None in results:
+            return None
+        else:
+            matches = False
+    return not matches if q.negated else matches
+
+
+# Lookups that can be evaluated in Python, as functions of (field value, lookup argument).
+# Both are already converted with field.to_python(), and neither is None.
+PYTHON_LOOKUPS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'in': lambda value, rhs: value in rhs,
+}
+
+
+def _lookup_matches_instance(lookup, rhs, instance):
+    parts = lookup.split(LOOKUP_SEP)
+    if len(parts) == 1:
+        field_name, lookup_name = parts[0], 'exact'
+    elif len(parts) == 2:
+        field_name, lookup_name = parts
+    else:
+        return None
+
+    field = _concrete_field_or_none(instance, field_name)
+    if field is None:
+        return None
+    value = getattr(instance, field.attname)
+
+    if lookup_name == 'isnull':
+        return (value is None) == bool(rhs)
+    if lookup_name not in PYTHON_LOOKUPS:
+        return None
+    if lookup_name == 'exact' and rhs is None:
+        return value is None
+
+    if isinstance(rhs, F):
+        rhs_field = _concrete_field_or_none(instance, rhs.name)
+        if rhs_field is None:
+            return None
+        rhs = getattr(instance, rhs_field.attname)
+        if rhs is None:
+            # Comparing to NULL is neither true nor false in SQL, and Django does not guard against it for the
+            # right hand side of negated lookups. Let the database decide.
+            return None
+    elif isinstance(rhs, expressions.Combinable):
+        return None
+
+    if value is None:
+        # A comparison with NULL never matches. Django adds an IS NOT NULL check when such lookups are negated,
+        # so this also holds under negation.
+        return False
+
+    try:
+        value = field.to_python(value)
+        if lookup_name == 'in':
+            rhs = [field.to_python(item.pk if isinstance(item, Model) else item) for item in rhs]
+        else:
+            rhs = field.to_python(rhs.pk if isinstance(rhs, Model) else rhs)
+        if lookup_name in ('gt', 'gte', 'lt', 'lte') and isinstance(value, six.string_types):
+            return None
+        if any(_naive_and_aware(value, item) for item in (rhs if lookup_name == 'in' else [rhs])):
+            return None
+        return PYTHON_LOOKUPS[lookup_name](value, rhs)
+    except (TypeError, ValidationError):
+        return None
+
+
+def _naive_and_aware(value, other):
+    """Returns True if one value is a naive and the other an aware datetime."""
+    if not isinstance(value, datetime.datetime) or not isinstance(other, datetime.datetime):
+        return False
+    return timezone.is_naive(value) != timezone.is_naive(other)
+
+
+def _concrete_field_or_none(instance, field_name):
+    try:
+        field = instance._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return None
+    return field if field.concrete else None
@@ -0,0 +1,62 @@
+"""Django Rest Framework support for ValidatePartialUniqueMixin. Requires djangorestframework to be installed."""
+import copy
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+from .mixins import PartialUniqueValidationError
+
+
+class PartialUniqueListSerializerMixin(object):
+    """Validates partial unique constraints of all items in a many=True ModelSerializer at once.
+
+    Add to a ListSerializer, and set it as list_serializer_class of a ModelSerializer for a model with ValidatePartialUniqueMixin:
+
+    class MyListSerializer(PartialUniqueListSerializerMixin, serializers.ListSerializer):
+        pass
+
+    class MySerializer(serializers.ModelSerializer):
+        class Meta:
+            model = MyModel
+            fields = ...
+            list_serializer_class = MyListSerializer
+
+    Runs a single query per unique PartialIndex for all items, and also detects items that conflict with each other.
+    Errors are added to the non-field errors of each invalid item.
+
+    When updating, the items are paired with the instances by position, and each item is validated as an update of its
+    instance. Nothing is validated if the model has partial_unique_optimistic = True.
+    """
+
+    def to_internal_value(self, data):
+        validated = super(PartialUniqueListSerializerMixin, self).to_internal_value(data)
+
+        model = self.child.Meta.model
+        if model.partial_unique_optimistic:
+            return validated
+        existing = list(self.instance) if self.instance is not None else []
+        instances = [
+            self._partial_unique_instance(model, attrs, existing[position] if position < len(existing) else None)
+            for position, attrs in enumerate(validated)
+        ]
+        try:
+            model.validate_partial_unique_bulk(instances)
+        except PartialUniqueValidationError as e:
+            errors = [{} for attrs in validated]
+            for position, position_errors in e.error_dict.items():
+                errors[position] = {api_settings.NON_FIELD_ERRORS_KEY: DjangoValidationError(position_errors).messages}
+            raise serializers.ValidationError(errors)
+        return validated
+
+    @staticmethod
+    def _partial_unique_instance(model, attrs, instance=None):
+        # A copy of the instance being updated keeps its pk, and the values of fields that are not in attrs.
+        field_names = set(field.name for field in model._meta.concrete_fields)
+        if instance is None:
+            return model(**{key: value for key, value in attrs.items() if key in field_names})
+        instance = copy.copy(instance)
+        for key, value in attrs.items():
+            if key in field_names:
+                setattr(instance, key, value)
+        return instance
@@ -5,7 +5,7 @@ from setuptools import setup
 
 setup(
     name='django-partial-index',
-    packages=['partial_index'],
+    packages=['partial_index', 'partial_index.management', 'partial_index.management.commands'],
     version='0.6.0',
     description='PostgreSQL and SQLite partial indexes for Django models',
     long_description=open('README.md').read(),
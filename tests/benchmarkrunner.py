@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for django-partial-index. These are not run as part of the test suite.
+
+Example: ./tests/benchmarkrunner.py --db sqlite validation
+"""
+from __future__ import print_function
+
+import argparse
+from os.path import abspath, dirname, join
+import sys
+import timeit
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+TESTS_DIR = join(REPO_DIR, 'tests')
+
+sys.path.append(REPO_DIR)
+sys.path.append(TESTS_DIR)
+
+
+DATABASES_FOR_DB = {
+    'postgresql': {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': 'partial_index',
+        }
+    },
+    'sqlite': {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': join(REPO_DIR, 'partial_index.sqlite3'),
+            # A file instead of the default in-memory test database, as the queue benchmark uses several threads.
+            'TEST': {'NAME': join(REPO_DIR, 'partial_index_benchmark.sqlite3')},
+        }
+    },
+}
+
+
+def report(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print('%-40s %10.1f us per call' % (name, seconds / number * 1e6))
+
+
+def benchmark_validation(args):
+    """Precompiled conflict SQL compared to building a QuerySet on every call."""
+    from partial_index.mixins import partial_unique_index_infos
+    from testapp.models import User, Room, RoomBookingQ
+
+    users = [User.objects.create(name='User%d' % i) for i in range(100)]
+    rooms = [Room.objects.create(name='Room%d' % i) for i in range(10)]
+    RoomBookingQ.objects.bulk_create([RoomBookingQ(user=user, room=room) for user in users for room in rooms])
+
+    info = partial_unique_index_infos(RoomBookingQ)[0]
+    for label, booking in [('new', RoomBookingQ(user=users[0], room=rooms[0])), ('existing', RoomBookingQ.objects.first())]:
+        report('%s, precompiled SQL' % label, lambda: booking.partial_unique_conflict_exists(info), args.number)
+        report('%s, QuerySet' % label, lambda: booking.partial_unique_conflict_queryset(info).exists(), args.number)
+
+
+def benchmark_compiler(args):
+    """Direct PQ compilation compared to going through Query._add_q() and SQLCompiler."""
+    from django.db import connection
+    from partial_index import PQ, PF
+    from partial_index.query import q_to_sql_params, orm_q_to_sql_params, q_mentioned_fields
+    from testapp.models import RoomBookingQ, JobQ, ComparisonQ
+
+    predicates = [
+        ('isnull', RoomBookingQ, PQ(deleted_at__isnull=True)),
+        ('and', JobQ, PQ(is_complete=False, order__gte=10)),
+        ('or, not', JobQ, ~(PQ(order__in=[1, 2, 3]) | PQ(group__lt=5))),
+        ('field reference', ComparisonQ, PQ(a=PF('b'))),
+    ]
+    for label, model, q in predicates:
+        report('%s, compiler' % label, lambda: q_to_sql_params(q, model, connection), args.number)
+        report('%s, ORM' % label, lambda: orm_q_to_sql_params(q, model, connection), args.number)
+    report('mentioned fields', lambda: q_mentioned_fields(predicates[1][2], JobQ), args.number)
+
+
+def benchmark_autodetector(args):
+    """Migration autodetector and index comparisons on a project with hundreds of models with partial indexes, and
+    makemigrations on the test app, as run by ./tests/makemigrationsrunner.py.
+    """
+    from django.core import management
+    from django.db import models
+    from django.db.migrations.autodetector import MigrationAutodetector
+    from django.db.migrations.graph import MigrationGraph
+    from django.db.migrations.state import ModelState, ProjectState
+    from partial_index import PartialIndex, PQ, PF
+
+    def make_state():
+        state = ProjectState()
+        for i in range(args.models):
+            indexes = [
+                PartialIndex(fields=['user_id', 'room_id'], unique=True, where=PQ(deleted_at__isnull=True), name='bench_%d_booking' % i),
+                PartialIndex(fields=['-order'], unique=False, where=PQ(is_complete=False, order__gte=i), name='bench_%d_order' % i),
+                PartialIndex(fields=['a', 'b'], unique=True, where=PQ(a=PF('b')) | ~PQ(group__in=[1, 2, 3]), name='bench_%d_ab' % i),
+            ]
+            fields = [('id', models.AutoField(primary_key=True))] + [
+                (name, models.IntegerField(null=True)) for name in ['user_id', 'room_id', 'order', 'group', 'a', 'b']
+            ] + [('deleted_at', models.DateTimeField(null=True)), ('is_complete', models.BooleanField(default=False))]
+            state.add_model(ModelState('bench', 'model%d' % i, fields, {'indexes': indexes}))
+        return state
+
+    from_state, to_state = make_state(), make_state()
+    old_indexes = [idx for model_state in from_state.models.values() for idx in model_state.options['indexes']]
+    new_indexes = [idx for model_state in to_state.models.values() for idx in model_state.options['indexes']]
+    number = max(1, args.number // 100)
+    report('%d indexes, membership' % len(new_indexes), lambda: [idx for idx in new_indexes[:100] if idx not in old_indexes], number)
+    report('%d models, autodetector' % args.models, lambda: MigrationAutodetector(from_state, to_state).changes(MigrationGraph()), number)
+    report('makemigrations testapp', lambda: management.call_command('makemigrations', 'testapp', dry_run=True, verbosity=0), number)
+
+
+def benchmark_queue(args):
+    """Throughput of claim_next() with several worker threads, compared to claiming rows one by one in a transaction."""
+    import threading
+    import time
+    from django.db import connection, transaction
+    from testapp.models import JobQ
+
+    index = JobQ._meta.indexes[0]
+    jobs = args.number * 10
+
+    def claim_next():
+        return JobQ.objects.claim_next(index, {'is_complete': True}, batch_size=10)
+
+    def claim_naive():
+        # Hand-rolled dequeue: the first open job, marked complete in a transaction.
+        with transaction.atomic():
+            job = JobQ.objects.filter(is_complete=False).order_by('-order').first()
+            if job is None:
+                return []
+            JobQ.objects.filter(pk=job.pk).update(is_complete=True)
+            return [job]
+
+    for label, claim in [('claim_next', claim_next), ('naive', claim_naive)]:
+        for threads in [1, 4]:
+            JobQ.objects.all().delete()
+            JobQ.objects.bulk_create([JobQ(order=i, group=i) for i in range(jobs)])
+            claimed = []
+            errors = []
+
+            def worker():
+                try:
+                    while True:
+                        rows = claim()
+                        if not rows:
+                            break
+                        claimed.extend(row.pk for row in rows)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    connection.close()
+
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            start = time.time()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            seconds = time.time() - start
+            print('%-40s %10.0f jobs per second, %d claimed twice, %d errors' % (
+                '%s, %d threads' % (label, threads), len(claimed) / seconds, len(claimed) - len(set(claimed)), len(errors)))
+
+
+BENCHMARKS = {
+    'autodetector': benchmark_autodetector,
+    'compiler': benchmark_compiler,
+    'queue': benchmark_queue,
+    'validation': benchmark_validation,
+}
+
+
+def main(args):
+    # Since this is designed to be ran outside of ./manage.py, we need to do some setup first.
+    import django
+    from django.conf import settings
+    settings.configure(INSTALLED_APPS=['testapp'], DATABASES=DATABASES_FOR_DB[args.db], DB_NAME=args.db)
+    django.setup()
+
+    from django.db import connection
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        for name in args.benchmarks or sorted(BENCHMARKS):
+            print('%s (%s):' % (name, args.db))
+            BENCHMARKS[name](args)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', required=True)
+    parser.add_argument('--number', type=int, default=1000, help='Number of calls per measurement.')
+    parser.add_argument('--models', type=int, default=300, help='Number of models for the autodetector benchmark.')
+    parser.add_argument('benchmarks', nargs='*', choices=[[]] + sorted(BENCHMARKS))
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,104 @@
+"""
+Tests for the direct PQ to SQL compiler.
+"""
+import datetime
+
+from django.db import connection
+from django.test import SimpleTestCase
+
+from partial_index import compiler, query, PQ, PF
+from testapp.models import AB, ABC, JobQ, RoomBookingQ
+
+
+class CompilerTest(SimpleTestCase):
+    """The compiler must produce exactly the same SQL and parameters as the Django ORM."""
+
+    def assertSameAsOrm(self, q, model=AB):
+        sql, params, _ = compiler.compile_q(q, model, connection)
+        self.assertEqual((sql, list(params)), tuple(query.orm_q_to_sql_params(q, model, connection)))
+
+    def test_empty(self):
+        self.assertSameAsOrm(PQ())
+
+    def test_lookups(self):
+        self.assertSameAsOrm(PQ(a='x'))
+        self.assertSameAsOrm(PQ(a__exact='x'))
+        self.assertSameAsOrm(PQ(a__gt='x'))
+        self.assertSameAsOrm(PQ(a__gte='x'))
+        self.assertSameAsOrm(PQ(a__lt='x'))
+        self.assertSameAsOrm(PQ(a__lte='x'))
+        self.assertSameAsOrm(PQ(a__isnull=True))
+        self.assertSameAsOrm(PQ(a__isnull=False))
+
+    def test_in(self):
+        self.assertSameAsOrm(PQ(a__in=['x', 'y', 'x']))
+        self.assertSameAsOrm(PQ(order__in=(3, 1, 2)), JobQ)
+
+    def test_exact_none(self):
+        self.assertSameAsOrm(PQ(a=None))
+        self.assertSameAsOrm(~PQ(a=None))
+
+    def test_pk(self):
+        self.assertSameAsOrm(PQ(pk=1))
+        self.assertSameAsOrm(PQ(pk__gt=PF('id')))
+
+    def test_value_types(self):
+        self.assertSameAsOrm(PQ(is_complete=False, order__gte=10, group__lt=5), JobQ)
+        self.assertSameAsOrm(PQ(deleted_at__gt=datetime.datetime(2018, 1, 2, 3, 4, 5)), RoomBookingQ)
+
+    def test_f(self):
+        self.assertSameAsOrm(PQ(a=PF('b')))
+        self.assertSameAsOrm(PQ(a__lt=PF('b')))
+        self.assertSameAsOrm(~PQ(a=PF('b')))
+
+    def test_and_or(self):
+        self.assertSameAsOrm(PQ(a='x', b='y'))
+        self.assertSameAsOrm(PQ(a='x') | PQ(b='y'))
+        self.assertSameAsOrm((PQ(a='x') | PQ(b='y')) & PQ(a__isnull=False))
+        self.assertSameAsOrm((PQ(a='x') | PQ(b='y')) & (PQ(a='z') | PQ(b='z')))
+        self.assertSameAsOrm(PQ(a='x') | (PQ(b='y') & PQ(a='z')) | PQ(b='z'))
+        self.assertSameAsOrm(PQ(PQ(PQ(a='x'))))
+
+    def test_not(self):
+        self.assertSameAsOrm(~PQ(a='x'))
+        self.assertSameAsOrm(~PQ(a='x', b='y'))
+        self.assertSameAsOrm(~(PQ(a='x') | PQ(b='y')))
+        self.assertSameAsOrm(~~PQ(a='x'))
+        self.assertSameAsOrm(PQ(a='x') & ~PQ(b='y'))
+        self.assertSameAsOrm(~(PQ(a='x') & ~PQ(b='y')))
+
+    def test_not_nullable(self):
+        self.assertSameAsOrm(~PQ(deleted_at__gt=datetime.datetime(2018, 1, 1)), RoomBookingQ)
+        self.assertSameAsOrm(~PQ(deleted_at__isnull=True), RoomBookingQ)
+        self.assertSameAsOrm(~(PQ(deleted_at__gt=datetime.datetime(2018, 1, 1)) | PQ(id=1)), RoomBookingQ)
+        self.assertSameAsOrm(~~PQ(deleted_at__gt=datetime.datetime(2018, 1, 1)), RoomBookingQ)
+
+    def test_mentioned_fields(self):
+        _, _, fields = compiler.compile_q(PQ(a='x') | ~PQ(b=PF('a')), AB, connection)
+        self.assertEqual(fields, {'a', 'b'})
+        _, _, fields = compiler.compile_q(PQ(pk__isnull=False), AB, connection)
+        self.assertEqual(fields, {'id'})
+
+    def assertUnsupported(self, q, model=AB):
+        with self.assertRaises(compiler.Unsupported):
+            compiler.compile_q(q, model, connection)
+
+    def test_unsupported(self):
+        self.assertUnsupported(PQ(a__contains='x'))
+        self.assertUnsupported(PQ(a__lower='x'))
+        self.assertUnsupported(PQ(a__lower__exact='x'))
+        self.assertUnsupported(PQ(a__in=[]))
+        self.assertUnsupported(PQ(a__in=['x', None]))
+        self.assertUnsupported(PQ(a__gt=None))
+        self.assertUnsupported(PQ(a=PF('b') + PF('c')))
+        self.assertUnsupported(PQ(a=PF('b__c')))
+        self.assertUnsupported(PQ(missing='x'))
+        self.assertUnsupported(PQ(order__gte=1.5), JobQ)
+        self.assertUnsupported(PQ(user=1), RoomBookingQ)
+        self.assertUnsupported(PQ(user__name='x'), RoomBookingQ)
+        self.assertUnsupported(~PQ(id=PF('deleted_at')), RoomBookingQ)
+
+    def test_unsupported_falls_back(self):
+        sql, params = query.q_to_sql_params(PQ(a__contains='x'), AB, connection)
+        self.assertEqual((sql, list(params)), tuple(query.orm_q_to_sql_params(PQ(a__contains='x'), AB, connection)))
+        self.assertEqual(query.q_mentioned_fields(PQ(a__contains='x', b=PF('c')), ABC), ['a', 'b', 'c'])
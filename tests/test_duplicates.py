@@ -0,0 +1,112 @@
+"""
+Tests for finding duplicates that would prevent creating a unique partial index.
+"""
+from django.core.management import call_command, CommandError
+from django.db import connection, IntegrityError
+from django.db.models.functions import Lower
+from django.test import TransactionTestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from partial_index import PartialIndex, PQ
+from partial_index.duplicates import check_duplicates, find_duplicates
+from testapp.models import AB, JobQ, JobText, Room, RoomBookingQ, User
+
+
+class FindDuplicatesTest(TransactionTestCase):
+    def setUp(self):
+        self.index = PartialIndex(fields=['order'], name='jobq_order_unique', unique=True, where=PQ(is_complete=False))
+        for group, (order, is_complete) in enumerate([(1, False), (1, False), (2, False), (3, False), (3, False), (3, False), (2, True)]):
+            JobQ.objects.create(order=order, group=group, is_complete=is_complete)
+
+    def test_duplicates(self):
+        self.assertEqual(list(find_duplicates(JobQ, self.index)), [((1,), 2), ((3,), 3)])
+
+    def test_chunks(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(list(find_duplicates(JobQ, self.index, chunk_size=1)), [((1,), 2), ((3,), 3)])
+
+    def test_where_condition(self):
+        index = PartialIndex(fields=['order'], name='jobq_order_unique', unique=True, where=PQ(is_complete=True))
+        self.assertEqual(list(find_duplicates(JobQ, index)), [])
+
+    def test_several_fields(self):
+        AB.objects.create(a='x', b='y')
+        AB.objects.create(a='x', b='y')
+        AB.objects.create(a='x', b='z')
+        index = PartialIndex(fields=['a', 'b'], name='ab_unique', unique=True, where=PQ(a='x'))
+        self.assertEqual(list(find_duplicates(AB, index, chunk_size=1)), [(('x', 'y'), 2)])
+
+    def test_expression_key(self):
+        AB.objects.create(a='X', b='y')
+        AB.objects.create(a='x', b='y')
+        index = PartialIndex(fields=[Lower('a')], name='ab_lower_unique', unique=True, where=PQ(b='y'))
+        self.assertEqual(list(find_duplicates(AB, index)), [(('x',), 2)])
+
+    def test_null_keys_skipped(self):
+        user, room = User.objects.create(name='User1'), Room.objects.create(name='Room1')
+        RoomBookingQ.objects.create(user=user, room=room)
+        RoomBookingQ.objects.create(user=user, room=room, deleted_at=timezone.now())
+        index = PartialIndex(fields=['user', 'deleted_at'], name='roombookingq_unique', unique=True, where=PQ(room__isnull=False))
+        self.assertEqual(list(find_duplicates(RoomBookingQ, index)), [])
+
+    def test_text_where(self):
+        index = PartialIndex(fields=['order'], name='jobtext_order_unique', unique=True,
+                             where_postgresql='is_complete = false', where_sqlite='is_complete = 0')
+        JobText.objects.create(order=1, group=1)
+        JobText.objects.create(order=1, group=2)
+        JobText.objects.create(order=1, group=3, is_complete=True)
+        self.assertEqual(list(find_duplicates(JobText, index)), [((1,), 2)])
+
+    def test_not_unique(self):
+        with self.assertRaisesMessage(ValueError, 'Duplicates can only be checked for unique PartialIndexes'):
+            list(find_duplicates(JobQ, JobQ._meta.indexes[0]))
+
+    def test_check_duplicates(self):
+        with self.assertRaisesMessage(IntegrityError, 'Cannot create unique index jobq_order_unique, rows covered by it have duplicate keys: order=1 (2 rows); order=3 (3 rows)'):
+            check_duplicates(JobQ, self.index)
+        JobQ.objects.filter(order__in=[1, 3]).update(is_complete=True)
+        check_duplicates(JobQ, self.index)
+
+
+class FindPartialDuplicatesCommandTest(TransactionTestCase):
+    def setUp(self):
+        # The unique index on group has to be dropped to create duplicates.
+        self.index = JobQ._meta.indexes[1]
+        with connection.schema_editor() as editor:
+            editor.remove_index(JobQ, self.index)
+
+    def tearDown(self):
+        JobQ.objects.all().delete()
+        with connection.schema_editor() as editor:
+            editor.add_index(JobQ, self.index)
+
+    def call_command(self, *args, **kwargs):
+        out = StringIO()
+        call_command('find_partial_duplicates', *args, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def test_no_duplicates(self):
+        JobQ.objects.create(order=1, group=1)
+        JobQ.objects.create(order=2, group=1, is_complete=True)
+        self.assertEqual(self.call_command('testapp.JobQ'), 'No duplicates found.\n')
+
+    def test_duplicates(self):
+        JobQ.objects.create(order=1, group=1)
+        JobQ.objects.create(order=2, group=1)
+        out = StringIO()
+        with self.assertRaisesMessage(CommandError, 'Found 1 duplicate keys.'):
+            call_command('find_partial_duplicates', 'testapp', stdout=out)
+        self.assertEqual(out.getvalue(), 'testapp.JobQ %s: group=1 (2 rows)\n' % self.index.name)
+
+    def test_index_name(self):
+        JobQ.objects.create(order=1, group=1)
+        JobQ.objects.create(order=2, group=1)
+        with self.assertRaisesMessage(CommandError, 'No unique partial index named missing_partial.'):
+            self.call_command(index='missing_partial')
+        with self.assertRaisesMessage(CommandError, 'Found 1 duplicate keys.'):
+            self.call_command(index=self.index.name)
+
+    def test_unknown_label(self):
+        with self.assertRaises(CommandError):
+            self.call_command('testapp.Missing')
@@ -3,10 +3,13 @@ Tests for actual use of the indexes after creating models with them.
 """
 import datetime
 
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connection
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 
-from testapp.forms import RoomBookingAllFieldsForm, RoomBookingNoConditionFieldForm, RoomBookingJustRoomForm, RoomBookingTextForm
+from testapp.forms import RoomBookingAllFieldsForm, RoomBookingNoConditionFieldForm, RoomBookingJustRoomForm, RoomBookingTextForm, \
+    RoomBookingFormSet
 from testapp.models import User, Room, RoomBookingQ
 
 
@@ -93,3 +96,57 @@ class SingleFieldFormTest(FormTestCase, TransactionTestCase):
     These have to be provided from an existing instance.
     """
     formclass = RoomBookingJustRoomForm
+
+
+class FormSetTest(TransactionTestCase):
+    """Test that partial unique validation on a ModelFormSet validates all forms together."""
+    conflict_error = 'RoomBookingQ with the same values for room, user already exists.'
+    duplicate_error = 'RoomBookingQ with the same values for room, user is repeated in the same batch.'
+
+    def setUp(self):
+        self.user1 = User.objects.create(name='User1')
+        self.user2 = User.objects.create(name='User2')
+        self.room1 = Room.objects.create(name='Room1')
+        self.room2 = Room.objects.create(name='Room2')
+        self.booking1 = RoomBookingQ.objects.create(user=self.user1, room=self.room1)
+
+    def formset(self, *rows):
+        data = {
+            'form-TOTAL_FORMS': '3',
+            'form-INITIAL_FORMS': '0',
+        }
+        for i, (user, room) in enumerate(rows):
+            data['form-%d-user' % i] = user.id
+            data['form-%d-room' % i] = room.id
+        return RoomBookingFormSet(data=data, queryset=RoomBookingQ.objects.none())
+
+    def test_valid(self):
+        formset = self.formset((self.user2, self.room1), (self.user1, self.room2))
+        self.assertTrue(formset.is_valid(), 'Formset errors: %s' % formset.errors)
+
+    def test_single_query_for_partial_unique(self):
+        formset = self.formset((self.user2, self.room1), (self.user1, self.room2))
+        with CaptureQueriesContext(connection) as queries:
+            formset.is_valid()
+        self.assertEqual(len([q for q in queries.captured_queries if 'testapp_roombookingq' in q['sql']]), 1)
+
+    def test_conflict_with_existing(self):
+        formset = self.formset((self.user2, self.room1), (self.user1, self.room1))
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.forms[0].errors, {})
+        self.assertEqual(formset.forms[1].errors['__all__'], [self.conflict_error])
+
+    def test_duplicate_in_formset(self):
+        formset = self.formset((self.user2, self.room2), (self.user2, self.room2))
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.forms[0].errors, {})
+        self.assertEqual(formset.forms[1].errors['__all__'], [self.duplicate_error])
+
+    def test_saved_instances_validated_afterwards(self):
+        formset = self.formset((self.user2, self.room2))
+        self.assertTrue(formset.is_valid(), 'Formset errors: %s' % formset.errors)
+        booking = formset.save()[0]
+        booking.room = self.room1
+        booking.user = self.user1
+        with self.assertRaisesMessage(ValidationError, self.conflict_error):
+            booking.full_clean()
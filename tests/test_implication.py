@@ -0,0 +1,102 @@
+"""
+Tests for checking whether a QuerySet implies the where-condition of a partial index.
+"""
+import datetime
+
+from django.db.models import F, Q
+from django.test import SimpleTestCase, TestCase
+
+from partial_index import implication, PartialIndex, PQ, PF
+from testapp.models import AB, ComparisonQ, JobQ, RoomBookingQ, RoomBookingText
+
+
+def index(where):
+    return PartialIndex(fields=['id'], unique=False, where=where)
+
+
+class ImplicationTest(SimpleTestCase):
+    def assertImplied(self, queryset, where):
+        usage = implication.analyze_index_usage(queryset, index(where))
+        self.assertEqual(usage, (True, [], None))
+
+    def assertMissing(self, queryset, where, missing):
+        usage = implication.analyze_index_usage(queryset, index(where))
+        self.assertEqual(usage, (False, missing, None))
+
+    def test_no_filter(self):
+        self.assertMissing(JobQ.objects.order_by('-order'), PQ(is_complete=False), [PQ(is_complete=False)])
+
+    def test_same_condition(self):
+        self.assertImplied(JobQ.objects.filter(is_complete=False), PQ(is_complete=False))
+        self.assertImplied(JobQ.objects.filter(is_complete=False, group=1), PQ(is_complete=False))
+        self.assertImplied(JobQ.objects.filter(is_complete=False).filter(group=1), PQ(is_complete=False))
+        self.assertImplied(RoomBookingQ.objects.filter(deleted_at__isnull=True), PQ(deleted_at__isnull=True))
+        self.assertImplied(RoomBookingQ.objects.filter(deleted_at=None), PQ(deleted_at__isnull=True))
+
+    def test_missing_conjuncts(self):
+        self.assertMissing(JobQ.objects.filter(group=1), PQ(is_complete=False, group=1), [PQ(is_complete=False)])
+        self.assertMissing(JobQ.objects.filter(group=1), PQ(group=1) & (PQ(order=1) | PQ(order=2)), [PQ(order=1) | PQ(order=2)])
+        self.assertMissing(JobQ.objects.filter(group=2), PQ(group=1) | PQ(order=1), [PQ(group=1) | PQ(order=1)])
+
+    def test_ranges(self):
+        self.assertImplied(JobQ.objects.filter(order=5), PQ(order__gt=1))
+        self.assertImplied(JobQ.objects.filter(order__gt=5), PQ(order__gte=5))
+        self.assertImplied(JobQ.objects.filter(order__gte=5), PQ(order__gt=4))
+        self.assertImplied(JobQ.objects.filter(order__lt=5), PQ(order__lte=5))
+        self.assertImplied(JobQ.objects.filter(order__in=[1, 2]), PQ(order__lt=3))
+        self.assertImplied(JobQ.objects.filter(order__in=[1, 2]), PQ(order__in=[1, 2, 3]))
+        self.assertMissing(JobQ.objects.filter(order__gte=5), PQ(order__gt=5), [PQ(order__gt=5)])
+        self.assertMissing(JobQ.objects.filter(order__lt=5), PQ(order__gt=1), [PQ(order__gt=1)])
+        self.assertMissing(JobQ.objects.filter(order__in=[1, 5]), PQ(order__lt=3), [PQ(order__lt=3)])
+
+    def test_not_null(self):
+        self.assertImplied(RoomBookingQ.objects.filter(deleted_at__isnull=False), PQ(deleted_at__isnull=False))
+        self.assertImplied(RoomBookingQ.objects.filter(deleted_at__gt=datetime.datetime(2018, 1, 1)), PQ(deleted_at__isnull=False))
+        self.assertMissing(RoomBookingQ.objects.filter(deleted_at__isnull=True), PQ(deleted_at__isnull=False), [PQ(deleted_at__isnull=False)])
+
+    def test_negation(self):
+        self.assertImplied(JobQ.objects.exclude(is_complete=True), PQ(is_complete=False))
+        self.assertImplied(JobQ.objects.exclude(group=1), ~PQ(group=1))
+        self.assertImplied(JobQ.objects.filter(group=2), ~PQ(group=1))
+        self.assertImplied(JobQ.objects.filter(group__gt=1), ~PQ(group__in=[0, 1]))
+        self.assertImplied(JobQ.objects.exclude(group__in=[1, 2]), ~PQ(group=1))
+        self.assertImplied(RoomBookingQ.objects.exclude(deleted_at__isnull=False), PQ(deleted_at__isnull=True))
+        self.assertMissing(JobQ.objects.exclude(group=1), ~PQ(group__in=[1, 2]), [~PQ(group__in=[1, 2])])
+        self.assertMissing(JobQ.objects.exclude(group=1), PQ(group=2), [PQ(group=2)])
+
+    def test_or(self):
+        self.assertImplied(JobQ.objects.filter(Q(order=1) | Q(order=2)), PQ(order__lt=3))
+        self.assertImplied(JobQ.objects.filter(Q(order=1) | Q(order=2)), PQ(order=1) | PQ(order=2) | PQ(order=3))
+        self.assertImplied(JobQ.objects.filter(Q(order=1, group=1) | Q(group=1)), PQ(group=1))
+        self.assertImplied(JobQ.objects.filter(order=1), PQ(order=1) | PQ(group=1))
+        self.assertMissing(JobQ.objects.filter(Q(order=1) | Q(group=1)), PQ(order=1), [PQ(order=1)])
+
+    def test_field_reference(self):
+        self.assertImplied(ComparisonQ.objects.filter(a=F('b')), PQ(a=PF('b')))
+        self.assertMissing(ComparisonQ.objects.filter(a=F('a')), PQ(a=PF('b')), [PQ(a=PF('b'))])
+
+    def test_unknown_query_conditions_ignored(self):
+        self.assertImplied(AB.objects.filter(a__contains='x', b='y'), PQ(b='y'))
+        self.assertMissing(AB.objects.filter(Q(a__contains='x') | Q(b='y')), PQ(b='y'), [PQ(b='y')])
+        self.assertMissing(RoomBookingQ.objects.filter(user__name='x'), PQ(user__name='x'), [PQ(user__name='x')])
+
+    def test_unsupported_predicate(self):
+        self.assertMissing(AB.objects.filter(a__contains='x'), PQ(a__contains='x'), [PQ(a__contains='x')])
+
+    def test_text_where(self):
+        usage = implication.analyze_index_usage(RoomBookingText.objects.all(), RoomBookingText._meta.indexes[0])
+        self.assertEqual(usage, (None, None, None))
+
+
+class ExplainTest(TestCase):
+    def test_explain(self):
+        idx = JobQ._meta.indexes[0]
+        usage = implication.analyze_index_usage(JobQ.objects.filter(is_complete=False).order_by('-order'), idx, explain=True)
+        self.assertEqual(usage, (True, [], True))
+        usage = implication.analyze_index_usage(JobQ.objects.order_by('-order'), idx, explain=True)
+        self.assertEqual(usage, (False, [PQ(is_complete=False)], False))
+
+    def test_explain_text_where(self):
+        idx = RoomBookingText._meta.indexes[0]
+        queryset = RoomBookingText.objects.filter(user_id=1, room_id=1, deleted_at__isnull=True)
+        self.assertIs(implication.explain_uses_index(queryset, idx), True)
@@ -0,0 +1,114 @@
+"""
+Tests for restricting QuerySets to the rows covered by a partial index.
+"""
+import threading
+
+from django.db import connection
+from django.db.models.functions import Lower
+from django.test import TestCase, TransactionTestCase
+
+from partial_index import PartialIndex, PQ
+from partial_index.managers import PartialIndexManager, PartialIndexQuerySet
+from testapp.models import AccountQ, JobQ, RoomBookingText
+
+
+class CoveredByTest(TestCase):
+    def setUp(self):
+        self.index = JobQ._meta.indexes[0]
+        self.job1 = JobQ.objects.create(order=1, group=1)
+        self.job2 = JobQ.objects.create(order=2, group=2)
+        self.job3 = JobQ.objects.create(order=3, group=1, is_complete=True)
+
+    def assertSameQuery(self, queryset, expect):
+        self.assertEqual(str(queryset.query), str(expect.query))
+
+    def test_covered_by(self):
+        self.assertEqual(list(JobQ.objects.covered_by(self.index)), [self.job2, self.job1])
+        self.assertSameQuery(JobQ.objects.covered_by(self.index), JobQ.objects.filter(is_complete=False).order_by('-order'))
+
+    def test_by_name(self):
+        self.assertSameQuery(JobQ.objects.covered_by(self.index.name), JobQ.objects.covered_by(self.index))
+
+    def test_not_ordered(self):
+        self.assertSameQuery(JobQ.objects.covered_by(self.index, ordered=False), JobQ.objects.filter(is_complete=False))
+
+    def test_chained(self):
+        self.assertEqual(list(JobQ.objects.filter(group=1).covered_by(self.index)), [self.job1])
+        self.assertEqual(list(JobQ.objects.covered_by(self.index).filter(group=1)), [self.job1])
+
+    def test_implied_condition_not_repeated(self):
+        queryset = JobQ.objects.filter(is_complete=False)
+        self.assertSameQuery(queryset.covered_by(self.index, ordered=False), queryset)
+
+    def test_expression_key_ordering(self):
+        accounts = PartialIndexQuerySet(model=AccountQ)
+        index = AccountQ._meta.indexes[0]
+        self.assertSameQuery(accounts.covered_by(index), accounts.filter(is_active=True).order_by(Lower('email').asc()))
+
+    def test_unknown_index(self):
+        with self.assertRaisesMessage(ValueError, 'Model testapp.JobQ has no partial index named missing_partial.'):
+            JobQ.objects.covered_by('missing_partial')
+        with self.assertRaisesMessage(ValueError, 'no partial index named'):
+            JobQ.objects.covered_by(PartialIndex(fields=['order'], unique=False, where=PQ(is_complete=False), name='other_partial'))
+
+    def test_text_where(self):
+        queryset = PartialIndexQuerySet(model=RoomBookingText)
+        with self.assertRaisesMessage(ValueError, 'text-based where-condition'):
+            queryset.covered_by(RoomBookingText._meta.indexes[0])
+
+    def test_manager(self):
+        manager = PartialIndexManager(self.index.name)
+        manager.model = JobQ
+        self.assertEqual(list(manager.all()), [self.job2, self.job1])
+        self.assertEqual(list(manager.filter(group=1)), [self.job1])
+        self.assertEqual(manager.deconstruct()[3], (self.index.name, ))
+
+
+class ClaimNextTest(TransactionTestCase):
+    def setUp(self):
+        self.index = JobQ._meta.indexes[0]
+        self.jobs = [JobQ.objects.create(order=order, group=order) for order in range(5)]
+
+    def test_claim_next(self):
+        claimed = JobQ.objects.claim_next(self.index, {'is_complete': True})
+        self.assertEqual(claimed, [self.jobs[4]])
+        self.assertIs(claimed[0].is_complete, True)
+        claimed = JobQ.objects.claim_next(self.index.name, {'is_complete': True}, batch_size=3)
+        self.assertEqual(claimed, [self.jobs[3], self.jobs[2], self.jobs[1]])
+        self.assertEqual(list(JobQ.objects.filter(is_complete=False)), [self.jobs[0]])
+
+    def test_claim_more_than_available(self):
+        self.assertEqual(len(JobQ.objects.claim_next(self.index, {'is_complete': True}, batch_size=10)), 5)
+        self.assertEqual(JobQ.objects.claim_next(self.index, {'is_complete': True}), [])
+
+    def test_filtered(self):
+        self.assertEqual(JobQ.objects.filter(group__lt=3).claim_next(self.index, {'is_complete': True}), [self.jobs[2]])
+
+    def test_values_must_leave_index(self):
+        with self.assertRaisesMessage(ValueError, 'Claimed rows must not be covered by partial index'):
+            JobQ.objects.claim_next(self.index, {'is_complete': False})
+        with self.assertRaisesMessage(ValueError, 'Claimed rows must not be covered by partial index'):
+            JobQ.objects.claim_next(self.index, {'group': 1})
+
+    def test_concurrent(self):
+        if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] == ':memory:':
+            self.skipTest('Needs a database that is shared by threads.')
+        JobQ.objects.bulk_create([JobQ(order=order, group=order) for order in range(5, 50)])
+        claimed = []
+
+        def worker():
+            try:
+                while True:
+                    jobs = JobQ.objects.claim_next(self.index, {'is_complete': True}, batch_size=3)
+                    if not jobs:
+                        break
+                    claimed.extend(job.pk for job in jobs)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), sorted(JobQ.objects.values_list('pk', flat=True)))
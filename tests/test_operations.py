@@ -0,0 +1,326 @@
+"""
+Tests for the migration operations.
+"""
+import unittest
+
+import django
+from django.apps import apps
+from django.db import connection, IntegrityError, NotSupportedError
+from django.db.migrations.state import ProjectState
+from django.db.models import Index, F, Q
+from django.db.models.functions import Lower
+from django.test import TransactionTestCase
+
+from partial_index import PartialIndex, PQ, PF
+from testapp.models import RoomBookingQ, RoomBookingText, JobQ
+from partial_index.operations import (
+    AddPartialIndexConcurrently, RemovePartialIndexConcurrently, ReplacePartialIndexConcurrently, index_is_valid,
+    CheckPartialIndexDuplicates, ConvertToNativeIndex, native_index, native_q, normalized_index_sql,
+)
+
+
+class OperationTestCase(TransactionTestCase):
+    def state_forwards(self, operation, state):
+        new_state = state.clone()
+        operation.state_forwards('testapp', new_state)
+        return new_state
+
+    def apply(self, operation, state, atomic=False):
+        """Runs the operation against the database, returns the project state after it."""
+        new_state = self.state_forwards(operation, state)
+        with connection.schema_editor(atomic=atomic) as editor:
+            operation.database_forwards('testapp', editor, state, new_state)
+        return new_state
+
+    def unapply(self, operation, state, new_state):
+        with connection.schema_editor(atomic=False) as editor:
+            operation.database_backwards('testapp', editor, new_state, state)
+
+    def index_names(self, table):
+        with connection.cursor() as cursor:
+            return set(connection.introspection.get_constraints(cursor, table))
+
+    def drop_indexes(self, table, names):
+        # Schema changes are not rolled back between tests.
+        with connection.schema_editor() as editor:
+            for name in set(names) & self.index_names(table):
+                editor.execute(editor.sql_delete_index % {'table': editor.quote_name(table), 'name': editor.quote_name(name)})
+
+
+class ConcurrentOperationsTest(OperationTestCase):
+    def setUp(self):
+        self.state = ProjectState.from_apps(apps)
+        self.index = PartialIndex(fields=['order'], name='jobq_order_concurrent', unique=False, where=PQ(is_complete=True))
+
+    def tearDown(self):
+        self.drop_indexes('testapp_jobq', ['jobq_order_concurrent'])
+
+    def test_add_and_remove(self):
+        state = self.apply(AddPartialIndexConcurrently('jobq', self.index), self.state)
+        self.assertIn('jobq_order_concurrent', self.index_names('testapp_jobq'))
+        self.apply(RemovePartialIndexConcurrently('jobq', 'jobq_order_concurrent'), state)
+        self.assertNotIn('jobq_order_concurrent', self.index_names('testapp_jobq'))
+
+    def test_add_backwards(self):
+        operation = AddPartialIndexConcurrently('jobq', self.index)
+        state = self.apply(operation, self.state)
+        self.unapply(operation, self.state, state)
+        self.assertNotIn('jobq_order_concurrent', self.index_names('testapp_jobq'))
+
+    def test_remove_backwards(self):
+        state = self.apply(AddPartialIndexConcurrently('jobq', self.index), self.state)
+        operation = RemovePartialIndexConcurrently('jobq', 'jobq_order_concurrent')
+        self.unapply(operation, state, self.apply(operation, state))
+        self.assertIn('jobq_order_concurrent', self.index_names('testapp_jobq'))
+
+    def test_state(self):
+        state = self.apply(AddPartialIndexConcurrently('jobq', self.index), self.state)
+        self.assertEqual(state.models['testapp', 'jobq'].get_index_by_name('jobq_order_concurrent'), self.index)
+        state = self.apply(RemovePartialIndexConcurrently('jobq', 'jobq_order_concurrent'), state)
+        with self.assertRaises(ValueError):
+            state.models['testapp', 'jobq'].get_index_by_name('jobq_order_concurrent')
+
+    def test_partial_index_required(self):
+        with self.assertRaises(ValueError):
+            AddPartialIndexConcurrently('jobq', Index(fields=['order'], name='jobq_order_plain'))
+
+    def test_deconstruct(self):
+        name, args, kwargs = AddPartialIndexConcurrently('jobq', self.index).deconstruct()
+        self.assertEqual(name, 'AddPartialIndexConcurrently')
+        self.assertEqual(kwargs, {'model_name': 'jobq', 'index': self.index})
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite does not need a special transaction setup.')
+    def test_sqlite_atomic(self):
+        self.apply(AddPartialIndexConcurrently('jobq', self.index), self.state, atomic=True)
+        self.assertIn('jobq_order_concurrent', self.index_names('testapp_jobq'))
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Concurrent indexes are only built on PostgreSQL.')
+    def test_postgresql_atomic_not_supported(self):
+        with self.assertRaises(NotSupportedError):
+            self.apply(AddPartialIndexConcurrently('jobq', self.index), self.state, atomic=True)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Concurrent indexes are only built on PostgreSQL.')
+    def test_postgresql_sql(self):
+        operation = AddPartialIndexConcurrently('jobq', self.index)
+        with connection.schema_editor(atomic=False, collect_sql=True) as editor:
+            operation.database_forwards('testapp', editor, self.state, self.state_forwards(operation, self.state))
+        self.assertTrue(editor.collected_sql[0].startswith('CREATE INDEX CONCURRENTLY "jobq_order_concurrent"'))
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Concurrent indexes are only built on PostgreSQL.')
+    def test_postgresql_invalid_index_rebuilt(self):
+        # Mark the index invalid, as if CREATE INDEX CONCURRENTLY had failed.
+        with connection.schema_editor(atomic=False) as editor:
+            editor.execute(self.index.create_sql(self.state.apps.get_model('testapp', 'jobq'), editor), params=None)
+            editor.execute("UPDATE pg_index SET indisvalid = false WHERE indexrelid = 'jobq_order_concurrent'::regclass")
+            self.assertIs(index_is_valid(editor, 'jobq_order_concurrent'), False)
+        self.apply(AddPartialIndexConcurrently('jobq', self.index), self.state)
+        with connection.schema_editor(atomic=False) as editor:
+            self.assertIs(index_is_valid(editor, 'jobq_order_concurrent'), True)
+
+
+class ReplaceOperationTest(OperationTestCase):
+    def setUp(self):
+        self.state = self.apply(
+            AddPartialIndexConcurrently('jobq', PartialIndex(fields=['order'], name='jobq_order_old', unique=True, where=PQ(is_complete=True))),
+            ProjectState.from_apps(apps))
+        self.index = PartialIndex(fields=['order', 'group'], name='jobq_order_replaced', unique=True, where=PQ(is_complete=False))
+        self.operation = ReplacePartialIndexConcurrently('jobq', 'jobq_order_old', self.index)
+
+    def tearDown(self):
+        self.drop_indexes('testapp_jobq', ['jobq_order_old', 'jobq_order_replaced', 'jobq_order_replaced_new', 'jobq_order_renamed'])
+
+    def test_forwards(self):
+        state = self.apply(self.operation, self.state)
+        names = self.index_names('testapp_jobq')
+        self.assertIn('jobq_order_replaced', names)
+        self.assertNotIn('jobq_order_old', names)
+        self.assertNotIn('jobq_order_replaced_new', names)
+        self.assertEqual(state.models['testapp', 'jobq'].get_index_by_name('jobq_order_replaced'), self.index)
+        with self.assertRaises(ValueError):
+            state.models['testapp', 'jobq'].get_index_by_name('jobq_order_old')
+
+    def test_backwards(self):
+        self.unapply(self.operation, self.state, self.apply(self.operation, self.state))
+        names = self.index_names('testapp_jobq')
+        self.assertIn('jobq_order_old', names)
+        self.assertNotIn('jobq_order_replaced', names)
+
+    def test_same_name(self):
+        index = PartialIndex(fields=['order'], name='jobq_order_old', unique=True, where=PQ(is_complete=False))
+        self.apply(ReplacePartialIndexConcurrently('jobq', 'jobq_order_old', index), self.state)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, 'testapp_jobq')
+        self.assertEqual(constraints['jobq_order_old']['columns'], ['order'])
+
+    def test_rename_only(self):
+        index = PartialIndex(fields=['order'], name='jobq_order_renamed', unique=True, where=PQ(is_complete=True))
+        operation = ReplacePartialIndexConcurrently('jobq', 'jobq_order_old', index)
+        new_state = self.state_forwards(operation, self.state)
+        with connection.schema_editor(atomic=False, collect_sql=True) as editor:
+            operation.database_forwards('testapp', editor, self.state, new_state)
+        if connection.vendor == 'postgresql':
+            self.assertEqual(editor.collected_sql, ['ALTER INDEX "jobq_order_old" RENAME TO "jobq_order_renamed";'])
+        else:
+            self.assertEqual(len(editor.collected_sql), 2)
+            self.assertTrue(editor.collected_sql[0].startswith('DROP INDEX "jobq_order_old"'))
+
+        self.apply(operation, self.state)
+        names = self.index_names('testapp_jobq')
+        self.assertIn('jobq_order_renamed', names)
+        self.assertNotIn('jobq_order_old', names)
+
+    def test_unchanged(self):
+        index = PartialIndex(fields=['order'], name='jobq_order_old', unique=True, where=PQ(is_complete=True))
+        operation = ReplacePartialIndexConcurrently('jobq', 'jobq_order_old', index)
+        with connection.schema_editor(atomic=False, collect_sql=True) as editor:
+            operation.database_forwards('testapp', editor, self.state, self.state_forwards(operation, self.state))
+        self.assertEqual(editor.collected_sql, [])
+
+    def test_normalized_index_sql(self):
+        jobq = self.state.apps.get_model('testapp', 'jobq')
+        ab = self.state.apps.get_model('testapp', 'ab')
+
+        def normalized(model, **kwargs):
+            with connection.schema_editor(collect_sql=True) as editor:
+                return normalized_index_sql(editor, model, PartialIndex(name='x', **kwargs))
+
+        self.assertEqual(
+            normalized(jobq, fields=['order'], unique=True, where=PQ(is_complete=True)),
+            normalized(jobq, fields=['order'], unique=True, where_postgresql='is_complete  =  true', where_sqlite='is_complete = 1'))
+        self.assertNotEqual(
+            normalized(jobq, fields=['order'], unique=True, where=PQ(is_complete=True)),
+            normalized(jobq, fields=['order'], unique=False, where=PQ(is_complete=True)))
+        self.assertEqual(
+            normalized(jobq, fields=['order'], unique=True, where=PQ(is_complete=True) & PQ(group=1)),
+            normalized(jobq, fields=['order'], unique=True, where=PQ(group=1) & PQ(is_complete=True)))
+        self.assertEqual(normalized(ab, fields=['a'], unique=True, where=PQ(a='x  y')), normalized(ab, fields=['a'], unique=True, where="a = 'x  y'"))
+        self.assertNotEqual(normalized(ab, fields=['a'], unique=True, where=PQ(a='x  y')), normalized(ab, fields=['a'], unique=True, where="a = 'x y'"))
+
+    def test_deconstruct(self):
+        name, args, kwargs = self.operation.deconstruct()
+        self.assertEqual(name, 'ReplacePartialIndexConcurrently')
+        self.assertEqual(kwargs, {'model_name': 'jobq', 'old_name': 'jobq_order_old', 'index': self.index})
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Concurrent indexes are only built on PostgreSQL.')
+    def test_postgresql_sql(self):
+        with connection.schema_editor(atomic=False, collect_sql=True) as editor:
+            self.operation.database_forwards('testapp', editor, self.state, self.state_forwards(self.operation, self.state))
+        self.assertTrue(editor.collected_sql[0].startswith('CREATE UNIQUE INDEX CONCURRENTLY "jobq_order_replaced_new"'))
+        self.assertEqual(editor.collected_sql[1:], [
+            'DROP INDEX IF EXISTS "jobq_order_old";',
+            'ALTER INDEX "jobq_order_replaced_new" RENAME TO "jobq_order_replaced";',
+        ])
+
+
+@unittest.skipIf(django.VERSION < (2, 2), 'Index conditions require Django 2.2 or later.')
+class CheckDuplicatesOperationTest(OperationTestCase):
+    def setUp(self):
+        self.state = ProjectState.from_apps(apps)
+        self.index = PartialIndex(fields=['order'], name='jobq_order_unique', unique=True, where=PQ(is_complete=False))
+        JobQ.objects.create(order=1, group=1)
+        JobQ.objects.create(order=1, group=2, is_complete=True)
+
+    def test_no_duplicates(self):
+        operation = CheckPartialIndexDuplicates('jobq', self.index)
+        state = self.apply(operation, self.state)
+        self.assertEqual(state.models['testapp', 'jobq'].options['indexes'], self.state.models['testapp', 'jobq'].options['indexes'])
+        self.unapply(operation, self.state, state)
+
+    def test_duplicates(self):
+        JobQ.objects.create(order=1, group=3)
+        with self.assertRaisesMessage(IntegrityError, 'rows covered by it have duplicate keys: order=1 (2 rows)'):
+            self.apply(CheckPartialIndexDuplicates('jobq', self.index), self.state)
+
+    def test_unique_partial_index_required(self):
+        with self.assertRaises(ValueError):
+            CheckPartialIndexDuplicates('jobq', JobQ._meta.indexes[0])
+
+    def test_deconstruct(self):
+        name, args, kwargs = CheckPartialIndexDuplicates('jobq', self.index).deconstruct()
+        self.assertEqual(name, 'CheckPartialIndexDuplicates')
+        self.assertEqual(kwargs, {'model_name': 'jobq', 'index': self.index})
+        name, args, kwargs = CheckPartialIndexDuplicates('jobq', self.index, chunk_size=100).deconstruct()
+        self.assertEqual(kwargs['chunk_size'], 100)
+
+
+class ConvertToNativeIndexTest(OperationTestCase):
+    def setUp(self):
+        self.state = ProjectState.from_apps(apps)
+
+    def convert(self, operation, expect_sql=()):
+        new_state = self.state_forwards(operation, self.state)
+        with connection.schema_editor(collect_sql=True) as editor:
+            operation.database_forwards('testapp', editor, self.state, new_state)
+        self.assertEqual(len(editor.collected_sql), len(expect_sql))
+        for sql, expect in zip(editor.collected_sql, expect_sql):
+            self.assertTrue(sql.startswith(expect), sql)
+        return new_state.models['testapp', operation.model_name_lower]
+
+    def test_unique(self):
+        from django.db.models import UniqueConstraint
+        name = RoomBookingQ._meta.indexes[0].name
+        model_state = self.convert(ConvertToNativeIndex('roombookingq', name))
+        self.assertEqual(model_state.options['indexes'], [])
+        self.assertEqual(model_state.options['constraints'], [
+            UniqueConstraint(fields=['user', 'room'], name=name, condition=Q(deleted_at__isnull=True)),
+        ])
+
+    def test_not_unique(self):
+        name = JobQ._meta.indexes[0].name
+        new_name = name.replace('_partial', '_idx')
+        if connection.vendor == 'postgresql':
+            expect_sql = ['ALTER INDEX "%s" RENAME TO "%s"' % (name, new_name)]
+        else:
+            expect_sql = ['DROP INDEX "%s"' % name, 'CREATE INDEX "%s"' % new_name]
+        model_state = self.convert(ConvertToNativeIndex('jobq', name), expect_sql)
+        self.assertEqual(model_state.options['indexes'][1], Index(fields=['-order'], name=new_name, condition=Q(is_complete=False)))
+        self.assertIsInstance(model_state.options['indexes'][0], PartialIndex)
+
+    def test_new_name(self):
+        name = JobQ._meta.indexes[0].name
+        new_state = self.state_forwards(ConvertToNativeIndex('jobq', name, new_name='jobq_order_native'), self.state)
+        self.assertEqual(new_state.models['testapp', 'jobq'].options['indexes'][1].name, 'jobq_order_native')
+
+    def test_apply_and_unapply(self):
+        name = JobQ._meta.indexes[0].name
+        operation = ConvertToNativeIndex('jobq', name, new_name='jobq_order_native')
+        new_state = self.apply(operation, self.state)
+        self.assertIn('jobq_order_native', self.index_names('testapp_jobq'))
+        self.assertNotIn(name, self.index_names('testapp_jobq'))
+        self.unapply(operation, self.state, new_state)
+        self.assertNotIn('jobq_order_native', self.index_names('testapp_jobq'))
+        self.assertIn(name, self.index_names('testapp_jobq'))
+
+    def test_text_requires_condition(self):
+        name = RoomBookingText._meta.indexes[0].name
+        with self.assertRaises(ValueError):
+            self.convert(ConvertToNativeIndex('roombookingtext', name))
+        model_state = self.convert(ConvertToNativeIndex('roombookingtext', name, condition=Q(deleted_at__isnull=True)))
+        self.assertEqual(model_state.options['constraints'][0].condition, Q(deleted_at__isnull=True))
+
+    def test_different_condition(self):
+        name = RoomBookingText._meta.indexes[0].name
+        with self.assertRaises(ValueError):
+            self.convert(ConvertToNativeIndex('roombookingtext', name, condition=Q(deleted_at__isnull=False)))
+
+    def test_native_index_types(self):
+        index = PartialIndex(fields=['a'], name='ab_a_partial', unique=False, where=PQ(b='x'), opclasses=['varchar_pattern_ops'])
+        self.assertEqual(native_index(index).opclasses, ['varchar_pattern_ops'])
+        with self.assertRaisesMessage(ValueError, 'has index type brin'):
+            native_index(PartialIndex(fields=['a'], name='ab_a_partial', unique=False, where=PQ(b='x'), index_type='brin'))
+        with self.assertRaisesMessage(ValueError, 'is unique and has operator classes'):
+            native_index(PartialIndex(fields=['a'], name='ab_a_partial', unique=True, where=PQ(b='x'), opclasses=['varchar_pattern_ops']))
+        with self.assertRaisesMessage(ValueError, 'has storage parameters'):
+            native_index(PartialIndex(fields=['a'], name='ab_a_partial', unique=False, where=PQ(b='x'), storage_params={'fillfactor': 70}))
+        index = PartialIndex(fields=['a'], name='ab_a_partial', unique=False, where=PQ(b='x'), db_tablespace='fast')
+        self.assertEqual(native_index(index).db_tablespace, 'fast')
+        with self.assertRaisesMessage(ValueError, 'is unique and has a tablespace'):
+            native_index(PartialIndex(fields=['a'], name='ab_a_partial', unique=True, where=PQ(b='x'), db_tablespace='fast'))
+        with self.assertRaisesMessage(ValueError, 'has expression keys'):
+            native_index(PartialIndex(fields=[Lower('a')], name='ab_a_partial', unique=False, where=PQ(b='x')))
+
+    def test_native_q(self):
+        q = native_q(PQ(a=PF('b')) | ~PQ(c=1))
+        self.assertEqual(q.__class__, Q)
+        self.assertEqual(q, Q(a=F('b')) | ~Q(c=1))
+        self.assertEqual(q.children[1].__class__, Q)
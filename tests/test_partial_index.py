@@ -4,6 +4,7 @@ Tests for basic fields and functions in the PartialIndex class.
 Tests interacting with a real PostgreSQL database are elsewhere.
 """
 
+from django.db.models.functions import Lower
 from django.test import SimpleTestCase
 
 from partial_index import PartialIndex, PQ
@@ -259,3 +260,228 @@ class PartialIndexSinglePQWhereTest(SimpleTestCase):
         idx2 = PartialIndex(fields=['a', 'b'], unique=False, where=PQ(a__isnull=False))
         idx2.set_name_with_model(AB)
         self.assertNotEqual(idx1.name, idx2.name)
+
+
+class PartialIndexNormalizeWhereTest(SimpleTestCase):
+    """Test the normalize_where option."""
+
+    def name(self, where, **kwargs):
+        idx = PartialIndex(fields=['a', 'b'], unique=False, where=where, **kwargs)
+        idx.set_name_with_model(AB)
+        return idx.name
+
+    def test_where_normalized(self):
+        idx = PartialIndex(fields=['a', 'b'], unique=False, where=PQ(b=2) & PQ(a__exact=1) & PQ(a=1), normalize_where=True)
+        self.assertEqual(idx.where, PQ(a=1, b=2))
+
+    def test_equivalent_where_same_name(self):
+        self.assertEqual(self.name(PQ(a=1, b=2), normalize_where=True), self.name(PQ(b=2) & PQ(a=1), normalize_where=True))
+        self.assertEqual(self.name(PQ(a=1), normalize_where=True), self.name(~~PQ(a=1), normalize_where=True))
+
+    def test_default_name_unchanged(self):
+        self.assertNotEqual(self.name(PQ(a=1, b=2)), self.name(PQ(b=2) & PQ(a=1)))
+        self.assertEqual(self.name(PQ(a=1, b=2)), self.name(PQ(a=1, b=2), normalize_where=True))
+
+    def test_deconstruct(self):
+        path, args, kwargs = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), normalize_where=True).deconstruct()
+        self.assertEqual(kwargs['normalize_where'], True)
+        path, args, kwargs = PartialIndex(fields=['a'], unique=False, where=PQ(a=1)).deconstruct()
+        self.assertNotIn('normalize_where', kwargs)
+
+    def test_text_where(self):
+        with self.assertRaisesMessage(ValueError, 'normalize_where can only be used with where=PQ()'):
+            PartialIndex(fields=['a'], unique=False, where='a IS NULL', normalize_where=True)
+
+    def test_empty_where(self):
+        with self.assertRaisesMessage(ValueError, 'The where predicate is empty.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(PQ()), normalize_where=True)
+
+
+class PartialIndexHashTest(SimpleTestCase):
+    """Test equality and hashing of index definitions."""
+
+    def test_equal(self):
+        self.assertEqual(PartialIndex(fields=['a'], unique=False, where=PQ(a=1)), PartialIndex(fields=['a'], unique=False, where=PQ(a=1)))
+        self.assertEqual(hash(PartialIndex(fields=['a'], unique=False, where=PQ(a=1))), hash(PartialIndex(fields=['a'], unique=False, where=PQ(a=1))))
+        self.assertEqual(PartialIndex(fields=['a'], unique=False, where='a = 1'), PartialIndex(fields=['a'], unique=False, where='a = 1'))
+
+    def test_not_equal(self):
+        idx = PartialIndex(fields=['a'], unique=False, where=PQ(a=1))
+        self.assertNotEqual(idx, PartialIndex(fields=['a'], unique=False, where=PQ(a=2)))
+        self.assertNotEqual(idx, PartialIndex(fields=['a'], unique=True, where=PQ(a=1)))
+        self.assertNotEqual(idx, PartialIndex(fields=['-a'], unique=False, where=PQ(a=1)))
+        self.assertNotEqual(idx, PartialIndex(fields=['a'], unique=False, where=PQ(a=1), normalize_where=True))
+        self.assertNotEqual(idx, PartialIndex(fields=['a'], unique=False, where=PQ(a=1), name='ab_a_partial'))
+
+    def test_in_list(self):
+        indexes = [PartialIndex(fields=['a'], unique=False, where=PQ(a=i)) for i in range(10)]
+        self.assertIn(PartialIndex(fields=['a'], unique=False, where=PQ(a=5)), indexes)
+        self.assertNotIn(PartialIndex(fields=['a'], unique=False, where=PQ(a=10)), indexes)
+
+    def test_hash_reset_on_name(self):
+        idx1 = PartialIndex(fields=['a'], unique=False, where=PQ(a=1))
+        idx2 = PartialIndex(fields=['a'], unique=False, where=PQ(a=1))
+        hash(idx1)
+        idx1.set_name_with_model(AB)
+        self.assertNotEqual(idx1, idx2)
+        idx2.set_name_with_model(AB)
+        self.assertEqual(idx1, idx2)
+        self.assertEqual(hash(idx1), hash(idx2))
+
+    def test_clone(self):
+        idx = PartialIndex(fields=['a', 'b'], unique=True, where=PQ(a__isnull=True), name='ab_partial')
+        self.assertEqual(idx.clone(), idx)
+        self.assertEqual(hash(idx.clone()), hash(idx))
+
+
+class PartialIndexIncludeTest(SimpleTestCase):
+    """Test the include option."""
+
+    def test_deconstruct(self):
+        idx = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), include=['b'])
+        path, args, kwargs = idx.deconstruct()
+        self.assertEqual(kwargs['include'], ['b'])
+        self.assertNotIn('include_as_key', kwargs)
+        self.assertEqual(PartialIndex(*args, **kwargs), idx)
+        path, args, kwargs = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), include=['b'], include_as_key=True).deconstruct()
+        self.assertEqual(kwargs['include_as_key'], True)
+        path, args, kwargs = PartialIndex(fields=['a'], unique=False, where=PQ(a=1)).deconstruct()
+        self.assertNotIn('include', kwargs)
+
+    def test_name(self):
+        idx1 = PartialIndex(fields=['a'], unique=False, where=PQ(a=1))
+        idx2 = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), include=['b'])
+        idx1.set_name_with_model(AB)
+        idx2.set_name_with_model(AB)
+        self.assertNotEqual(idx1.name, idx2.name)
+        self.assertNotEqual(idx1, idx2)
+
+    def test_repr(self):
+        idx = PartialIndex(fields=['a'], unique=False, where='a IS NULL', include=['b'])
+        self.assertEqual(repr(idx), "<PartialIndex: fields='a', unique=False, where='a IS NULL', include='b'>")
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(ValueError, 'PartialIndex.include must be a list or tuple.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), include='b')
+        with self.assertRaisesMessage(ValueError, 'PartialIndex.include must contain field names, without ordering.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), include=['-b'])
+        with self.assertRaisesMessage(ValueError, 'include_as_key cannot be used with unique=True'):
+            PartialIndex(fields=['a'], unique=True, where=PQ(a=1), include=['b'], include_as_key=True)
+
+
+class PartialIndexTypeTest(SimpleTestCase):
+    """Test the index_type and opclasses options."""
+
+    def test_deconstruct(self):
+        idx = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), index_type='gin', opclasses=['gin_trgm_ops'])
+        path, args, kwargs = idx.deconstruct()
+        self.assertEqual((kwargs['index_type'], kwargs['opclasses']), ('gin', ['gin_trgm_ops']))
+        self.assertEqual(PartialIndex(*args, **kwargs), idx)
+        path, args, kwargs = PartialIndex(fields=['a'], unique=False, where=PQ(a=1)).deconstruct()
+        self.assertNotIn('index_type', kwargs)
+        self.assertNotIn('opclasses', kwargs)
+
+    def test_name(self):
+        def name(**kwargs):
+            idx = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), **kwargs)
+            idx.set_name_with_model(AB)
+            return idx.name
+        self.assertEqual(name(), name(index_type='btree'))
+        self.assertNotEqual(name(), name(index_type='brin'))
+        self.assertNotEqual(name(), name(opclasses=['varchar_pattern_ops']))
+
+    def test_repr(self):
+        idx = PartialIndex(fields=['a'], unique=False, where='a IS NULL', index_type='gin', opclasses=['gin_trgm_ops'])
+        self.assertEqual(repr(idx), "<PartialIndex: fields='a', unique=False, where='a IS NULL', index_type='gin', opclasses='gin_trgm_ops'>")
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(ValueError, 'PartialIndex.index_type must be one of btree, hash, gist, spgist, gin, brin.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), index_type='bloom')
+        with self.assertRaisesMessage(ValueError, 'Only btree indexes can be unique.'):
+            PartialIndex(fields=['a'], unique=True, where=PQ(a=1), index_type='hash')
+        with self.assertRaisesMessage(ValueError, 'Only btree indexes can have descending fields.'):
+            PartialIndex(fields=['-a'], unique=False, where=PQ(a=1), index_type='brin')
+        with self.assertRaisesMessage(ValueError, 'PartialIndex.fields and PartialIndex.opclasses must have the same number of elements.'):
+            PartialIndex(fields=['a', 'b'], unique=False, where=PQ(a=1), opclasses=['gin_trgm_ops'])
+
+
+class PartialIndexExpressionTest(SimpleTestCase):
+    """Test expressions as index keys."""
+
+    def test_key_orders(self):
+        idx = PartialIndex(fields=[Lower('a').desc(), 'b'], unique=False, where=PQ(a=1))
+        self.assertEqual(idx.key_orders, [(Lower('a'), 'DESC'), ('b', '')])
+        self.assertEqual(idx.fields_orders, [('b', '')])
+        self.assertEqual(idx.key_expressions(), [Lower('a')])
+
+    def test_deconstruct(self):
+        idx = PartialIndex(fields=[Lower('a'), 'b'], unique=True, where=PQ(a=1))
+        path, args, kwargs = idx.deconstruct()
+        self.assertEqual(kwargs['fields'], [Lower('a'), 'b'])
+        self.assertEqual(PartialIndex(*args, **kwargs), idx)
+
+    def test_name(self):
+        def name(fields):
+            idx = PartialIndex(fields=fields, unique=False, where=PQ(a=1))
+            idx.set_name_with_model(AB)
+            return idx.name
+        self.assertTrue(name([Lower('a')]).startswith('testapp_ab_a_'))
+        self.assertNotEqual(name([Lower('a')]), name(['a']))
+        self.assertNotEqual(name([Lower('a')]), name([Lower('a').desc()]))
+
+    def test_repr(self):
+        idx = PartialIndex(fields=[Lower('a'), 'b'], unique=False, where='a IS NULL')
+        self.assertEqual(repr(idx), "<PartialIndex: fields='Lower(F(a)), b', unique=False, where='a IS NULL'>")
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(ValueError, 'PartialIndex.fields must contain field names or expressions.'):
+            PartialIndex(fields=[1], unique=False, where=PQ(a=1))
+        with self.assertRaisesMessage(ValueError, 'Only btree indexes can have descending fields.'):
+            PartialIndex(fields=[Lower('a').desc()], unique=False, where=PQ(a=1), index_type='brin')
+
+
+class PartialIndexStorageTest(SimpleTestCase):
+    """Test the storage_params and db_tablespace options."""
+
+    def test_deconstruct(self):
+        idx = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), storage_params={'fillfactor': 70}, db_tablespace='fast')
+        path, args, kwargs = idx.deconstruct()
+        self.assertEqual((kwargs['storage_params'], kwargs['db_tablespace']), ({'fillfactor': 70}, 'fast'))
+        self.assertEqual(PartialIndex(*args, **kwargs), idx)
+        self.assertNotEqual(PartialIndex(fields=['a'], unique=False, where=PQ(a=1), storage_params={'fillfactor': 80}), idx)
+        path, args, kwargs = PartialIndex(fields=['a'], unique=False, where=PQ(a=1)).deconstruct()
+        self.assertNotIn('storage_params', kwargs)
+        self.assertNotIn('db_tablespace', kwargs)
+
+    def test_name(self):
+        def name(**kwargs):
+            idx = PartialIndex(fields=['a'], unique=False, where=PQ(a=1), **kwargs)
+            idx.set_name_with_model(AB)
+            return idx.name
+        self.assertEqual(name(), name(db_tablespace='fast'))
+        self.assertNotEqual(name(), name(storage_params={'fillfactor': 70}))
+
+    def test_repr(self):
+        idx = PartialIndex(fields=['a'], unique=False, where='a IS NULL', storage_params={'fillfactor': 70}, db_tablespace='fast')
+        self.assertEqual(repr(idx), "<PartialIndex: fields='a', unique=False, where='a IS NULL', storage_params={'fillfactor': 70}, db_tablespace='fast'>")
+
+    def test_valid_for_index_type(self):
+        PartialIndex(fields=['a'], unique=False, where=PQ(a=1), index_type='gin', storage_params={'fastupdate': False, 'gin_pending_list_limit': 512})
+        PartialIndex(fields=['a'], unique=False, where=PQ(a=1), index_type='brin', storage_params={'pages_per_range': 32, 'autosummarize': True})
+        PartialIndex(fields=['a'], unique=False, where=PQ(a=1), index_type='gist', storage_params={'buffering': 'auto'})
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(ValueError, 'PartialIndex.storage_params must be a dict.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), storage_params=[('fillfactor', 70)])
+        with self.assertRaisesMessage(ValueError, 'Unknown storage parameter fillfacter for btree indexes. Valid parameters are deduplicate_items, fillfactor.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), storage_params={'fillfacter': 70})
+        with self.assertRaisesMessage(ValueError, 'Unknown storage parameter fillfactor for brin indexes.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), index_type='brin', storage_params={'fillfactor': 70})
+        with self.assertRaisesMessage(ValueError, 'Storage parameter fillfactor must be of type int.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), storage_params={'fillfactor': '70'})
+        with self.assertRaisesMessage(ValueError, 'Storage parameter deduplicate_items must be of type bool.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), storage_params={'deduplicate_items': 'off'})
+        with self.assertRaisesMessage(ValueError, 'Storage parameter fillfactor must be between 10 and 100.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), storage_params={'fillfactor': 5})
+        with self.assertRaisesMessage(ValueError, 'Storage parameter buffering must be on, off or auto.'):
+            PartialIndex(fields=['a'], unique=False, where=PQ(a=1), index_type='gist', storage_params={'buffering': 'yes'})
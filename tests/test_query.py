@@ -2,11 +2,19 @@
 Tests for SQL CREATE INDEX statements.
 """
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import datetime
+
 from django.db import connection
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
 
 from partial_index import query, PQ, PF
-from testapp.models import AB, ABC
+from testapp.models import AB, ABC, JobQ, RoomBookingQ
 
 
 class QueryToSqlTest(TransactionTestCase):
@@ -37,6 +45,144 @@ class QueryToSqlTest(TransactionTestCase):
         self.assertQSql(PQ(a=PF('b')), '"testapp_ab"."a" = ("testapp_ab"."b")')
 
 
+class QueryToSqlCacheTest(TransactionTestCase):
+    """Check that q_to_sql results are cached."""
+
+    def setUp(self):
+        query.clear_q_to_sql_cache()
+
+    def tearDown(self):
+        query.Q_TO_SQL_CACHE_SIZE = 512
+        query.clear_q_to_sql_cache()
+
+    def q_to_sql(self, q, model=AB):
+        with connection.schema_editor(collect_sql=True) as editor:
+            return query.q_to_sql(q, model, editor)
+
+    def test_cached(self):
+        sql = self.q_to_sql(PQ(a='Hello'))
+        with mock.patch.object(query, 'q_to_sql_params') as q_to_sql_params:
+            self.assertEqual(self.q_to_sql(PQ(a='Hello')), sql)
+            self.assertFalse(q_to_sql_params.called)
+
+    def test_different_models(self):
+        self.assertEqual(self.q_to_sql(PQ(a='Hello'), AB), '"testapp_ab"."a" = \'Hello\'')
+        self.assertEqual(self.q_to_sql(PQ(a='Hello'), ABC), '"testapp_abc"."a" = \'Hello\'')
+
+    def test_different_value_types(self):
+        self.assertNotEqual(query.hashable_q(PQ(a=1)), query.hashable_q(PQ(a=True)))
+
+    def test_unhashable_values_not_cached(self):
+        self.assertEqual(self.q_to_sql(PQ(a__in=[{}, ])), self.q_to_sql(PQ(a__in=[{}, ])))
+
+    def test_bounded_size(self):
+        query.Q_TO_SQL_CACHE_SIZE = 2
+        for value in ['x', 'y', 'z']:
+            self.q_to_sql(PQ(a=value))
+        self.assertEqual(len(query._q_to_sql_cache), 2)
+
+    def test_least_recently_used_removed(self):
+        query.Q_TO_SQL_CACHE_SIZE = 2
+        self.q_to_sql(PQ(a='x'))
+        self.q_to_sql(PQ(a='y'))
+        self.q_to_sql(PQ(a='x'))
+        self.q_to_sql(PQ(a='z'))
+        self.assertEqual([key[3] for key in query._q_to_sql_cache], [query.hashable_q(PQ(a='x')), query.hashable_q(PQ(a='z'))])
+
+
+class QueryNormalizeTest(SimpleTestCase):
+    def assertNormalized(self, q, expect):
+        self.assertEqual(query.normalize_q(q), expect)
+
+    def test_sorted(self):
+        self.assertNormalized(PQ(b=2) & PQ(a=1), PQ(a=1, b=2))
+        self.assertNormalized(PQ(b=2) | PQ(a=1), PQ(a=1) | PQ(b=2))
+
+    def test_flattened(self):
+        self.assertNormalized(PQ(PQ(PQ(a=1) & PQ(b=2)), c=3), PQ(a=1, b=2, c=3))
+        self.assertNormalized((PQ(a=1) | PQ(b=2)) | (PQ(c=3) | PQ(d=4)), PQ(a=1) | PQ(b=2) | PQ(c=3) | PQ(d=4))
+        self.assertNormalized((PQ(b=2) | PQ(c=3)) & PQ(a=1), PQ(a=1) & (PQ(b=2) | PQ(c=3)))
+
+    def test_duplicates_removed(self):
+        self.assertNormalized(PQ(a=1) & PQ(a=1), PQ(a=1))
+        self.assertNormalized(PQ(a=1) & PQ(a__exact=1), PQ(a=1))
+        self.assertNormalized(PQ(a=1) | PQ(a=1) | PQ(b=2), PQ(a=1) | PQ(b=2))
+
+    def test_different_types_not_duplicates(self):
+        self.assertEqual(len(query.normalize_q(PQ(a=1) | PQ(a=True)).children), 2)
+
+    def test_double_negation(self):
+        self.assertNormalized(~~PQ(a=1), PQ(a=1))
+        self.assertNormalized(~~PQ(a=1, b=2), PQ(a=1, b=2))
+        self.assertNormalized(~~~PQ(a=1), ~PQ(a=1))
+
+    def test_negated_group(self):
+        normalized = query.normalize_q(~PQ(PQ(a=1) | PQ(b=2)))
+        self.assertEqual((normalized.connector, normalized.negated, normalized.children), (PQ.OR, True, [('a', 1), ('b', 2)]))
+
+    def test_empty_dropped(self):
+        self.assertNormalized(PQ(PQ(), a=1), PQ(a=1))
+
+    def test_unhashable_values(self):
+        self.assertNormalized(PQ(b__in=[{}]) & PQ(a=1), PQ(a=1, b__in=[{}]))
+
+    def test_simpler_sql(self):
+        q = PQ(a='x') & ~~(PQ(b='y') & PQ(a='x'))
+        sql, params = query.q_to_sql_params(query.normalize_q(q), AB, connection)
+        self.assertEqual(sql, '("testapp_ab"."a" = %s AND "testapp_ab"."b" = %s)')
+        self.assertEqual(list(params), ['x', 'y'])
+
+
+class QueryHashTest(SimpleTestCase):
+    def test_equal_hash(self):
+        self.assertEqual(hash(PQ(a=1, b=PF('c'))), hash(PQ(a=1, b=PF('c'))))
+        self.assertEqual(hash(PQ(a=[1, 2])), hash(PQ(a=[1, 2])))
+        self.assertEqual(hash(PQ(a={'x': 1})), hash(PQ(a={'x': 1})))
+        self.assertEqual(hash(PF('a')), hash(PF('a')))
+
+    def test_not_equal(self):
+        self.assertNotEqual(PQ(a=1), PQ(a=2))
+        self.assertNotEqual(PQ(a=1), ~PQ(a=1))
+        self.assertNotEqual(PQ(a=1) | PQ(b=2), PQ(a=1) & PQ(b=2))
+        self.assertNotEqual(PQ(a={'x': 1}), PQ(a={'x': 2}))
+        self.assertNotEqual(PF('a'), PF('b'))
+
+    def test_equal_numbers(self):
+        # Same result as the comparison of the children, which the hash must not change.
+        self.assertEqual(PQ(a=1), PQ(a=1.0))
+        self.assertEqual(PQ(a=1), PQ(a=True))
+        self.assertEqual(hash(PQ(a=1)), hash(PQ(a=1.0)))
+        self.assertEqual(hash(PQ(a__in=[0, 1])), hash(PQ(a__in=[False, True])))
+
+    def test_set(self):
+        self.assertEqual(len({PQ(a=1), PQ(a=1), PQ(a=2)}), 2)
+        self.assertEqual(len({PF('a'), PF('a'), PF('b')}), 2)
+
+    def test_hash_reset(self):
+        q = PQ(a=1)
+        old_hash = hash(q)
+        q.negate()
+        self.assertNotEqual(hash(q), old_hash)
+        self.assertEqual(q, ~PQ(a=1))
+
+        q = PQ(a=1)
+        hash(q)
+        q.add(PQ(b=2), PQ.AND)
+        self.assertEqual(q, PQ(a=1, b=2))
+
+        q = PQ(a=1)
+        hash(q)
+        q.children = [('a', 2)]
+        self.assertEqual(q, PQ(a=2))
+
+    def test_combined(self):
+        q = PQ(a=1)
+        hash(q)
+        self.assertEqual(q | PQ(b=2), PQ(a=1) | PQ(b=2))
+        self.assertEqual(~q, ~PQ(a=1))
+        self.assertEqual(q, PQ(a=1))
+
+
 class QueryMentionedFieldsTest(TransactionTestCase):
     def assertMentioned(self, q, fields):
         self.assertEqual(set(query.q_mentioned_fields(q, ABC)), set(fields))
@@ -77,3 +223,84 @@ class QueryMentionedFieldsTest(TransactionTestCase):
 
     def test_or_extra(self):
         self.assertMentioned(PQ(a=12, b=34) | PQ(c=56), ['a', 'b', 'c'])
+
+
+class QueryMatchesInstanceTest(SimpleTestCase):
+    def assertMatches(self, q, expect, **values):
+        self.assertEqual(query.q_matches_instance(q, ABC(**values)), expect)
+
+    def test_empty(self):
+        self.assertMatches(PQ(), True)
+
+    def test_exact(self):
+        self.assertMatches(PQ(a='x'), True, a='x')
+        self.assertMatches(PQ(a__exact='x'), False, a='y')
+
+    def test_isnull(self):
+        self.assertMatches(PQ(a__isnull=True), True, a=None)
+        self.assertMatches(PQ(a__isnull=True), False, a='x')
+        self.assertMatches(PQ(a__isnull=False), True, a='x')
+
+    def test_and(self):
+        self.assertMatches(PQ(a='x', b='y'), True, a='x', b='y')
+        self.assertMatches(PQ(a='x', b='y'), False, a='x', b='z')
+
+    def test_or(self):
+        self.assertMatches(PQ(a='x') | PQ(b='y'), True, a='z', b='y')
+        self.assertMatches(PQ(a='x') | PQ(b='y'), False, a='z', b='z')
+
+    def test_not(self):
+        self.assertMatches(~PQ(a='x'), False, a='x')
+        self.assertMatches(~PQ(a='x'), True, a='y')
+
+    def test_comparisons(self):
+        self.assertEqual(query.q_matches_instance(PQ(order__gt=2), JobQ(order=3)), True)
+        self.assertEqual(query.q_matches_instance(PQ(order__gt=2), JobQ(order=2)), False)
+        self.assertEqual(query.q_matches_instance(PQ(order__gte=2), JobQ(order=2)), True)
+        self.assertEqual(query.q_matches_instance(PQ(order__lt=2), JobQ(order=1)), True)
+        self.assertEqual(query.q_matches_instance(PQ(order__lte=2), JobQ(order=3)), False)
+
+    def test_text_comparisons(self):
+        # The database orders text by the collation of the column, which may differ from Python.
+        self.assertMatches(PQ(a__gt='b'), None, a='c')
+        self.assertMatches(PQ(a__lte='b'), None, a='B')
+        self.assertMatches(PQ(a__lt=PF('b')), None, a='x', b='y')
+
+    def test_comparison_null(self):
+        self.assertMatches(PQ(a__gt='b'), False, a=None)
+        self.assertMatches(~PQ(a__gt='b'), True, a=None)
+
+    def test_naive_and_aware_datetimes(self):
+        # Django makes naive datetimes aware before querying, so the database may match where Python would not.
+        naive = datetime.datetime(2020, 1, 1)
+        aware = timezone.make_aware(naive, timezone.utc)
+        for q in [PQ(deleted_at=naive), PQ(deleted_at__in=[naive]), PQ(deleted_at__gte=naive)]:
+            self.assertEqual(query.q_matches_instance(q, RoomBookingQ(deleted_at=aware)), None)
+        self.assertEqual(query.q_matches_instance(PQ(deleted_at=aware), RoomBookingQ(deleted_at=aware)), True)
+        self.assertEqual(query.q_matches_instance(PQ(deleted_at=naive), RoomBookingQ(deleted_at=naive)), True)
+
+    def test_in(self):
+        self.assertMatches(PQ(a__in=['x', 'y']), True, a='y')
+        self.assertMatches(PQ(a__in=['x', 'y']), False, a='z')
+
+    def test_f(self):
+        self.assertMatches(PQ(a=PF('b')), True, a='x', b='x')
+        self.assertMatches(PQ(a=PF('b')), False, a='x', b='y')
+
+    def test_f_null(self):
+        self.assertMatches(PQ(a=PF('b')), False, a=None, b='x')
+        self.assertMatches(PQ(a=PF('b')), None, a='x', b=None)
+
+    def test_not_and(self):
+        self.assertMatches(~PQ(a='x', b='y'), True, a='x', b='z')
+        self.assertMatches(~(PQ(a='x') | PQ(b='y')), False, a='z', b='y')
+
+    def test_unsupported_expression(self):
+        self.assertMatches(PQ(a=PF('b') + PF('c')), None, a='x', b='y', c='z')
+
+    def test_unsupported_lookup(self):
+        self.assertMatches(PQ(a__contains='x'), None, a='xyz')
+
+    def test_unsupported_lookup_decided_by_other_terms(self):
+        self.assertMatches(PQ(a__contains='x', b='y'), False, a='xyz', b='z')
+        self.assertMatches(PQ(a__contains='x') | PQ(b='y'), True, a='xyz', b='y')
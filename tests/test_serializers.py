@@ -1,6 +1,13 @@
 """
 Tests for actual use of the indexes after creating models with them.
 """
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from testapp.serializers import RoomBookingBatchSerializer
+from testapp.models import User, Room, RoomBookingQ
+
 # import datetime
 # from unittest import skip
 #
@@ -99,3 +106,57 @@ Tests for actual use of the indexes after creating models with them.
 #     These have to be provided from an existing instance.
 #     """
 #     serializerclass = RoomBookingJustRoomSerializer
+
+
+class ListSerializerTest(TransactionTestCase):
+    """Test that a many=True serializer with PartialUniqueListSerializerMixin validates all items together."""
+    conflict_error = 'RoomBookingQ with the same values for room, user already exists.'
+    duplicate_error = 'RoomBookingQ with the same values for room, user is repeated in the same batch.'
+
+    def setUp(self):
+        self.user1 = User.objects.create(name='User1')
+        self.user2 = User.objects.create(name='User2')
+        self.room1 = Room.objects.create(name='Room1')
+        self.room2 = Room.objects.create(name='Room2')
+        self.booking1 = RoomBookingQ.objects.create(user=self.user1, room=self.room1)
+
+    def serializer(self, *rows):
+        return RoomBookingBatchSerializer(data=[{'user': user.id, 'room': room.id} for user, room in rows], many=True)
+
+    def test_valid(self):
+        ser = self.serializer((self.user2, self.room1), (self.user1, self.room2))
+        self.assertTrue(ser.is_valid(), 'Serializer errors: %s' % ser.errors)
+
+    def test_conflict_with_existing(self):
+        ser = self.serializer((self.user2, self.room1), (self.user1, self.room1))
+        self.assertFalse(ser.is_valid())
+        self.assertEqual(ser.errors, [{}, {'non_field_errors': [self.conflict_error]}])
+
+    def test_duplicate_in_batch(self):
+        ser = self.serializer((self.user2, self.room2), (self.user2, self.room2))
+        self.assertFalse(ser.is_valid())
+        self.assertEqual(ser.errors, [{}, {'non_field_errors': [self.duplicate_error]}])
+
+    def test_update_unchanged_valid(self):
+        booking2 = RoomBookingQ.objects.create(user=self.user2, room=self.room1)
+        ser = RoomBookingBatchSerializer(
+            instance=[self.booking1, booking2], many=True,
+            data=[{'user': self.user1.id, 'room': self.room1.id}, {'user': self.user2.id, 'room': self.room1.id}],
+        )
+        self.assertTrue(ser.is_valid(), 'Serializer errors: %s' % ser.errors)
+
+    def test_update_conflict_with_existing(self):
+        booking2 = RoomBookingQ.objects.create(user=self.user2, room=self.room1)
+        ser = RoomBookingBatchSerializer(instance=[booking2], many=True, data=[{'user': self.user1.id, 'room': self.room1.id}])
+        self.assertFalse(ser.is_valid())
+        self.assertEqual(ser.errors, [{'non_field_errors': [self.conflict_error]}])
+
+    def test_optimistic_no_queries(self):
+        RoomBookingQ.partial_unique_optimistic = True
+        try:
+            ser = self.serializer((self.user2, self.room2), (self.user2, self.room2))
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(ser.is_valid(), 'Serializer errors: %s' % ser.errors)
+            self.assertEqual([q for q in queries.captured_queries if 'testapp_roombookingq' in q['sql']], [])
+        finally:
+            RoomBookingQ.partial_unique_optimistic = False
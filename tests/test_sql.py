@@ -5,8 +5,10 @@ from django.db import connection
 from django.test import TransactionTestCase
 import re
 
+from django.db.models.functions import Lower
+
 from partial_index import PartialIndex, PQ
-from testapp.models import RoomBookingText, JobText, ComparisonText, RoomBookingQ, JobQ, ComparisonQ
+from testapp.models import AB, AccountQ, RoomBookingText, JobText, ComparisonText, RoomBookingQ, JobQ, ComparisonQ
 
 
 ROOMBOOKING_TEXT_SQL = r'^CREATE UNIQUE INDEX "testapp_[a-zA-Z0-9_]+_partial" ' + \
@@ -120,6 +122,78 @@ class PartialIndexSqlTest(TransactionTestCase):
             editor.create_model(ComparisonQ)
         self.assertContainsMatch(editor.collected_sql, COMPARISON_Q_SQL)
 
+    def test_concurrently_createsql(self):
+        with self.schema_editor() as editor:
+            if editor.connection.vendor == 'postgresql':
+                sql = RoomBookingQ._meta.indexes[0].create_sql(RoomBookingQ, editor, concurrently=True)
+                self.assertRegex(sql, ROOMBOOKING_Q_SQL.replace('INDEX', 'INDEX CONCURRENTLY'))
+            else:
+                with self.assertRaises(ValueError):
+                    RoomBookingQ._meta.indexes[0].create_sql(RoomBookingQ, editor, concurrently=True)
+
+    def test_include_createsql(self):
+        index = PartialIndex(fields=['-order'], name='testapp_jobq_include_partial', unique=False, where=PQ(is_complete=False), include=['group'])
+        with self.schema_editor() as editor:
+            if editor.connection.vendor == 'postgresql':
+                sql = index.create_sql(JobQ, editor)
+                self.assertRegex(sql, JOB_Q_NONUNIQUE_SQL.replace(r'DESC\) ', r'DESC\) INCLUDE \("group"\) ') % self.false(editor))
+            else:
+                with self.assertRaisesMessage(ValueError, 'Index testapp_jobq_include_partial has include columns, which SQLite does not support.'):
+                    index.create_sql(JobQ, editor)
+
+    def test_include_as_key_createsql(self):
+        index = PartialIndex(fields=['-order'], name='testapp_jobq_include_partial', unique=False, where=PQ(is_complete=False), include=['group'], include_as_key=True)
+        with self.schema_editor() as editor:
+            sql = index.create_sql(JobQ, editor)
+            if editor.connection.vendor == 'postgresql':
+                self.assertIn(' INCLUDE ("group") ', sql)
+            else:
+                self.assertRegex(sql, JOB_Q_NONUNIQUE_SQL.replace(r'DESC\)', r'DESC, "group"\)') % self.false(editor))
+
+    def test_index_type_createsql(self):
+        index = PartialIndex(fields=['a'], name='testapp_ab_a_gin_partial', unique=False, where=PQ(b='x'), index_type='gin', opclasses=['gin_trgm_ops'])
+        with self.schema_editor() as editor:
+            if editor.connection.vendor == 'postgresql':
+                sql = index.create_sql(AB, editor)
+                self.assertEqual(sql, 'CREATE INDEX "testapp_ab_a_gin_partial" ON "testapp_ab" USING gin ("a" gin_trgm_ops) WHERE "testapp_ab"."b" = \'x\'')
+            else:
+                with self.assertRaisesMessage(ValueError, 'Index testapp_ab_a_gin_partial has an index type or operator classes, which SQLite does not support.'):
+                    index.create_sql(AB, editor)
+
+    def test_btree_createsql(self):
+        index = PartialIndex(fields=['-order'], name='testapp_jobq_btree_partial', unique=False, where=PQ(is_complete=False), index_type='btree')
+        with self.schema_editor() as editor:
+            sql = index.create_sql(JobQ, editor)
+            if editor.connection.vendor == 'postgresql':
+                self.assertRegex(sql, JOB_Q_NONUNIQUE_SQL.replace(r'"testapp_jobq" ', r'"testapp_jobq" USING btree ') % self.false(editor))
+            else:
+                self.assertRegex(sql, JOB_Q_NONUNIQUE_SQL % self.false(editor))
+
+    def test_storage_params_createsql(self):
+        index = PartialIndex(fields=['-order'], name='testapp_jobq_storage_partial', unique=False, where=PQ(is_complete=False),
+                             storage_params={'fillfactor': 70, 'deduplicate_items': False}, db_tablespace='fast')
+        with self.schema_editor() as editor:
+            sql = index.create_sql(JobQ, editor)
+            if editor.connection.vendor == 'postgresql':
+                self.assertRegex(sql, JOB_Q_NONUNIQUE_SQL.replace(
+                    r'DESC\) ', r'DESC\) WITH \(deduplicate_items = off, fillfactor = 70\) TABLESPACE "fast" ') % self.false(editor))
+            else:
+                # Storage parameters and tablespaces only tune the physical storage, and are ignored on SQLite.
+                self.assertRegex(sql, JOB_Q_NONUNIQUE_SQL % self.false(editor))
+
+    def test_expression_createsql(self):
+        with self.schema_editor() as editor:
+            sql = AccountQ._meta.indexes[0].create_sql(AccountQ, editor)
+        self.assertRegex(sql, r'^CREATE UNIQUE INDEX "testapp_[a-zA-Z0-9_]+_partial" '
+                              r'ON "testapp_accountq" \(\(LOWER\("email"\)\)\) '
+                              r'WHERE "testapp_accountq"."is_active" = (true|1);?$')
+
+    def test_descending_expression_createsql(self):
+        index = PartialIndex(fields=[Lower('email').desc(), 'is_active'], name='testapp_accountq_desc_partial', unique=False, where=PQ(is_active=True))
+        with self.schema_editor() as editor:
+            sql = index.create_sql(AccountQ, editor)
+        self.assertIn(' ON "testapp_accountq" ((LOWER("email")) DESC, "is_active") WHERE ', sql)
+
 
 class PartialIndexCreateTest(TransactionTestCase):
     """Check that the index really can be added to and removed from the model in the DB."""
@@ -197,3 +271,20 @@ class PartialIndexCreateTest(TransactionTestCase):
             'index': True,
             'unique': False,
         })
+
+    def test_expression(self):
+        index_name = 'accountq_test_idx'
+        index = PartialIndex(fields=[Lower('email')], name=index_name, unique=True, where=PQ(is_active=True))
+        self.assertAddRemoveConstraint(AccountQ, index_name, index, {
+            'index': True,
+            'unique': True,
+        })
+
+    def test_include(self):
+        index_name = 'jobq_include_idx'
+        index = PartialIndex(fields=['-order'], name=index_name, unique=False, where=PQ(is_complete=False), include=['group'], include_as_key=True)
+        self.assertAddRemoveConstraint(JobQ, index_name, index, {
+            'columns': ['order'] if connection.vendor == 'postgresql' else ['order', 'group'],
+            'index': True,
+            'unique': False,
+        })
@@ -0,0 +1,443 @@
+"""
+Tests for ValidatePartialUniqueMixin used directly on model instances.
+"""
+from unittest import skipIf
+import sys
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction, IntegrityError
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from partial_index import PartialUniqueValidationError
+from partial_index.mixins import partial_unique_index_infos
+from testapp.models import User, Room, RoomBookingQ, RoomBookingText, JobUniqueQ, AccountQ, LabelQ
+
+
+class IndexInfoCacheTest(TransactionTestCase):
+    """Test that validation metadata is computed once per model."""
+
+    def test_cached_per_model(self):
+        self.assertIs(partial_unique_index_infos(RoomBookingQ), partial_unique_index_infos(RoomBookingQ))
+
+    def test_contents(self):
+        infos = partial_unique_index_infos(RoomBookingQ)
+        self.assertEqual(len(infos), 1)
+        self.assertIs(infos[0].idx, RoomBookingQ._meta.indexes[0])
+        self.assertEqual(infos[0].mentioned_fields, ['deleted_at', 'room', 'user'])
+        self.assertEqual(infos[0].attnames, ['deleted_at', 'room_id', 'user_id'])
+
+    def test_cleared_when_installed_apps_change(self):
+        before = partial_unique_index_infos(RoomBookingQ)
+        with override_settings(INSTALLED_APPS=['testapp']):
+            self.assertIsNot(partial_unique_index_infos(RoomBookingQ), before)
+
+    def test_text_condition_not_cached(self):
+        for i in range(2):
+            with self.assertRaises(ImproperlyConfigured):
+                partial_unique_index_infos(RoomBookingText)
+
+
+class ValidationQueriesTest(TransactionTestCase):
+    """Test the number of queries used by validate_partial_unique()."""
+
+    def setUp(self):
+        self.user1 = User.objects.create(name='User1')
+        self.room1 = Room.objects.create(name='Room1')
+
+    def test_validate_not_covered_no_queries(self):
+        booking = RoomBookingQ(user=self.user1, room=self.room1, deleted_at=timezone.now())
+        booking.validate_partial_unique()
+        with self.assertNumQueries(0):
+            booking.validate_partial_unique()
+
+    def test_validate_single_query(self):
+        booking = RoomBookingQ(user=self.user1, room=self.room1)
+        booking.validate_partial_unique()
+        with self.assertNumQueries(1):
+            booking.validate_partial_unique()
+
+
+class MultipleIndexesTest(TransactionTestCase):
+    """Test that models with several unique partial indexes are validated with a single query."""
+    order_error = 'JobUniqueQ with the same values for order already exists.'
+    group_error = 'JobUniqueQ with the same values for group already exists.'
+
+    def setUp(self):
+        JobUniqueQ.objects.create(order=1, group=1)
+        JobUniqueQ.objects.create(order=2, group=2, is_complete=True)
+
+    def assertValid(self, job):
+        with self.assertNumQueries(1):
+            job.validate_partial_unique()
+
+    def assertInvalid(self, job, message):
+        with self.assertNumQueries(1):
+            with self.assertRaisesMessage(PartialUniqueValidationError, message):
+                job.validate_partial_unique()
+
+    def test_valid(self):
+        self.assertValid(JobUniqueQ(order=2, group=2))
+
+    def test_first_index_conflict(self):
+        self.assertInvalid(JobUniqueQ(order=1, group=2), self.order_error)
+
+    def test_second_index_conflict(self):
+        self.assertInvalid(JobUniqueQ(order=2, group=1), self.group_error)
+
+    def test_both_conflict(self):
+        self.assertInvalid(JobUniqueQ(order=1, group=1), self.order_error)
+
+    def test_existing_valid(self):
+        self.assertValid(JobUniqueQ.objects.get(order=1))
+
+    def test_conflicts(self):
+        job = JobUniqueQ(order=2, group=1)
+        self.assertEqual(job.partial_unique_conflicts(partial_unique_index_infos(JobUniqueQ)), [False, True])
+
+
+class ConflictSqlTest(TransactionTestCase):
+    """Test the precompiled conflict query."""
+
+    def setUp(self):
+        self.info = partial_unique_index_infos(RoomBookingQ)[0]
+        self.user1 = User.objects.create(name='User1')
+        self.user2 = User.objects.create(name='User2')
+        self.room1 = Room.objects.create(name='Room1')
+        self.booking1 = RoomBookingQ.objects.create(user=self.user1, room=self.room1)
+
+    def test_sql(self):
+        sql, params = self.info.conflict_sql(RoomBookingQ, connection, ('deleted_at', ), True)
+        self.assertEqual(sql, 'SELECT 1 FROM "testapp_roombookingq" WHERE "testapp_roombookingq"."deleted_at" IS NULL AND '
+                              '"testapp_roombookingq"."room_id" = %s AND "testapp_roombookingq"."user_id" = %s AND '
+                              '("testapp_roombookingq"."deleted_at" IS NULL) AND "testapp_roombookingq"."id" <> %s LIMIT 1')
+        self.assertEqual(params, ())
+
+    def test_sql_cached(self):
+        self.assertIs(self.info.conflict_sql(RoomBookingQ, connection, (), False),
+                      self.info.conflict_sql(RoomBookingQ, connection, (), False))
+
+    def test_same_result_as_queryset(self):
+        RoomBookingQ.objects.create(user=self.user2, room=self.room1, deleted_at=timezone.now())
+        instances = [
+            self.booking1,
+            RoomBookingQ(user=self.user1, room=self.room1),
+            RoomBookingQ(user=self.user2, room=self.room1),
+            RoomBookingQ(user=self.user1, room=self.room1, deleted_at=timezone.now()),
+            RoomBookingQ(user=self.user2, room=self.room1, deleted_at=timezone.now()),
+        ]
+        for instance in instances:
+            self.assertEqual(instance.partial_unique_conflict_exists(self.info),
+                             instance.partial_unique_conflict_queryset(self.info).exists())
+
+
+class TrackChangesTest(TransactionTestCase):
+    """Test that partial_unique_track_changes skips validation for unchanged fields."""
+
+    def setUp(self):
+        RoomBookingQ.partial_unique_track_changes = True
+        self.user1 = User.objects.create(name='User1')
+        self.user2 = User.objects.create(name='User2')
+        self.room1 = Room.objects.create(name='Room1')
+        RoomBookingQ.objects.create(user=self.user1, room=self.room1)
+
+    def tearDown(self):
+        RoomBookingQ.partial_unique_track_changes = False
+
+    def test_loaded_unchanged_no_queries(self):
+        booking = RoomBookingQ.objects.get()
+        with self.assertNumQueries(0):
+            booking.validate_partial_unique()
+
+    def test_loaded_unrelated_field_changed_no_queries(self):
+        booking = RoomBookingQ.objects.select_related('user').get()
+        booking.user.name = 'Renamed'
+        with self.assertNumQueries(0):
+            booking.validate_partial_unique()
+
+    def test_loaded_changed_validated(self):
+        booking = RoomBookingQ.objects.get()
+        booking.user = self.user2
+        with self.assertNumQueries(1):
+            booking.validate_partial_unique()
+
+    def test_loaded_changed_back_no_queries(self):
+        booking = RoomBookingQ.objects.get()
+        booking.user = self.user2
+        booking.user = self.user1
+        with self.assertNumQueries(0):
+            booking.validate_partial_unique()
+
+    def test_deferred_field_unchanged_no_queries(self):
+        booking = RoomBookingQ.objects.defer('deleted_at').get()
+        with self.assertNumQueries(0):
+            booking.validate_partial_unique()
+
+    def test_saved_changes_remembered(self):
+        booking = RoomBookingQ.objects.get()
+        booking.user = self.user2
+        booking.save()
+        with self.assertNumQueries(0):
+            booking.validate_partial_unique()
+
+    def test_saved_update_fields_positional(self):
+        booking = RoomBookingQ.objects.get()
+        booking.user = self.user2
+        booking.save(False, False, None, ['room'])
+        with self.assertNumQueries(1):
+            booking.validate_partial_unique()
+
+    def test_refresh_from_db_remembered(self):
+        booking = RoomBookingQ.objects.get()
+        RoomBookingQ.objects.update(user=self.user2)
+        booking.refresh_from_db()
+        self.assertEqual(booking.user_id, self.user2.id)
+        with self.assertNumQueries(0):
+            booking.validate_partial_unique()
+
+    def test_new_instance_validated(self):
+        booking = RoomBookingQ(user=self.user2, room=self.room1)
+        with self.assertNumQueries(1):
+            booking.validate_partial_unique()
+
+    def test_changed_conflict_detected(self):
+        RoomBookingQ.objects.create(user=self.user1, room=self.room1, deleted_at=timezone.now())
+        booking = RoomBookingQ.objects.get(deleted_at__isnull=False)
+        booking.deleted_at = None
+        with self.assertRaises(PartialUniqueValidationError):
+            booking.validate_partial_unique()
+
+
+class OptimisticTest(TransactionTestCase):
+    """Test that partial_unique_optimistic turns IntegrityErrors on save into validation errors."""
+    conflict_error = 'RoomBookingQ with the same values for room, user already exists.'
+
+    def setUp(self):
+        RoomBookingQ.partial_unique_optimistic = True
+        self.user1 = User.objects.create(name='User1')
+        self.user2 = User.objects.create(name='User2')
+        self.room1 = Room.objects.create(name='Room1')
+        RoomBookingQ.objects.create(user=self.user1, room=self.room1)
+
+    def tearDown(self):
+        RoomBookingQ.partial_unique_optimistic = False
+
+    def test_full_clean_no_queries(self):
+        booking = RoomBookingQ(user=self.user1, room=self.room1)
+        with self.assertNumQueries(0):
+            booking.validate_unique()
+
+    def test_save_valid(self):
+        RoomBookingQ(user=self.user2, room=self.room1).save()
+        self.assertEqual(RoomBookingQ.objects.count(), 2)
+
+    def test_save_conflict(self):
+        booking = RoomBookingQ(user=self.user1, room=self.room1)
+        with self.assertRaisesMessage(PartialUniqueValidationError, self.conflict_error):
+            booking.save()
+        self.assertIsNone(booking.pk)
+
+    def test_save_using_positional(self):
+        booking = RoomBookingQ(user=self.user1, room=self.room1)
+        # The database passed to save() must be used instead of the router's choice.
+        with mock.patch('partial_index.mixins.router.db_for_write', return_value='other'):
+            with self.assertRaises(PartialUniqueValidationError):
+                booking.save(False, False, 'default')
+
+    def test_save_conflict_keeps_outer_transaction(self):
+        with transaction.atomic():
+            RoomBookingQ.objects.create(user=self.user2, room=self.room1)
+            with self.assertRaises(PartialUniqueValidationError):
+                RoomBookingQ(user=self.user1, room=self.room1).save()
+            self.assertEqual(RoomBookingQ.objects.count(), 2)
+
+    def test_matches_integrity_error_messages(self):
+        info = partial_unique_index_infos(RoomBookingQ)[0]
+        self.assertTrue(info.matches_integrity_error(IntegrityError(
+            'duplicate key value violates unique constraint "%s"\nDETAIL: Key (user_id, room_id)=(1, 1) already exists.' % info.name)))
+        self.assertTrue(info.matches_integrity_error(IntegrityError(
+            'UNIQUE constraint failed: testapp_roombookingq.user_id, testapp_roombookingq.room_id')))
+        self.assertTrue(info.matches_integrity_error(IntegrityError("UNIQUE constraint failed: index '%s'" % info.name)))
+        self.assertFalse(info.matches_integrity_error(IntegrityError('duplicate key value violates unique constraint "other"')))
+        self.assertFalse(info.matches_integrity_error(IntegrityError('UNIQUE constraint failed: testapp_roombookingq.user_id')))
+
+    def test_other_integrity_error_reraised(self):
+        with self.assertRaises(IntegrityError):
+            RoomBookingQ(user=self.user1, room_id=12345).save()
+
+
+@skipIf(sys.version_info < (3, 5), 'Async validation requires Python 3.5 or later.')
+class AsyncValidationTest(TransactionTestCase):
+    """Test avalidate_partial_unique() and avalidate_unique()."""
+    conflict_error = 'RoomBookingQ with the same values for room, user already exists.'
+
+    def setUp(self):
+        self.user1 = User.objects.create(name='User1')
+        self.user2 = User.objects.create(name='User2')
+        self.room1 = Room.objects.create(name='Room1')
+        RoomBookingQ.objects.create(user=self.user1, room=self.room1)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_valid(self):
+        self.loop.run_until_complete(RoomBookingQ(user=self.user2, room=self.room1).avalidate_partial_unique())
+
+    def test_conflict(self):
+        with self.assertRaisesMessage(PartialUniqueValidationError, self.conflict_error):
+            self.loop.run_until_complete(RoomBookingQ(user=self.user1, room=self.room1).avalidate_partial_unique())
+
+    def test_validate_unique_conflict(self):
+        with self.assertRaisesMessage(PartialUniqueValidationError, self.conflict_error):
+            self.loop.run_until_complete(RoomBookingQ(user=self.user1, room=self.room1).avalidate_unique())
+
+    def test_not_covered_no_queries(self):
+        booking = RoomBookingQ(user=self.user1, room=self.room1, deleted_at=timezone.now())
+        with self.assertNumQueries(0):
+            self.loop.run_until_complete(booking.avalidate_partial_unique())
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            self.loop.run_until_complete(RoomBookingQ(user=self.user2, room=self.room1).avalidate_partial_unique())
+
+    def test_conflict_in_same_transaction(self):
+        with transaction.atomic():
+            RoomBookingQ.objects.create(user=self.user2, room=self.room1)
+            with self.assertRaisesMessage(PartialUniqueValidationError, self.conflict_error):
+                self.loop.run_until_complete(RoomBookingQ(user=self.user2, room=self.room1).avalidate_partial_unique())
+
+
+class BulkValidationTest(TransactionTestCase):
+    """Test validate_partial_unique_bulk() on many instances at once."""
+    conflict_error = 'RoomBookingQ with the same values for room, user already exists.'
+    duplicate_error = 'RoomBookingQ with the same values for room, user is repeated in the same batch.'
+
+    def setUp(self):
+        self.user1 = User.objects.create(name='User1')
+        self.user2 = User.objects.create(name='User2')
+        self.room1 = Room.objects.create(name='Room1')
+        self.room2 = Room.objects.create(name='Room2')
+        self.booking1 = RoomBookingQ.objects.create(user=self.user1, room=self.room1)
+
+    def assertBulkErrors(self, instances, expect_errors):
+        with self.assertRaises(PartialUniqueValidationError) as cm:
+            RoomBookingQ.validate_partial_unique_bulk(instances)
+        self.assertEqual({position: [e.message for e in errors] for position, errors in cm.exception.error_dict.items()},
+                         expect_errors)
+
+    def test_empty(self):
+        with self.assertNumQueries(0):
+            RoomBookingQ.validate_partial_unique_bulk([])
+
+    def test_no_conflicts_valid(self):
+        RoomBookingQ.validate_partial_unique_bulk([
+            RoomBookingQ(user=self.user2, room=self.room1),
+            RoomBookingQ(user=self.user1, room=self.room2),
+        ])
+
+    def test_one_query_per_index(self):
+        instances = [RoomBookingQ(user=User.objects.create(name='U%d' % i), room=self.room2) for i in range(20)]
+        with self.assertNumQueries(1):
+            RoomBookingQ.validate_partial_unique_bulk(instances)
+
+    def test_conflict_with_existing_row(self):
+        self.assertBulkErrors([
+            RoomBookingQ(user=self.user2, room=self.room1),
+            RoomBookingQ(user=self.user1, room=self.room1),
+        ], {1: [self.conflict_error]})
+
+    def test_existing_row_itself_valid(self):
+        RoomBookingQ.validate_partial_unique_bulk([self.booking1])
+
+    def test_conflict_when_existing_deleted_valid(self):
+        self.booking1.deleted_at = timezone.now()
+        self.booking1.save()
+        RoomBookingQ.validate_partial_unique_bulk([RoomBookingQ(user=self.user1, room=self.room1)])
+
+    def test_duplicates_in_batch(self):
+        self.assertBulkErrors([
+            RoomBookingQ(user=self.user2, room=self.room2),
+            RoomBookingQ(user=self.user1, room=self.room2),
+            RoomBookingQ(user=self.user2, room=self.room2),
+        ], {2: [self.duplicate_error]})
+
+    def test_deleted_duplicates_in_batch_valid(self):
+        deleted_at = timezone.now()
+        with self.assertNumQueries(0):
+            RoomBookingQ.validate_partial_unique_bulk([
+                RoomBookingQ(user=self.user2, room=self.room2, deleted_at=deleted_at),
+                RoomBookingQ(user=self.user2, room=self.room2, deleted_at=deleted_at),
+            ])
+
+    def test_unknown_coverage_duplicates_in_batch_valid(self):
+        # status__startswith cannot be evaluated in Python, and the database accepts both rows.
+        LabelQ.validate_partial_unique_bulk([
+            LabelQ(name='a', group=1, status='archived'),
+            LabelQ(name='a', group=1, status='archived'),
+        ])
+        LabelQ.objects.bulk_create([LabelQ(name='a', group=1, status='archived'), LabelQ(name='a', group=1, status='archived')])
+
+    def test_unknown_coverage_conflict_with_existing_row(self):
+        LabelQ.objects.create(name='a', group=1, status='active')
+        with self.assertRaises(PartialUniqueValidationError) as cm:
+            LabelQ.validate_partial_unique_bulk([LabelQ(name='a', group=1, status='active')])
+        self.assertEqual(list(cm.exception.error_dict), [0])
+
+    def test_chunks_include_where_params(self):
+        if connection.features.max_query_params is None:
+            self.skipTest('The database has no limit on query parameters.')
+        instances = [LabelQ(name='a', group=i, status='active') for i in range(999)]
+        # 3 mentioned fields and 1 where parameter: 332 keys per query fit into 999 parameters on SQLite, 333 would not.
+        with self.assertNumQueries(4):
+            LabelQ.validate_partial_unique_bulk(instances)
+
+    def test_text_condition_improperlyconfigured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RoomBookingText.validate_partial_unique_bulk([RoomBookingText(user=self.user1, room=self.room1)])
+
+
+class ExpressionKeyTest(TransactionTestCase):
+    """Test validation of a unique PartialIndex with an expression key, Lower('email')."""
+    error = 'AccountQ with the same values for Lower(F(email)) already exists.'
+
+    def setUp(self):
+        self.account = AccountQ.objects.create(email='Ann@example.com')
+
+    def test_info(self):
+        info = partial_unique_index_infos(AccountQ)[0]
+        self.assertEqual(info.mentioned_fields, ['is_active'])
+        self.assertEqual(info.tracked_attnames, ['is_active', 'email'])
+
+    def test_conflict(self):
+        account = AccountQ(email='ann@EXAMPLE.com')
+        with self.assertRaisesMessage(PartialUniqueValidationError, self.error):
+            account.validate_partial_unique()
+        self.assertTrue(account.partial_unique_conflict_queryset(partial_unique_index_infos(AccountQ)[0]).exists())
+
+    def test_valid(self):
+        AccountQ(email='bob@example.com').validate_partial_unique()
+        AccountQ(email='ann@example.com', is_active=False).validate_partial_unique()
+        self.account.validate_partial_unique()
+        account = AccountQ(email='bob@example.com')
+        self.assertFalse(account.partial_unique_conflict_queryset(partial_unique_index_infos(AccountQ)[0]).exists())
+
+    def test_database_conflict(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                AccountQ.objects.bulk_create([AccountQ(email='ANN@example.com')])
+
+    def test_bulk(self):
+        with self.assertRaises(PartialUniqueValidationError) as cm:
+            AccountQ.validate_partial_unique_bulk([AccountQ(email='bob@example.com'), AccountQ(email='ANN@example.com')])
+        self.assertEqual(list(cm.exception.error_dict), [1])
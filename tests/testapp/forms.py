@@ -1,6 +1,7 @@
 """ModelForms for testing ValidatePartialUniqueMixin."""
 from django import forms
 
+from partial_index.forms import PartialUniqueBaseModelFormSet
 from testapp.models import RoomBookingQ, RoomBookingText
 
 
@@ -30,3 +31,6 @@ class RoomBookingJustRoomForm(forms.ModelForm):
     class Meta:
         model = RoomBookingQ
         fields = ('room', )
+
+
+RoomBookingFormSet = forms.modelformset_factory(RoomBookingQ, formset=PartialUniqueBaseModelFormSet, fields=('user', 'room'), extra=3)
@@ -2,8 +2,10 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.db.models.functions import Lower
 
 from partial_index import PartialIndex, PQ, PF, ValidatePartialUniqueMixin
+from partial_index.managers import PartialIndexManager
 
 
 class AB(models.Model):
@@ -70,6 +72,8 @@ class JobQ(models.Model):
     group = models.IntegerField()
     is_complete = models.BooleanField(default=False)
 
+    objects = PartialIndexManager()
+
     class Meta:
         indexes = [
             PartialIndex(fields=['-order'], unique=False, where=PQ(is_complete=False)),
@@ -97,3 +101,39 @@ class ComparisonQ(models.Model):
         indexes = [
             PartialIndex(fields=['a', 'b'], unique=True, where=PQ(a=PF('b'))),
         ]
+
+
+class JobUniqueQ(ValidatePartialUniqueMixin, models.Model):
+    """Several unique partial indexes on the same model."""
+    order = models.IntegerField()
+    group = models.IntegerField()
+    is_complete = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            PartialIndex(fields=['order'], unique=True, where=PQ(is_complete=False)),
+            PartialIndex(fields=['group'], unique=True, where=PQ(is_complete=False)),
+        ]
+
+
+class AccountQ(ValidatePartialUniqueMixin, models.Model):
+    """Unique partial index with an expression key."""
+    email = models.CharField(max_length=100)
+    is_active = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [
+            PartialIndex(fields=[Lower('email')], unique=True, where=PQ(is_active=True)),
+        ]
+
+
+class LabelQ(ValidatePartialUniqueMixin, models.Model):
+    """Unique partial index with a condition that cannot be evaluated in Python."""
+    name = models.CharField(max_length=50)
+    group = models.IntegerField()
+    status = models.CharField(max_length=50)
+
+    class Meta:
+        indexes = [
+            PartialIndex(fields=['name', 'group'], unique=True, where=PQ(status__startswith='active')),
+        ]
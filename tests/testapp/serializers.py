@@ -1,5 +1,6 @@
 from rest_framework import serializers
 
+from partial_index.serializers import PartialUniqueListSerializerMixin
 from testapp.models import RoomBookingText, RoomBookingQ
 
 
@@ -29,3 +30,15 @@ class RoomBookingJustRoomSerializer(serializers.ModelSerializer):
     class Meta:
         model = RoomBookingQ
         fields = ('room', )
+
+
+class RoomBookingListSerializer(PartialUniqueListSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class RoomBookingBatchSerializer(serializers.ModelSerializer):
+    """Validates partial unique constraints when used with many=True."""
+    class Meta:
+        model = RoomBookingQ
+        fields = ('user', 'room', 'deleted_at')
+        list_serializer_class = RoomBookingListSerializer